@@ -12,6 +12,11 @@ from Distiller.mp_aug import aug_process, generate_aug_data
 from Distiller.transformers import AutoConfig, AutoTokenizer
 from Distiller.transformers import AutoModelForSequenceClassification, AutoModelForQuestionAnswering
 from Distiller.textbrewer import DistillationConfig,TrainingConfig,GeneralDistiller, EMDDistiller
+from Distiller.textbrewer.data_utils import TensorAugmenter
+from Distiller.textbrewer.pseudo_labels import PseudoLabelCache, IndexedDataset
+from Distiller.trial_cost import TrialCostTracker, TrialBudgetExceeded
+from Distiller.student_init import init_student_from_teacher
+from Distiller.packing import PackedSequenceClassifier
 import queue
 from torch.utils.data import DataLoader, RandomSampler
 from torch.utils.data.distributed import DistributedSampler
@@ -37,7 +42,7 @@ def set_seed(args):
 # class CustomDataLoader(DataLoader):
 
 
-def train(args, examples, train_dataset, t_model, s_model, tokenizer, augmenter=None, matches=None, predict_callback=None, q=None, processor=None):
+def train(args, examples, train_dataset, t_model, s_model, tokenizer, augmenter=None, matches=None, predict_callback=None, q=None, processor=None, cost_tracker=None):
     """ Train the model """
 
     args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
@@ -75,8 +80,15 @@ def train(args, examples, train_dataset, t_model, s_model, tokenizer, augmenter=
     #     train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.train_batch_size)
     # mix_dataloader = DataLoader(train_dataset, sampler=mix_sampler,
     #                             batch_size=args.train_batch_size) if args.mixup else None
+    pseudo_label_cache = None
+    if args.soft_label_weight > 0 and args.repeated_aug <= 1:
+        # teacher pseudo labels are computed once per example and augmentation round. The batches rebuilt by
+        # repeated_aug (text or tensor augmentation) carry no example ids, the cache would never be read
+        pseudo_label_cache = PseudoLabelCache.for_teacher(t_model, args.data_dir,
+                                                          f"{args.task_name}_{args.max_seq_length}")
+        train_dataset = IndexedDataset(train_dataset, aug_id=1 if args.aug_pipeline else 0)
     train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
-    if args.repeated_aug>1:
+    if args.repeated_aug>1 and not args.tensor_aug:
         def collate_fn(batch):
             return batch
         train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.train_batch_size, collate_fn=collate_fn, drop_last=True)
@@ -106,6 +118,13 @@ def train(args, examples, train_dataset, t_model, s_model, tokenizer, augmenter=
     #         raise ImportError("Please install apex from https://www.github.com/nvidia/apex to use fp16 training.")
     #     s_model, optimizer = amp.initialize(s_model, optimizer, opt_level=args.fp16_opt_level)
 
+    if args.pack_sequences:
+        # packed training rows (see Distiller.packing), the logits are unpacked to one row per example
+        assert args.task_type == "glue" and not args.mixup and args.repeated_aug <= 1 and not args.aug_pipeline \
+            and args.soft_label_weight == 0, "sequence packing only supports plain GLUE distillation"
+        t_model = PackedSequenceClassifier(t_model)
+        s_model = PackedSequenceClassifier(s_model)
+
     # multi-gpu training (should be after apex fp16 initialization)
     if args.n_gpu > 1 and args.local_rank == -1:
         t_model = torch.nn.DataParallel(t_model)
@@ -282,7 +301,8 @@ def train(args, examples, train_dataset, t_model, s_model, tokenizer, augmenter=
                 kd_loss_type=args.kd_loss_type,
                 critic=critic,
                 baseline_fn=baseline_fn,
-                alpha=args.alpha)
+                alpha=args.alpha,
+                pseudo_label_cache=pseudo_label_cache)
         else:
             # intermediate_matches = matches
             # if args.intermediate_strategy == "skip":
@@ -299,16 +319,20 @@ def train(args, examples, train_dataset, t_model, s_model, tokenizer, augmenter=
                 kd_loss_type=args.kd_loss_type,
                 critic=critic,
                 baseline_fn=baseline_fn,
-                alpha=args.alpha)
+                alpha=args.alpha,
+                pseudo_label_cache=pseudo_label_cache)
         train_config = TrainingConfig(gradient_accumulation_steps=args.gradient_accumulation_steps, device=args.device,
                                       log_dir=os.path.join(args.output_dir, "log"), output_dir=args.output_dir,
                                       fp16=args.fp16, mixup=args.mixup, local_rank=args.local_rank,
                                       task_type=args.task_type, task_name=args.task_name,q=q, augmenter=augmenter, processor=processor,
                                       repeated_aug=args.repeated_aug, tokenizer=tokenizer, num_reaug=args.num_reaug,
-                                      max_seq_length=args.max_seq_length)
+                                      max_seq_length=args.max_seq_length, ckpt_steps=args.max_steps if args.max_steps > 0 else None,
+                                      tensor_augmenter=TensorAugmenter.from_tokenizer(tokenizer, args.tensor_aug, p=args.tensor_aug_p) if args.tensor_aug and args.repeated_aug > 1 else None)
         if args.task_type in ["squad", "squad2"]:
             args.task_name = args.task_type
             from Distiller.adapters import BertForQAAdaptor as adaptor_func
+        elif args.task_type == "glue" and args.pack_sequences:
+            from Distiller.adapters import PackedGLUEAdaptor as adaptor_func
         elif args.task_type == "glue":
             from Distiller.adapters import BertForGLUEAdptor as adaptor_func
         adaptor_T = adaptor_func
@@ -322,9 +346,12 @@ def train(args, examples, train_dataset, t_model, s_model, tokenizer, augmenter=
                                      emd=matches)
         else:
             distiller = GeneralDistiller(train_config, distill_config, t_model, s_model, adaptor_T, adaptor_S, )
+        if cost_tracker is not None:
+            cost_tracker.start(total_steps=t_total)
         with distiller:
             distiller.train(optimizer, scheduler_class=scheduler_class, scheduler_args=scheduler_args, dataloader=train_dataloader,
-                            num_epochs=args.num_train_epochs, callback=predict_callback,max_grad_norm=args.max_grad_norm)
+                            num_epochs=args.num_train_epochs, num_steps=args.max_steps if args.max_steps > 0 else None,
+                            callback=predict_callback,max_grad_norm=args.max_grad_norm)
             # distiller.train(optimizer,train_dataloader,args.num_train_epochs,
             #                 scheduler_class=scheduler_class, scheduler_args=scheduler_args,
             #                 max_grad_norm=1.0, callback=predict_callback, mixup_value=args.mixup_value,
@@ -368,7 +395,12 @@ def main(args):
     t_model = model_class.from_pretrained(args.T_model_name_or_path, config=t_config)
     ## If the student borrow layers from teachers, it must borrow complete layers. Their hidden size and attention size
     # must be the same
-    if args.random_student:
+    if args.student_init_from_teacher:
+        # copy the embeddings, the mapped teacher layers and the head into the student (cached)
+        s_model = init_student_from_teacher(t_model, s_config, args.layer_mapping_strategy,
+                                            truncate=args.student_init_truncate,
+                                            cache_dir=args.student_init_cache_dir or args.data_dir)
+    elif args.random_student:
         s_model = model_class.from_config(s_config)
     else:
         s_model = model_class.from_pretrained(args.S_model_name_or_path, config=s_config)
@@ -407,9 +439,14 @@ def main(args):
     if args.local_rank in [-1,0]:
         logger.info("Training/evaluation parameters %s", args)
 
+    global trial_cost
+    trial_cost = TrialCostTracker(args.trial_time_budget, objective=args.sweep_objective)
+
     def predict_callback(model, step):
         if args.eval and args.local_rank in [-1, 0]:
+            trial_cost.start_eval()
             evaluation_result = evaluate_func(args, model, s_tokenizer if s_tokenizer else t_tokenizer, prefix=step)
+            trial_cost.end_eval(step)
             global best_evaluation
             if evaluation_result[glue_criterion(args.task_name)[0]] > best_evaluation:
                 best_evaluation = evaluation_result[glue_criterion(args.task_name)[0]]
@@ -428,10 +465,13 @@ def main(args):
             logger.info(f"Write evaluation result to {output_eval_file}...")
             with open(output_eval_file, "a") as writer:
                 writer.write(f"Output: {json.dumps(evaluation_result, indent=2)}\n")
+            logger.info(f"Trial cost: {trial_cost.summary(best_evaluation)}")
             # if "exact" in evaluation_result.keys():
             #     return evaluation_result['exact'], evaluation_result['f1']
             # else:
             #     return evaluation_result
+            # stop configurations that will not finish within their time budget
+            trial_cost.check(step)
             model.train()
             return evaluation_result
         else:
@@ -441,7 +481,7 @@ def main(args):
         # examples = read_examples_from_file(args.data_dir, mode="train", task_type=args.task_type)
         augmenter = None
         q = None
-        if args.repeated_aug > 1:
+        if args.repeated_aug > 1 and not args.tensor_aug:
             processor = Processor(args, t_tokenizer, task=args.task_name, max_length=args.max_seq_length,
                                   s_tokenizer=s_tokenizer if s_tokenizer else None)
             train_dataset, s_dataset, features, s_features, examples = processor.load_and_cache_examples(
@@ -449,7 +489,8 @@ def main(args):
                                                                                            return_examples=True)
         else:
             train_dataset, s_dataset, features, s_features, examples = load_and_cache_examples(args, t_tokenizer, mode="train",
-                                                                return_examples=True, s_tokenizer=s_tokenizer)
+                                                                return_examples=True, s_tokenizer=s_tokenizer,
+                                                                pack=args.pack_sequences)
         # if args.augmenter_config_path:
         #     augmenter = AutoAugmenter.from_config(args.augmenter_config_path, "cpu" if args.n_gpu == 0 else "gpu")
         #     # global q
@@ -486,7 +527,11 @@ def main(args):
             augmenter = AutoAugmenter.init_pipeline(w=[0,1], threads=min(args.thread, cpu_count()), aug_p=args.aug_p)
         else:
             pass
-        train(args, examples, train_dataset, t_model, s_model, t_tokenizer, augmenter, matches, predict_callback, q=q, processor=processor if args.repeated_aug > 1 else None)
+        try:
+            train(args, examples, train_dataset, t_model, s_model, t_tokenizer, augmenter, matches, predict_callback, q=q,
+                  processor=processor if args.repeated_aug > 1 and not args.tensor_aug else None, cost_tracker=trial_cost)
+        except TrialBudgetExceeded as e:
+            logger.warning(f"Trial terminated: {e}")
         if args.local_rank in [-1, 0] and args.aug_pipeline and args.repeated_aug <= 1:
             process.processes[0].terminate()
         # p = Process(target=data_aug_process, args=(augmenter,examples,tokenizer,args))
@@ -583,11 +628,29 @@ if __name__ == '__main__':
     args.device = device
 
     import pandas as pd
-    df = pd.read_csv('./audo_distiller_candidates.csv')
+    if args.predictor_top_k > 0:
+        # only train the configurations the outcome predictor ranks highest on this task
+        from Distiller.autodistiller import rank_candidates
+        known_tasks = pd.read_csv(os.path.join(args.autodistiller_data_dir, 'dataset_features_50_concat.csv'))['task']
+        dataset_features = None
+        if args.task_name not in set(known_tasks):
+            # the stored descriptors come from another pipeline: the new task and the training tasks are all
+            # described by the cached CPU extractor
+            from Distiller.dataset_features import DatasetFeatureExtractor, describe_training_tasks
+            extractor = DatasetFeatureExtractor(args.descriptor_encoder, cache_dir=args.descriptor_cache_dir)
+            descriptors = describe_training_tasks(extractor, list(known_tasks), args.descriptor_glue_dir)
+            descriptors.append(extractor.describe_task(args.task_type, args.task_name, args.data_dir))
+            dataset_features = pd.DataFrame(descriptors)
+        df = rank_candidates(args.autodistiller_data_dir, './audo_distiller_candidates.csv',
+                             top_k=args.predictor_top_k, task=args.task_name,
+                             dataset_features=dataset_features).reset_index(drop=True)
+    else:
+        df = pd.read_csv('./audo_distiller_candidates.csv')
     df["distill_result"] = 0
-    for i in range(df.shape[0]):
+
+    def apply_candidate(i):
+        global w
         print(df.loc[i,:])
-        best_evaluation = 0.0
         args.intermediate_loss_type = df.loc[i,'intermediate_loss_type']
         args.alpha = df.loc[i, 'alpha']
         args.intermediate_strategy = df.loc[i, 'intermediate_strategy']
@@ -608,8 +671,38 @@ if __name__ == '__main__':
             if random_aug != 0:
                 w[random_aug-1] = 2
 
-        main(args)
-        df.loc[i,'distill_result'] = best_evaluation
+    if args.successive_halving:
+        # train every candidate for a few steps and only promote the best ones to larger budgets
+        from Distiller.autodistiller import SuccessiveHalving
+        base_output_dir = args.output_dir
+        args.eval = True
+        search = SuccessiveHalving(list(range(df.shape[0])), args.sh_min_steps,
+                                   args.sh_max_steps if args.sh_max_steps > 0 else args.sh_min_steps * args.sh_eta ** 2,
+                                   eta=args.sh_eta, state_file=os.path.join(base_output_dir, "successive_halving.json"))
+
+        def trial(i, num_steps, rung):
+            global best_evaluation
+            best_evaluation = 0.0
+            apply_candidate(i)
+            args.max_steps = num_steps
+            args.output_dir = os.path.join(base_output_dir, f"rung_{rung}", f"candidate_{i}")
+            main(args)
+            args.device = device
+            for name, value in trial_cost.summary(best_evaluation).items():
+                df.loc[i, name] = value
+            return trial_cost.summary(best_evaluation)['objective']
+
+        for i, score in search.run(trial):
+            df.loc[i, 'distill_result'] = score
+        args.output_dir = base_output_dir
+    else:
+        for i in range(df.shape[0]):
+            best_evaluation = 0.0
+            apply_candidate(i)
+            main(args)
+            df.loc[i,'distill_result'] = best_evaluation
+            for name, value in trial_cost.summary(best_evaluation).items():
+                df.loc[i, name] = value
     df.to_csv("./auto_distiller_results.csv",index=False)
 
 
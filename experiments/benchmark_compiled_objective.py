@@ -0,0 +1,78 @@
+import time
+import argparse
+from types import SimpleNamespace
+import torch
+from Distiller.utils import cal_layer_mapping
+from Distiller.textbrewer import DistillationConfig, TrainingConfig, GeneralDistiller
+# CPU benchmark of the distillation objective: times the forward and backward of the KD and intermediate losses of
+# GeneralDistiller.compute_loss on random features, eagerly and with compile_objective, for the layer mapping
+# cal_layer_mapping builds from the given teacher and student sizes, e.g.
+#   python benchmark_compiled_objective.py --intermediate_strategy skip --intermediate_features hidden attention \
+#       --intermediate_loss_type mse --t_layers 12 --t_hidden 768 --s_layers 4 --s_hidden 312
+
+
+def random_results(num_layers, hidden_size, num_heads, batch_size, length, num_labels, requires_grad):
+    def tensor(*shape):
+        return torch.randn(*shape, requires_grad=requires_grad)
+    return {'logits': [tensor(batch_size, num_labels)],
+            'hidden': [tensor(batch_size, length, hidden_size) for _ in range(num_layers + 1)],
+            'attention': [torch.softmax(torch.randn(batch_size, num_heads, length, length), dim=-1)
+                          .requires_grad_(requires_grad) for _ in range(num_layers)],
+            'inputs_mask': torch.ones(batch_size, length, dtype=torch.long)}
+
+
+def time_steps(distiller, results_S, results_T, steps):
+    for _ in range(3):
+        distiller.compute_loss(results_S, results_T)[0].backward()
+    start = time.perf_counter()
+    for _ in range(steps):
+        distiller.compute_loss(results_S, results_T)[0].backward()
+    return (time.perf_counter() - start) / steps
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--intermediate_strategy", default="skip", choices=["skip", "last"])
+    parser.add_argument("--intermediate_features", nargs="+", default=["hidden"], choices=["hidden", "attention"])
+    parser.add_argument("--intermediate_loss_type", default="mse", choices=["ce", "mse"])
+    parser.add_argument("--kd_loss_type", default="ce", choices=["ce", "mse"])
+    parser.add_argument("--t_layers", default=12, type=int)
+    parser.add_argument("--t_hidden", default=768, type=int)
+    parser.add_argument("--s_layers", default=4, type=int)
+    parser.add_argument("--s_hidden", default=312, type=int)
+    parser.add_argument("--num_heads", default=12, type=int)
+    parser.add_argument("--batch_size", default=8, type=int)
+    parser.add_argument("--max_seq_length", default=128, type=int)
+    parser.add_argument("--steps", default=20, type=int)
+    parser.add_argument("--threads", default=0, type=int, help="torch threads, 0 for the default")
+    args = parser.parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    args.inter_loss_weight = 1.0
+    matches = cal_layer_mapping(args, SimpleNamespace(num_hidden_layers=args.t_layers, hidden_size=args.t_hidden),
+                                SimpleNamespace(num_hidden_layers=args.s_layers, hidden_size=args.s_hidden))
+    torch.manual_seed(0)
+    results_T = random_results(args.t_layers, args.t_hidden, args.num_heads, args.batch_size, args.max_seq_length, 2,
+                               requires_grad=False)
+    results_S = random_results(args.s_layers, args.s_hidden, args.num_heads, args.batch_size, args.max_seq_length, 2,
+                               requires_grad=True)
+    timings = {}
+    losses = {}
+    for compile_objective in [False, True]:
+        distill_config = DistillationConfig(intermediate_matches=matches, kd_loss_type=args.kd_loss_type,
+                                            compile_objective=compile_objective)
+        distiller = GeneralDistiller(TrainingConfig(device="cpu"), distill_config, None, None, None, None)
+        # both distillers start from the same projections, so that they compute the same loss
+        torch.manual_seed(1)
+        for proj in distiller.projs:
+            if proj is not None:
+                for p in proj.parameters():
+                    torch.nn.init.normal_(p, std=0.02)
+        name = "compiled" if compile_objective else "eager"
+        losses[name] = distiller.compute_loss(results_S, results_T)[0].item()
+        timings[name] = time_steps(distiller, results_S, results_T, args.steps)
+    print(f"{len(matches)} intermediate matches, batch {args.batch_size} x {args.max_seq_length}, "
+          f"{torch.get_num_threads()} threads")
+    for name in timings:
+        print(f"{name:>9}: {timings[name] * 1000:.2f} ms/step (forward + backward), loss {losses[name]:.6f}")
+    print(f"  speedup: {timings['eager'] / timings['compiled']:.2f}x")
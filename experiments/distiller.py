@@ -12,7 +12,13 @@ from Distiller.mp_aug import aug_process, generate_aug_data
 from Distiller.transformers import AutoConfig, AutoTokenizer
 from Distiller.transformers import AutoModelForSequenceClassification, AutoModelForQuestionAnswering
 from Distiller.textbrewer import DistillationConfig,TrainingConfig,GeneralDistiller, EMDDistiller
+from Distiller.textbrewer.blockwise import AttentionCapture, blockwise_adaptor, set_block_size
+from Distiller.textbrewer.replay import ReplayLog
+from Distiller.student_init import init_student_from_teacher
+from Distiller.packing import PackedSequenceClassifier
+from Distiller.resources import ResourceManager
 import queue
+import contextlib
 from torch.utils.data import DataLoader, RandomSampler
 from torch.utils.data.distributed import DistributedSampler
 from Distiller.transformers import AdamW, get_linear_schedule_with_warmup, WEIGHTS_NAME
@@ -45,7 +51,14 @@ def train(args, examples, train_dataset, t_model, s_model, tokenizer, augmenter=
     # mix_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
     # train_dataloader = CustomDataLoader(train_dataset, examples, args=args, sampler=train_sampler, batch_size=args.train_batch_size, collate_fn=collate_fn, tokenizer=tokenizer, augmenter=augmenter)
     # train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.train_batch_size, collate_fn=collate_fn)
-    if args.aug_pipeline and args.repeated_aug <= 1:
+    replay_log = None
+    if args.replay_log:
+        # records the batches of the run, or replays those of a recorded run (textbrewer/replay.py)
+        replay_log = ReplayLog(args.replay_log, replay=args.replay)
+    if replay_log is not None and replay_log.replaying:
+        if args.aug_pipeline and args.repeated_aug <= 1 and 0 in replay_log.datasets:
+            train_dataset = replay_log.dataset(0)
+    elif args.aug_pipeline and args.repeated_aug <= 1:
         if args.local_rank not in [-1, 0]:
             torch.distributed.barrier()
         # else:
@@ -58,6 +71,8 @@ def train(args, examples, train_dataset, t_model, s_model, tokenizer, augmenter=
                     count += 1
                     train_dataset = q.get(timeout=300)
                     torch.save(train_dataset, os.path.join(args.output_dir,'train_dataset.bin'))
+                    if replay_log is not None:
+                        replay_log.record_dataset(0, os.path.join(args.output_dir,'train_dataset.bin'))
                     break
                 except queue.Empty:
                     logger.info("Waiting for data augmentation process to return data")
@@ -106,6 +121,23 @@ def train(args, examples, train_dataset, t_model, s_model, tokenizer, augmenter=
     #         raise ImportError("Please install apex from https://www.github.com/nvidia/apex to use fp16 training.")
     #     s_model, optimizer = amp.initialize(s_model, optimizer, opt_level=args.fp16_opt_level)
 
+    if args.pack_sequences:
+        # packed training rows (see Distiller.packing), the logits are unpacked to one row per example
+        assert args.task_type == "glue" and not args.mixup and args.repeated_aug <= 1 and not args.aug_pipeline \
+            and args.soft_label_weight == 0, "sequence packing only supports plain GLUE distillation"
+        t_model = PackedSequenceClassifier(t_model)
+        s_model = PackedSequenceClassifier(s_model)
+
+    if args.blockwise_attention:
+        # the attention losses are computed blockwise from the captured queries and keys (textbrewer/blockwise.py)
+        assert not (args.n_gpu > 1 and args.local_rank == -1) and args.intermediate_strategy != "emd", \
+            "blockwise attention does not support DataParallel or the EMD strategy"
+        assert "attention" not in args.intermediate_features or args.intermediate_loss_type in ["ce", "mse"], \
+            "only the attention_ce and attention_mse losses are computed blockwise"
+        set_block_size(args.attention_block_size)
+        capture_T = AttentionCapture(t_model, args.attention_block_size)
+        capture_S = AttentionCapture(s_model, args.attention_block_size)
+
     # multi-gpu training (should be after apex fp16 initialization)
     if args.n_gpu > 1 and args.local_rank == -1:
         t_model = torch.nn.DataParallel(t_model)
@@ -305,20 +337,26 @@ def train(args, examples, train_dataset, t_model, s_model, tokenizer, augmenter=
                 kd_loss_type=args.kd_loss_type,
                 critic=critic,
                 baseline_fn=baseline_fn,
-                alpha=args.alpha)
+                alpha=args.alpha,
+                compile_objective=args.compile_objective)
         train_config = TrainingConfig(gradient_accumulation_steps=args.gradient_accumulation_steps, device=args.device,
                                       log_dir=os.path.join(args.output_dir, "log"), output_dir=args.output_dir,
                                       fp16=args.fp16, mixup=args.mixup, local_rank=args.local_rank,
                                       task_type=args.task_type, task_name=args.task_name,q=q, augmenter=augmenter, processor=processor,
                                       repeated_aug=args.repeated_aug, tokenizer=tokenizer, num_reaug=args.num_reaug,
-                                      max_seq_length=args.max_seq_length)
+                                      max_seq_length=args.max_seq_length, replay=replay_log)
         if args.task_type in ["squad", "squad2"]:
             args.task_name = args.task_type
             from Distiller.adapters import BertForQAAdaptor as adaptor_func
+        elif args.task_type == "glue" and args.pack_sequences:
+            from Distiller.adapters import PackedGLUEAdaptor as adaptor_func
         elif args.task_type == "glue":
             from Distiller.adapters import BertForGLUEAdptor as adaptor_func
         adaptor_T = adaptor_func
         adaptor_S = adaptor_func
+        if args.blockwise_attention:
+            adaptor_T = blockwise_adaptor(adaptor_func, capture_T)
+            adaptor_S = blockwise_adaptor(adaptor_func, capture_S)
         if args.intermediate_strategy == "emd":
             distiller = EMDDistiller(train_config=train_config,
                                      distill_config=distill_config,
@@ -360,6 +398,13 @@ def main(args):
                         level=logging.INFO if args.local_rank in [-1, 0] else logging.WARN)
     logger.warning("Process rank: %s, device: %s, n_gpu: %s, distributed training: %s, 16-bits training: %s",
                    args.local_rank, device, args.n_gpu, bool(args.local_rank != -1), args.fp16)
+    resources = None
+    if args.cpu_resources:
+        # the trainer and the augmentation process get disjoint cores (Distiller/resources.py)
+        assert args.local_rank == -1, "--cpu_resources supports single process training"
+        resources = ResourceManager.from_args(args)
+        resources.apply("trainer")
+    track = resources.track if resources else lambda component: contextlib.nullcontext()
 
     # Set seed
     set_seed(args)
@@ -368,9 +413,9 @@ def main(args):
     args.model_type = s_config.model_type
     s_config.num_labels = t_config.num_labels
     t_config.output_hidden_states = True
-    t_config.output_attentions = True
+    t_config.output_attentions = not args.blockwise_attention
     s_config.output_hidden_states = True
-    s_config.output_attentions = True
+    s_config.output_attentions = not args.blockwise_attention
     model_class = task_dict.get(args.task_type)
     ## load pretrained models and tokenizers
     t_tokenizer = AutoTokenizer.from_pretrained(args.T_model_name_or_path,
@@ -383,7 +428,12 @@ def main(args):
     t_model = model_class.from_pretrained(args.T_model_name_or_path, config=t_config)
     ## If the student borrow layers from teachers, it must borrow complete layers. Their hidden size and attention size
     # must be the same
-    if args.random_student:
+    if args.student_init_from_teacher:
+        # copy the embeddings, the mapped teacher layers and the head into the student (cached)
+        s_model = init_student_from_teacher(t_model, s_config, args.layer_mapping_strategy,
+                                            truncate=args.student_init_truncate,
+                                            cache_dir=args.student_init_cache_dir or args.data_dir)
+    elif args.random_student:
         s_model = model_class.from_config(s_config)
     else:
         s_model = model_class.from_pretrained(args.S_model_name_or_path, config=s_config)
@@ -456,15 +506,17 @@ def main(args):
         # examples = read_examples_from_file(args.data_dir, mode="train", task_type=args.task_type)
         augmenter = None
         q = None
-        if args.repeated_aug > 1:
-            processor = Processor(args, t_tokenizer, task=args.task_name, max_length=args.max_seq_length,
-                                  s_tokenizer=s_tokenizer if s_tokenizer else None)
-            train_dataset, s_dataset, features, s_features, examples = processor.load_and_cache_examples(
-                                                                                           mode="train",
-                                                                                           return_examples=True)
-        else:
-            train_dataset, s_dataset, features, s_features, examples = load_and_cache_examples(args, t_tokenizer, mode="train",
-                                                                return_examples=True, s_tokenizer=s_tokenizer)
+        with track("tokenizer"):
+            if args.repeated_aug > 1:
+                processor = Processor(args, t_tokenizer, task=args.task_name, max_length=args.max_seq_length,
+                                      s_tokenizer=s_tokenizer if s_tokenizer else None)
+                train_dataset, s_dataset, features, s_features, examples = processor.load_and_cache_examples(
+                                                                                               mode="train",
+                                                                                               return_examples=True)
+            else:
+                train_dataset, s_dataset, features, s_features, examples = load_and_cache_examples(args, t_tokenizer, mode="train",
+                                                                    return_examples=True, s_tokenizer=s_tokenizer,
+                                                                    pack=args.pack_sequences)
         # if args.augmenter_config_path:
         #     augmenter = AutoAugmenter.from_config(args.augmenter_config_path, "cpu" if args.n_gpu == 0 else "gpu")
         #     # global q
@@ -480,12 +532,14 @@ def main(args):
         #     process.start()
         #     # process.join()
         matches = cal_layer_mapping(args, t_config, s_config)
-        if args.aug_pipeline and args.repeated_aug <= 1:
+        if args.aug_pipeline and args.repeated_aug <= 1 and not args.replay:
             q = Queue()
             if args.local_rank not in [-1, 0]:
                 torch.distributed.barrier()
             else:
-                augmenter = AutoAugmenter.init_pipeline(w=[int(i) for i in args.w], threads=min(args.thread, cpu_count()), aug_p=args.aug_p)
+                augmenter = AutoAugmenter.init_pipeline(w=[int(i) for i in args.w],
+                                                        threads=resources.threads("augmentation") if resources else min(args.thread, cpu_count()),
+                                                        aug_p=args.aug_p)
                 if len(augmenter) and args.repeated_aug <= 1:
                     # args.augs = augmenter.aug_names
                     # generate_aug_data(examples, train_dataset, augmenter, args, t_tokenizer, s_tokenizer,32)
@@ -498,11 +552,14 @@ def main(args):
                 if args.local_rank == 0:
                     torch.distributed.barrier()
         elif args.aug_pipeline and args.repeated_aug > 1:
-            augmenter = AutoAugmenter.init_pipeline(w=[int(i) for i in args.w], threads=min(args.thread, cpu_count()), aug_p=args.aug_p)
+            augmenter = AutoAugmenter.init_pipeline(w=[int(i) for i in args.w],
+                                                    threads=resources.threads("trainer") if resources else min(args.thread, cpu_count()),
+                                                    aug_p=args.aug_p)
         else:
             pass
-        train(args, examples, train_dataset, t_model, s_model, t_tokenizer, augmenter, matches, predict_callback, q=q, processor=processor if args.repeated_aug > 1 else None)
-        if args.local_rank in [-1, 0] and args.aug_pipeline and args.repeated_aug <= 1:
+        with track("trainer"):
+            train(args, examples, train_dataset, t_model, s_model, t_tokenizer, augmenter, matches, predict_callback, q=q, processor=processor if args.repeated_aug > 1 else None)
+        if args.local_rank in [-1, 0] and args.aug_pipeline and args.repeated_aug <= 1 and not args.replay:
             process.processes[0].terminate()
         # p = Process(target=data_aug_process, args=(augmenter,examples,tokenizer,args))
         # p.start()
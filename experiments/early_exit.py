@@ -0,0 +1,78 @@
+import os
+import json
+import torch
+import random
+import logging
+import numpy as np
+from torch.utils.data import DataLoader, RandomSampler
+from Distiller.configs import parse
+from Distiller.utils import Logger
+from Distiller.modeling import SequenceClassificationModel
+from Distiller.early_exit import train_exit_classifiers, evaluate_exit_thresholds
+from Distiller.evaluate import evaluate_glue
+from Distiller.glue_preprocess import load_and_cache_examples
+from Distiller.transformers import AutoConfig, AutoTokenizer, AutoModelForSequenceClassification
+# Early exit inference for a distilled GLUE student: the exit classifiers of every student layer are distilled from
+# the teacher logits, then the student is evaluated at several exit thresholds (accuracy and average layers run).
+
+
+def set_seed(args):
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    if args.n_gpu > 0:
+        torch.cuda.manual_seed_all(args.seed)
+
+
+def main(args):
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+                        datefmt="%m/%d/%Y %H:%M:%S", level=logging.INFO)
+    set_seed(args)
+    t_config = AutoConfig.from_pretrained(args.T_config_file if args.T_config_file else args.T_model_name_or_path)
+    s_config = AutoConfig.from_pretrained(args.S_model_name_or_path)
+    s_config.num_labels = t_config.num_labels
+    t_tokenizer = AutoTokenizer.from_pretrained(args.T_model_name_or_path, use_fast=False, config=t_config)
+    s_tokenizer = AutoTokenizer.from_pretrained(args.S_model_name_or_path, use_fast=False,
+                                                config=s_config) if args.S_model_name_or_path != args.T_model_name_or_path else None
+    t_model = AutoModelForSequenceClassification.from_pretrained(args.T_model_name_or_path, config=t_config)
+    # the distilled student, e.g. the best_model directory written by distiller.py
+    s_model = AutoModelForSequenceClassification.from_pretrained(args.S_model_name_or_path, config=s_config)
+    model = SequenceClassificationModel.from_classifier(s_model, early_exit=True)
+    t_model.to(args.device)
+    model.to(args.device)
+
+    exit_file = os.path.join(args.output_dir, "exit_classifiers.bin")
+    if os.path.exists(exit_file):
+        model.exit_classifiers.load_state_dict(torch.load(exit_file, map_location=args.device))
+        logger.info(f"Loaded the exit classifiers from {exit_file}")
+    else:
+        train_dataset, s_dataset, features, s_features, examples = load_and_cache_examples(
+            args, t_tokenizer, mode="train", return_examples=True, s_tokenizer=s_tokenizer)
+        args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
+        train_dataloader = DataLoader(train_dataset, sampler=RandomSampler(train_dataset),
+                                      batch_size=args.train_batch_size, drop_last=True)
+        train_exit_classifiers(model, t_model, train_dataloader, args.device, num_steps=args.early_exit_steps,
+                               learning_rate=args.learning_rate, warmup_proportion=args.warmup_proportion,
+                               kd_loss_type=args.kd_loss_type, temperature=args.temperature,
+                               hard_label_weight=args.hard_label_weight)
+        torch.save(model.exit_classifiers.state_dict(), exit_file)
+
+    results = evaluate_exit_thresholds(
+        lambda m: evaluate_glue(args, m, s_tokenizer if s_tokenizer else t_tokenizer, prefix="early_exit"),
+        model, args.early_exit_thresholds, criterion=args.early_exit_criterion)
+    with open(os.path.join(args.output_dir, "early_exit_results.json"), "w") as writer:
+        json.dump(results, writer, indent=2)
+
+
+if __name__ == '__main__':
+    args = parse()
+    assert args.task_type == "glue", "early exit is only implemented for sequence classification"
+    assert not args.pack_sequences, "early_exit.py does not train on packed sequences"
+    if args.S_model_name_or_path is None:
+        args.S_model_name_or_path = args.T_model_name_or_path
+    logger = Logger(f"{args.output_dir}/all.log", level="debug").logger
+    args.device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+    args.n_gpu = 0 if args.no_cuda else torch.cuda.device_count()
+    main(args)
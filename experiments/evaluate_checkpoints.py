@@ -0,0 +1,20 @@
+import os
+from Distiller.configs import parse
+from Distiller.utils import Logger
+from Distiller.batch_evaluate import evaluate_checkpoints
+# Scores every checkpoint of a finished sweep (auto_distiller_exp.py, ray_directory/run.py) on the dev set with a pool
+# of CPU workers, and writes one results table with the columns of auto_distiller_tabular_data.csv, e.g.
+#   python evaluate_checkpoints.py --task_type glue --task_name rte --data_dir ../datasets/glue/RTE \
+#       --T_model_name_or_path google/bert_uncased_L-12_H-768_A-12 --output_dir ./eval \
+#       --eval_checkpoints_dir ./sweep_outputs --eval_workers 8 --eval_memory_budget 32 --max_seq_length 128
+
+
+if __name__ == '__main__':
+    args = parse()
+    assert args.eval_checkpoints_dir, "--eval_checkpoints_dir is required"
+    os.makedirs(args.output_dir, exist_ok=True)
+    logger = Logger(f"{args.output_dir}/all.log", level="debug").logger
+    args.local_rank = -1
+    results = evaluate_checkpoints(args, args.eval_checkpoints_dir, num_workers=args.eval_workers,
+                                   memory_budget=args.eval_memory_budget)
+    logger.info(f"\n{results.to_string()}")
@@ -0,0 +1,132 @@
+import os
+import json
+import torch
+import random
+import logging
+import numpy as np
+from torch.utils.data import DataLoader, RandomSampler
+from Distiller.configs import parse
+from Distiller.utils import Logger, cal_layer_mapping
+from Distiller.pruning import prune_and_distill
+from Distiller.transformers import AutoConfig, AutoTokenizer
+from Distiller.transformers import AutoModelForSequenceClassification, AutoModelForQuestionAnswering
+from Distiller.transformers import AdamW, get_linear_schedule_with_warmup
+from Distiller.textbrewer import DistillationConfig, TrainingConfig, GeneralDistiller
+# Structured pruning of the student combined with distillation: every stage removes the least important attention
+# heads and FFN neurons of the student, then continues the distillation from the teacher with GeneralDistiller.
+task_dict = {'squad2': AutoModelForQuestionAnswering,
+             'squad': AutoModelForQuestionAnswering,
+             'glue': AutoModelForSequenceClassification,
+             'superglue': AutoModelForSequenceClassification}
+# attention losses which reduce over the heads before comparing the maps, so they do not depend on the head count
+HEAD_AGNOSTIC_ATTENTION_LOSSES = ("attention_mse_sum", "attention_ce_mean")
+
+
+def set_seed(args):
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    if args.n_gpu > 0:
+        torch.cuda.manual_seed_all(args.seed)
+
+
+def main(args):
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+                        datefmt="%m/%d/%Y %H:%M:%S", level=logging.INFO)
+    set_seed(args)
+    t_config = AutoConfig.from_pretrained(args.T_config_file if args.T_config_file else args.T_model_name_or_path)
+    s_config = AutoConfig.from_pretrained(args.S_config_file if args.S_config_file else args.S_model_name_or_path)
+    s_config.num_labels = t_config.num_labels
+    for config in [t_config, s_config]:
+        config.output_hidden_states = True
+        config.output_attentions = True
+    model_class = task_dict.get(args.task_type)
+    t_tokenizer = AutoTokenizer.from_pretrained(args.T_model_name_or_path, use_fast=False, config=t_config)
+    s_tokenizer = AutoTokenizer.from_pretrained(args.S_model_name_or_path, use_fast=False,
+                                                config=s_config) if args.S_model_name_or_path != args.T_model_name_or_path else None
+    t_model = model_class.from_pretrained(args.T_model_name_or_path, config=t_config).to(args.device)
+    if args.random_student:
+        s_model = model_class.from_config(s_config)
+    else:
+        s_model = model_class.from_pretrained(args.S_model_name_or_path, config=s_config)
+    s_model.to(args.device)
+
+    train_dataset, s_dataset, features, s_features, examples = load_and_cache_examples(
+        args, t_tokenizer, mode="train", return_examples=True, s_tokenizer=s_tokenizer)
+    args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
+    train_dataloader = DataLoader(train_dataset, sampler=RandomSampler(train_dataset),
+                                  batch_size=args.train_batch_size, drop_last=True)
+    assert not (args.intermediate_strategy and args.intermediate_strategy.lower() == "emd"), \
+        "prune_distill.py distills with GeneralDistiller, the emd strategy is not supported"
+    matches = cal_layer_mapping(args, t_config, s_config)
+    stages = list(zip(args.prune_heads, args.prune_ffn))
+    assert len(args.prune_heads) == len(args.prune_ffn), "prune_heads and prune_ffn need one fraction per stage"
+
+    def distill_fn(model, stage):
+        stage_matches = matches
+        if any(args.prune_heads[:stage]):
+            # attention maps of pruned layers have fewer heads than the teacher ones, only the attention matches
+            # whose loss reduces over the heads first are kept
+            stage_matches = [match for match in matches
+                             if match['feature'] != 'attention' or match['loss'] in HEAD_AGNOSTIC_ATTENTION_LOSSES]
+            if len(stage_matches) < len(matches):
+                logger.info(f"Stage {stage}: {len(matches) - len(stage_matches)} per head attention matches dropped")
+        no_decay = ["bias", "LayerNorm.weight"]
+        optimizer_grouped_parameters = [
+            {"params": [p for n, p in model.named_parameters() if not any(nd in n for nd in no_decay)],
+             "weight_decay": args.weight_decay},
+            {"params": [p for n, p in model.named_parameters() if any(nd in n for nd in no_decay)], "weight_decay": 0.0}
+        ]
+        optimizer = AdamW(optimizer_grouped_parameters, lr=args.learning_rate, eps=args.adam_epsilon)
+        scheduler_args = {'num_warmup_steps': int(args.prune_steps * args.warmup_proportion),
+                          'num_training_steps': args.prune_steps}
+        distill_config = DistillationConfig(temperature=args.temperature, intermediate_matches=stage_matches,
+                                            hard_label_weight=args.hard_label_weight,
+                                            soft_label_weight=args.soft_label_weight,
+                                            kd_loss_weight=args.kd_loss_weight, kd_loss_type=args.kd_loss_type)
+        train_config = TrainingConfig(gradient_accumulation_steps=args.gradient_accumulation_steps, device=args.device,
+                                      log_dir=os.path.join(args.output_dir, "log"),
+                                      output_dir=os.path.join(args.output_dir, f"stage_{stage}"),
+                                      fp16=args.fp16, task_type=args.task_type, task_name=args.task_name,
+                                      max_seq_length=args.max_seq_length, ckpt_steps=args.prune_steps)
+        distiller = GeneralDistiller(train_config, distill_config, t_model, model, adaptor_func, adaptor_func)
+        with distiller:
+            distiller.train(optimizer, scheduler_class=get_linear_schedule_with_warmup, scheduler_args=scheduler_args,
+                            dataloader=train_dataloader, num_steps=args.prune_steps, max_grad_norm=args.max_grad_norm)
+
+    def evaluate_fn(model, stage):
+        if not args.eval:
+            return {}
+        evaluation_result = evaluate_func(args, model, s_tokenizer if s_tokenizer else t_tokenizer,
+                                          prefix=f"stage_{stage}")
+        model.save_pretrained(os.path.join(args.output_dir, f"stage_{stage}"))
+        return evaluation_result
+
+    reports = prune_and_distill(s_model, train_dataloader, args.device, stages, distill_fn, model_T=t_model,
+                                temperature=args.temperature, importance_batches=args.prune_importance_batches,
+                                evaluate_fn=evaluate_fn)
+    with open(os.path.join(args.output_dir, "pruning_results.json"), "w") as writer:
+        json.dump(reports, writer, indent=2)
+    logger.info(json.dumps(reports, indent=2))
+
+
+if __name__ == '__main__':
+    args = parse()
+    assert not args.pack_sequences, "prune_distill.py does not train on packed sequences"
+    if args.S_model_name_or_path is None:
+        args.S_model_name_or_path = args.T_model_name_or_path
+    if args.task_type in ["squad", "squad2"]:
+        args.task_name = args.task_type
+        from Distiller.evaluate import evaluate_squad as evaluate_func
+        from Distiller.squad_preprocess import load_and_cache_examples
+        from Distiller.adapters import BertForQAAdaptor as adaptor_func
+    elif args.task_type == "glue":
+        from Distiller.evaluate import evaluate_glue as evaluate_func
+        from Distiller.glue_preprocess import load_and_cache_examples
+        from Distiller.adapters import BertForGLUEAdptor as adaptor_func
+    logger = Logger(f"{args.output_dir}/all.log", level="debug").logger
+    args.device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+    args.n_gpu = 0 if args.no_cuda else torch.cuda.device_count()
+    main(args)
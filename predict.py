@@ -2,10 +2,10 @@ from Distiller.glue_preprocess import load_and_cache_examples, Processor
 from Distiller.glue_preprocess import MrpcProcessor, ColaProcessor, MnliProcessor, MnliMismatchedProcessor, Sst2Processor
 from Distiller.glue_preprocess import StsbProcessor, QqpProcessor, QnliProcessor, RteProcessor, WnliProcessor
 from Distiller.glue_preprocess import convert_examples_to_features, convert_features_to_dataset
+from Distiller.artifact_writer import get_artifact_writer, flush_artifacts
 import os
 import torch
 import argparse
-import pandas as pd
 from Distiller.transformers import AutoConfig, AutoTokenizer
 from Distiller.transformers import AutoModelForSequenceClassification, AutoModelForQuestionAnswering
 from torch.utils.data import SequentialSampler, DataLoader
@@ -75,7 +75,8 @@ def main(args):
             predictions = predictions[:, 0]
             preds.extend(predictions.tolist())
         label_list.extend(batch['labels'].cpu().tolist())
-    pd.DataFrame({'index':list(range(len(preds))), 'prediction':preds}).to_csv(args.output_path+'.tsv', sep="\t", index=False)
+    # written in the background while the mismatched set is predicted
+    get_artifact_writer().write_tsv(args.output_path+'.tsv', {'index': list(range(len(preds))), 'prediction': preds})
     if args.task_name == "mnli":
         args.task_name = "mnli-mm"
         processor = glue_processors[args.task_name]()
@@ -108,7 +109,7 @@ def main(args):
                 predictions = predictions[:, 0]
                 preds.extend(predictions.tolist())
             label_list.extend(batch['labels'].cpu().tolist())
-        pd.DataFrame({'index':list(range(len(preds))), 'prediction': preds}).to_csv(args.output_path+"m.tsv", sep="\t", index=False)
+        get_artifact_writer().write_tsv(args.output_path+"m.tsv", {'index': list(range(len(preds))), 'prediction': preds})
 
 glue_output_modes = {
     "cola": "classification",
@@ -147,3 +148,4 @@ if __name__ == "__main__":
         file_name = args.task_name.upper()
     args.output_path = args.output_path + '/' + file_name
     main(args)
+    flush_artifacts()
@@ -3,6 +3,7 @@ import os
 import argparse
 import ast
 import gzip
+import shutil
 from gluonnlp.utils.misc import download, load_checksum_stats
 from gluonnlp.base import get_data_home_dir, get_repo_url
 
@@ -37,6 +38,20 @@ def get_parser():
     parser.add_argument('--cache-path', type=str, default=_BASE_DATASET_PATH,
                         help='The path to download the dataset.')
     parser.add_argument('--overwrite', action='store_true')
+    parser.add_argument('--extract', type=ast.literal_eval, default=True,
+                        help='Write the decompressed jsonl files next to the gzip shards.')
+    parser.add_argument('--featurize', action='store_true',
+                        help='Stream the shards into squad style features stored under <save-path>/features.')
+    parser.add_argument('--tokenizer', type=str, default='bert-base-uncased',
+                        help='Name or path of the tokenizer used to featurize the examples.')
+    parser.add_argument('--max-seq-length', type=int, default=384)
+    parser.add_argument('--doc-stride', type=int, default=128)
+    parser.add_argument('--max-query-length', type=int, default=64)
+    parser.add_argument('--chunk-size', type=int, default=2000,
+                        help='Number of examples converted and written to the feature store at once.')
+    parser.add_argument('--keep-null-prob', type=float, default=1.0,
+                        help='Fraction of the training questions without long answer to keep.')
+    parser.add_argument('--thread', type=int, default=1)
     return parser
 
 
@@ -44,17 +59,22 @@ def main(args):
     def extract(gz_path):
         try:
             f_name = gz_path.replace(".gz", "")
-            g_file = gzip.GzipFile(gz_path)
-            open(f_name, "wb+").write(g_file.read())
-            g_file.close()
+            with gzip.GzipFile(gz_path) as g_file, open(f_name, "wb+") as f:
+                shutil.copyfileobj(g_file, f, length=16 * 1024 * 1024)
         except Exception  as e:
             print(e)
+
+    tokenizer = None
+    if args.featurize:
+        from Distiller.transformers import AutoTokenizer
+        from Distiller.nq_preprocess import stream_nq_features
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer, use_fast=False)
     if not os.path.exists(args.save_path):
         os.makedirs(args.save_path)
     if args.all:
         pass
     else:
-        for url in _URLS.values():
+        for mode, url in _URLS.items():
             file_name = url[url.rfind('/') + 1:]
             file_hash = _URL_FILE_STATS[url]
             download(url, path=os.path.join(args.cache_path, file_name), sha1_hash=file_hash)
@@ -62,7 +82,17 @@ def main(args):
                     or (args.overwrite and args.save_path != args.cache_path):
                 os.symlink(os.path.join(args.cache_path, file_name),
                            os.path.join(args.save_path, file_name))
-            extract(os.path.join(args.save_path, file_name))
+            if args.extract:
+                extract(os.path.join(args.save_path, file_name))
+            if args.featurize:
+                stream_nq_features(os.path.join(args.save_path, file_name),
+                                   os.path.join(args.save_path, 'features',
+                                                f"{mode}_{os.path.basename(args.tokenizer)}_{args.max_seq_length}"),
+                                   tokenizer, mode, max_seq_length=args.max_seq_length,
+                                   doc_stride=args.doc_stride, max_query_length=args.max_query_length,
+                                   chunk_size=args.chunk_size, threads=args.thread,
+                                   keep_null_prob=args.keep_null_prob if mode == 'train' else 1.0,
+                                   overwrite=args.overwrite)
 
 
 def cli_main():
@@ -3,12 +3,15 @@ import json
 import glob
 import torch
 import logging
+import copy
 import random
+import warnings
+import itertools
 import ray
 from ray import tune
 import numpy as np
 from ray.tune import CLIReporter
-from ray.tune.schedulers import ASHAScheduler
+from ray.tune.schedulers import ASHAScheduler, PopulationBasedTraining
 
 from Distiller.configs import parse
 from Distiller.autoaug import AutoAugmenter
@@ -17,6 +20,10 @@ from Distiller.mp_aug import aug_process
 from Distiller.transformers import AutoConfig, AutoTokenizer
 from Distiller.transformers import AutoModelForSequenceClassification, AutoModelForQuestionAnswering
 from Distiller.textbrewer import DistillationConfig,TrainingConfig,GeneralDistiller, EMDDistiller
+from Distiller.textbrewer.data_utils import TensorAugmenter
+from Distiller.textbrewer.pseudo_labels import PseudoLabelCache, IndexedDataset
+from Distiller.trial_cost import TrialCostTracker
+from Distiller.student_init import init_student_from_teacher
 import queue
 from torch.utils.data import DataLoader, RandomSampler
 from torch.utils.data.distributed import DistributedSampler
@@ -42,10 +49,43 @@ def set_seed(args):
         torch.cuda.manual_seed_all(args.seed)
 
 
+def state_dict_to_arrays(model):
+    """Numpy copy of the state dict of `model`, numpy arrays are read from the ray object store without a copy."""
+    return {name: tensor.detach().cpu().numpy() for name, tensor in model.state_dict().items()}
+
+
+def arrays_to_state_dict(arrays):
+    with warnings.catch_warnings():
+        # arrays fetched from the object store are read-only, the weights are copied into the models anyway
+        warnings.simplefilter("ignore")
+        return {name: torch.from_numpy(array) for name, array in arrays.items()}
+
+
+def dataset_to_arrays(dataset):
+    """Splits a MyDataset (glue or squad) into its class and its tensors as numpy arrays."""
+    return type(dataset), {name: value.numpy() if torch.is_tensor(value) else value
+                           for name, value in vars(dataset).items()}
+
+
+def dataset_from_arrays(dataset_class, arrays):
+    """Rebuilds a dataset whose tensors share the memory of the arrays of :func:`dataset_to_arrays`."""
+    dataset = dataset_class.__new__(dataset_class)
+    with warnings.catch_warnings():
+        # the training data is never written to, so sharing read-only memory is fine
+        warnings.simplefilter("ignore")
+        dataset.__dict__.update({name: torch.from_numpy(value) if isinstance(value, np.ndarray) else value
+                                 for name, value in arrays.items()})
+    return dataset
+
+
+def shared_assets_key(args):
+    return f"{args.task_name}|{args.T_model_name_or_path}|{args.S_model_name_or_path}|{args.max_seq_length}"
+
+
 # class CustomDataLoader(DataLoader):
 
 
-def train(args, examples, train_dataset, t_model, s_model, tokenizer, augmenter=None, matches=None, predict_callback=None, q=None, processor=None):
+def train(args, examples, train_dataset, t_model, s_model, tokenizer, augmenter=None, matches=None, predict_callback=None, q=None, processor=None, initial_state=None, cost_tracker=None):
     """ Train the model """
 
     args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
@@ -83,8 +123,15 @@ def train(args, examples, train_dataset, t_model, s_model, tokenizer, augmenter=
     #     train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.train_batch_size)
     # mix_dataloader = DataLoader(train_dataset, sampler=mix_sampler,
     #                             batch_size=args.train_batch_size) if args.mixup else None
+    pseudo_label_cache = None
+    if args.soft_label_weight > 0 and args.repeated_aug <= 1:
+        # teacher pseudo labels are computed once per example and augmentation round. The batches rebuilt by
+        # repeated_aug (text or tensor augmentation) carry no example ids, the cache would never be read
+        pseudo_label_cache = PseudoLabelCache.for_teacher(t_model, args.data_dir,
+                                                          f"{args.task_name}_{args.max_seq_length}")
+        train_dataset = IndexedDataset(train_dataset, aug_id=1 if args.aug_pipeline else 0)
     train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
-    if args.repeated_aug>1:
+    if args.repeated_aug>1 and not args.tensor_aug:
         def collate_fn(batch):
             return batch
         train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.train_batch_size, collate_fn=collate_fn)
@@ -271,7 +318,8 @@ def train(args, examples, train_dataset, t_model, s_model, tokenizer, augmenter=
                 kd_loss_type=args.kd_loss_type,
                 critic=critic,
                 baseline_fn=baseline_fn,
-                alpha=args.alpha)
+                alpha=args.alpha,
+                pseudo_label_cache=pseudo_label_cache)
         else:
             # intermediate_matches = matches
             # if args.intermediate_strategy == "skip":
@@ -288,13 +336,15 @@ def train(args, examples, train_dataset, t_model, s_model, tokenizer, augmenter=
                 kd_loss_type=args.kd_loss_type,
                 critic=critic,
                 baseline_fn=baseline_fn,
-                alpha=args.alpha)
+                alpha=args.alpha,
+                pseudo_label_cache=pseudo_label_cache)
         train_config = TrainingConfig(gradient_accumulation_steps=args.gradient_accumulation_steps, device=args.device,
                                       log_dir=os.path.join(args.output_dir, "log"), output_dir=args.output_dir,
                                       fp16=args.fp16, mixup=args.mixup, local_rank=args.local_rank,
                                       task_type=args.task_type, q=q, augmenter=augmenter, processor=processor,
                                       repeated_aug=args.repeated_aug, tokenizer=tokenizer, num_reaug=args.num_reaug,
-                                      max_seq_length=args.max_seq_length)
+                                      max_seq_length=args.max_seq_length, ckpt_steps=args.pbt_interval if args.pbt else None,
+                                      tensor_augmenter=TensorAugmenter.from_tokenizer(tokenizer, args.tensor_aug, p=args.tensor_aug_p) if args.tensor_aug and args.repeated_aug > 1 else None)
         if args.task_type in ["squad", "squad2"]:
             args.task_name = args.task_type
             from Distiller.adapters import BertForQAAdaptor as adaptor_func
@@ -311,9 +361,27 @@ def train(args, examples, train_dataset, t_model, s_model, tokenizer, augmenter=
                                      emd=matches)
         else:
             distiller = GeneralDistiller(train_config, distill_config, t_model, s_model, adaptor_T, adaptor_S, )
+        callback = predict_callback
+        if args.pbt:
+            def callback(model, step):
+                # the checkpoint is written before the result is reported, so that PBT can exploit it
+                with tune.checkpoint_dir(step=step) as checkpoint_dir:
+                    torch.save(dict(distiller.training_state(), learning_rate=args.learning_rate),
+                               os.path.join(checkpoint_dir, "training_state.bin"))
+                return predict_callback(model, step)
+        if cost_tracker is not None:
+            # a restored PBT trial continues from the step of its checkpoint
+            cost_tracker.start(total_steps=t_total,
+                               initial_step=initial_state['global_step'] if initial_state is not None else 0)
         with distiller:
-            distiller.train(optimizer, scheduler_class=scheduler_class, scheduler_args=scheduler_args, dataloader=train_dataloader,
-                            num_epochs=args.num_train_epochs, callback=predict_callback,max_grad_norm=args.max_grad_norm)
+            if args.pbt:
+                lr_scale = args.learning_rate / initial_state['learning_rate'] if initial_state is not None else 1.0
+                distiller.train(optimizer, scheduler_class=scheduler_class, scheduler_args=scheduler_args,
+                                dataloader=train_dataloader, num_steps=args.max_steps, callback=callback,
+                                max_grad_norm=args.max_grad_norm, initial_state=initial_state, lr_scale=lr_scale)
+            else:
+                distiller.train(optimizer, scheduler_class=scheduler_class, scheduler_args=scheduler_args, dataloader=train_dataloader,
+                                num_epochs=args.num_train_epochs, callback=callback,max_grad_norm=args.max_grad_norm)
             # distiller.train(optimizer,train_dataloader,args.num_train_epochs,
             #                 scheduler_class=scheduler_class, scheduler_args=scheduler_args,
             #                 max_grad_norm=1.0, callback=predict_callback, mixup_value=args.mixup_value,
@@ -322,17 +390,86 @@ def train(args, examples, train_dataset, t_model, s_model, tokenizer, augmenter=
 
 
 
-def remote_fn(config, checkpoint_dir=None):
-    if not os.path.exists(args.output_dir) and args.local_rank in [-1, 0]:
-        os.makedirs(args.output_dir)
-    set_start_method('spawn')
-    if args.ddp:
-        args.local_rank = torch.distributed.get_rank()
-    if is_distributed_trainable():
-        print("Can distributed")
+def load_models(args, model_class):
+    t_config = AutoConfig.from_pretrained(args.T_config_file if args.T_config_file else args.T_model_name_or_path)
+    s_config = AutoConfig.from_pretrained(args.S_config_file if args.S_config_file else args.S_model_name_or_path)
+    args.model_type = s_config.model_type
+    s_config.num_labels = t_config.num_labels
+    t_config.output_hidden_states = True
+    t_config.output_attentions = True
+    s_config.output_hidden_states = True
+    s_config.output_attentions = True
+    ## load pretrained models and tokenizers
+    t_tokenizer = AutoTokenizer.from_pretrained(args.T_model_name_or_path,
+                                                use_fast=False,
+                                                config=t_config,
+                                                )
+    s_tokenizer = AutoTokenizer.from_pretrained(args.S_model_name_or_path,
+                                                use_fast=False,
+                                                config=s_config) if args.S_model_name_or_path != args.T_model_name_or_path else None
+    t_model = model_class.from_pretrained(args.T_model_name_or_path, config=t_config)
+    ## If the student borrow layers from teachers, it must borrow complete layers. Their hidden size and attention size
+    # must be the same
+    if args.student_init_from_teacher:
+        # copy the embeddings, the mapped teacher layers and the head into the student (cached)
+        s_model = init_student_from_teacher(t_model, s_config, args.layer_mapping_strategy,
+                                            truncate=args.student_init_truncate,
+                                            cache_dir=args.student_init_cache_dir or args.data_dir)
+    elif args.random_student:
+        s_model = model_class.from_config(s_config)
     else:
-        print("Can't distributed")
-    # Set ray tune hyper parameters
+        s_model = model_class.from_pretrained(args.S_model_name_or_path, config=s_config)
+    return t_config, s_config, t_tokenizer, s_tokenizer, t_model, s_model
+
+
+def prepare_shared_assets(args, search_space):
+    """
+    Loads the configs, tokenizers and weights and featurizes the training set once for every (task, teacher,
+    student) of the grid of `search_space`, and puts them in the ray object store. Weights and features are stored
+    as numpy arrays, which trials on the same node read from shared memory without copying them.
+
+    Returns:
+        dict: key of :func:`shared_assets_key` -> ObjectRef
+    """
+    grid = {k: v['grid_search'] for k, v in search_space.items() if isinstance(v, dict) and 'grid_search' in v}
+    constants = {k: v for k, v in search_space.items() if isinstance(v, (str, int, float, bool, list))}
+    names = [k for k in ["task_name", "teacher_name", "s_model"] if k in grid]
+    model_class = task_dict.get(args.task_type)
+    if "repeated_aug" in grid:
+        repeated_aug_values = grid["repeated_aug"]
+    elif "repeated_aug" in search_space and "repeated_aug" not in constants:
+        # sampled by the search algorithm, both kinds of trials may run
+        repeated_aug_values = [1, 2]
+    else:
+        repeated_aug_values = [search_space.get("repeated_aug", args.repeated_aug)]
+    shared_assets = {}
+    for values in itertools.product(*[grid[k] for k in names]):
+        trial_args = copy.deepcopy(args)
+        config = dict(constants, **dict(zip(names, values)))
+        if "task_name" in config and "teacher_name" not in config:
+            continue
+        apply_config(trial_args, config)
+        key = shared_assets_key(trial_args)
+        if key in shared_assets:
+            continue
+        logger.info(f"Preparing the shared assets of {key}")
+        t_config, s_config, t_tokenizer, s_tokenizer, t_model, s_model = load_models(trial_args, model_class)
+        assets = {'t_config': t_config, 's_config': s_config, 't_tokenizer': t_tokenizer, 's_tokenizer': s_tokenizer,
+                  't_state_dict': state_dict_to_arrays(t_model), 's_state_dict': state_dict_to_arrays(s_model)}
+        # the features are used by the trials of every repeated_aug of the search space without text augmentation
+        # of the batches, the trials with it featurize their batches on the fly
+        if any(not (repeated_aug > 1 and not trial_args.tensor_aug) for repeated_aug in repeated_aug_values):
+            train_dataset, _, _, _, examples = load_and_cache_examples(trial_args, t_tokenizer, mode="train",
+                                                                        return_examples=True, s_tokenizer=s_tokenizer)
+            assets['train_dataset'] = dataset_to_arrays(train_dataset)
+            assets['examples'] = examples
+        shared_assets[key] = ray.put(assets)
+        del assets, t_model, s_model
+    return shared_assets
+
+
+def apply_config(args, config):
+    """Sets the hyper parameters of a trial on `args`, returns the augmentation pipeline `w`."""
     w=[]
     # for c in config.items():
     #     if c[0] == 'intermediate_loss_type' and 'mi' in c[1]:
@@ -372,6 +509,21 @@ def remote_fn(config, checkpoint_dir=None):
             w = c[1]
         else:
             args.__setattr__(c[0], c[1])
+    return w
+
+
+def remote_fn(config, checkpoint_dir=None, shared_assets=None):
+    if not os.path.exists(args.output_dir) and args.local_rank in [-1, 0]:
+        os.makedirs(args.output_dir)
+    set_start_method('spawn')
+    if args.ddp:
+        args.local_rank = torch.distributed.get_rank()
+    if is_distributed_trainable():
+        print("Can distributed")
+    else:
+        print("Can't distributed")
+    # Set ray tune hyper parameters
+    w = apply_config(args, config)
     globals()['best_evaluation'] = 0.0
     # Setup CUDA, GPU & distributed training
     if args.mixup:
@@ -395,30 +547,22 @@ def remote_fn(config, checkpoint_dir=None):
 
     # Set seed
     set_seed(args)
-    t_config = AutoConfig.from_pretrained(args.T_config_file if args.T_config_file else args.T_model_name_or_path)
-    s_config = AutoConfig.from_pretrained(args.S_config_file if args.S_config_file else args.S_model_name_or_path)
-    args.model_type = s_config.model_type
-    s_config.num_labels = t_config.num_labels
-    t_config.output_hidden_states = True
-    t_config.output_attentions = True
-    s_config.output_hidden_states = True
-    s_config.output_attentions = True
     model_class = task_dict.get(args.task_type)
-    ## load pretrained models and tokenizers
-    t_tokenizer = AutoTokenizer.from_pretrained(args.T_model_name_or_path,
-                                                use_fast=False,
-                                                config=t_config,
-                                                )
-    s_tokenizer = AutoTokenizer.from_pretrained(args.S_model_name_or_path,
-                                                use_fast=False,
-                                                config=s_config) if args.S_model_name_or_path != args.T_model_name_or_path else None
-    t_model = model_class.from_pretrained(args.T_model_name_or_path, config=t_config)
-    ## If the student borrow layers from teachers, it must borrow complete layers. Their hidden size and attention size
-    # must be the same
-    if args.random_student:
+    # configs, tokenizers, weights and features prepared once by the driver, see prepare_shared_assets
+    assets = None
+    if shared_assets is not None and shared_assets_key(args) in shared_assets:
+        assets = ray.get(shared_assets[shared_assets_key(args)])
+    if assets is not None:
+        t_config, s_config = assets['t_config'], assets['s_config']
+        t_tokenizer, s_tokenizer = assets['t_tokenizer'], assets['s_tokenizer']
+        args.model_type = s_config.model_type
+        t_model = model_class.from_config(t_config)
+        t_model.load_state_dict(arrays_to_state_dict(assets['t_state_dict']))
         s_model = model_class.from_config(s_config)
+        if not args.random_student:
+            s_model.load_state_dict(arrays_to_state_dict(assets['s_state_dict']))
     else:
-        s_model = model_class.from_pretrained(args.S_model_name_or_path, config=s_config)
+        t_config, s_config, t_tokenizer, s_tokenizer, t_model, s_model = load_models(args, model_class)
     s_model.to(args.device)
     t_model.to(args.device)
     # multi-gpu training (should be after apex fp16 initialization)
@@ -468,17 +612,21 @@ def remote_fn(config, checkpoint_dir=None):
     if args.local_rank in [-1, 0]:
         logger.info("Training/evaluation parameters %s", args)
 
+    trial_cost = TrialCostTracker(args.trial_time_budget, objective=args.sweep_objective)
+
     def predict_callback(model, step):
         if args.eval and args.local_rank in [-1, 0]:
+            trial_cost.start_eval()
             evaluation_result = evaluate_func(args, model, s_tokenizer if s_tokenizer else t_tokenizer, prefix=step)
+            trial_cost.end_eval(step)
             global best_evaluation
             if evaluation_result[glue_criterion(args.task_name)[0]] > best_evaluation:
                 best_evaluation = evaluation_result[glue_criterion(args.task_name)[0]]
                 logger.info("Saving best model checkpoint to %s", os.path.join(args.output_dir, 'best_model'))
                 # Save a trained model, configuration and tokenizer using `save_pretrained()`.
                 # They can then be reloaded using `from_pretrained()`
-                model_to_save = model.module.module if hasattr(model.module,
-                                                               "module") else model.module  # Take care of distributed/parallel training
+                model_to_save = model.module if hasattr(model, "module") else model
+                model_to_save = model_to_save.module if hasattr(model_to_save, "module") else model_to_save  # Take care of distributed/parallel training
                 model_to_save.save_pretrained(os.path.join(args.output_dir, 'best_model'))
                 with open(os.path.join(args.output_dir, 'best_model/best_results.txt'), "w") as writer:
                     writer.write(f"Output: {json.dumps(evaluation_result, indent=2)}\n")
@@ -495,21 +643,26 @@ def remote_fn(config, checkpoint_dir=None):
             #     return evaluation_result
             with open(output_eval_file, "a") as writer:
                 writer.write(f"Output: {json.dumps(evaluation_result, indent=2)}\n")
+            report = None
             if 'exact' in evaluation_result.keys():
-                tune.report(score=evaluation_result['exact'],exact=evaluation_result['exact'], f1=evaluation_result['f1'])
+                report = dict(score=evaluation_result['exact'],exact=evaluation_result['exact'], f1=evaluation_result['f1'])
             elif 'f1' in evaluation_result.keys():
-                tune.report(score=evaluation_result['acc_and_f1'],f1=evaluation_result['f1'], accuracy=evaluation_result['acc'])
+                report = dict(score=evaluation_result['acc_and_f1'],f1=evaluation_result['f1'], accuracy=evaluation_result['acc'])
             elif 'acc' in evaluation_result.keys():
-                tune.report(score=evaluation_result['acc'], accuracy=evaluation_result['acc'])
+                report = dict(score=evaluation_result['acc'], accuracy=evaluation_result['acc'])
             elif 'roc_auc' in evaluation_result.keys():
-                tune.report(score=evaluation_result['roc_auc'], roc_auc=evaluation_result['roc_auc'])
+                report = dict(score=evaluation_result['roc_auc'], roc_auc=evaluation_result['roc_auc'])
             elif 'mcc' in evaluation_result.keys():
-                tune.report(score=evaluation_result['mcc'], mcc=evaluation_result['mcc'])
+                report = dict(score=evaluation_result['mcc'], mcc=evaluation_result['mcc'])
             elif 'spearmanr' in evaluation_result.keys():
-                tune.report(score=evaluation_result['spearmanr'], pearson=evaluation_result['pearson'],corr=evaluation_result['corr'])
+                report = dict(score=evaluation_result['spearmanr'], pearson=evaluation_result['pearson'],corr=evaluation_result['corr'])
             elif 'm_mm_acc' in evaluation_result.keys():
-                tune.report(score=evaluation_result['m_mm_acc'], mnli_acc=evaluation_result['mnli/acc'],
+                report = dict(score=evaluation_result['m_mm_acc'], mnli_acc=evaluation_result['mnli/acc'],
                             mnli_mm_acc=evaluation_result['mnli-mm/acc'])
+            # throughput, eval time, peak memory and the cost aware objective; over_budget stops the trial
+            if report is not None:
+                report.update(trial_cost.summary(report['score']))
+                tune.report(**report)
             model.train()
             return evaluation_result
         else:
@@ -520,12 +673,15 @@ def remote_fn(config, checkpoint_dir=None):
         # examples = read_examples_from_file(args.data_dir, mode="train", task_type=args.task_type)
         augmenter = None
         q = None
-        if args.repeated_aug > 1:
+        if args.repeated_aug > 1 and not args.tensor_aug:
             processor = Processor(args, t_tokenizer, task=args.task_name, max_length=args.max_seq_length,
                                   s_tokenizer=s_tokenizer if s_tokenizer else None)
             train_dataset, s_dataset, features, s_features, examples = processor.load_and_cache_examples(
                 mode="train",
                 return_examples=True)
+        elif assets is not None and 'train_dataset' in assets:
+            train_dataset = dataset_from_arrays(*assets['train_dataset'])
+            examples = assets['examples']
         else:
             train_dataset, s_dataset, features, s_features, examples = load_and_cache_examples(args, t_tokenizer,
                                                                                                mode="train",
@@ -570,9 +726,14 @@ def remote_fn(config, checkpoint_dir=None):
         else:
             pass
 
+        initial_state = None
+        if checkpoint_dir is not None:
+            # PBT restarts the trial from the checkpoint of a better trial, with perturbed hyper parameters
+            initial_state = torch.load(os.path.join(checkpoint_dir, "training_state.bin"), map_location=args.device)
         train(args, examples, train_dataset, t_model, s_model, t_tokenizer, augmenter, matches, predict_callback,
-              q=q, processor=processor if args.repeated_aug > 1 else None)
-        s_tokenizer.save_pretrained(os.path.join(args.output_dir, 'best_model'))
+              q=q, processor=processor if args.repeated_aug > 1 and not args.tensor_aug else None,
+              initial_state=initial_state, cost_tracker=trial_cost)
+        (s_tokenizer if s_tokenizer else t_tokenizer).save_pretrained(os.path.join(args.output_dir, 'best_model'))
         if args.aug_pipeline and args.repeated_aug <= 1:
             process.processes[0].terminate()
         # p = Process(target=data_aug_process, args=(augmenter,examples,tokenizer,args))
@@ -686,6 +847,27 @@ def main(args, gpus_per_trial=4):
     #     "alpha": tune.grid_search([0.0, 0.1, 0.5, 0.9, 1.0]),
     #     "intermediate_strategy": tune.grid_search(["skip", "last", "EMD"]),
     #     "mixup": tune.grid_search([True, False])}
+    num_samples = 1
+    if args.pbt:
+        # a population of trials on the task given on the command line, the distillation hyper parameters are
+        # perturbed every time a trial reports
+        hyperparam_mutations = {
+            "temperature": tune.uniform(1.0, 8.0),
+            "kd_loss_weight": tune.uniform(0.1, 2.0),
+            "alpha": tune.uniform(0.05, 0.95),
+            "learning_rate": tune.loguniform(1e-5, 1e-4),
+            "aug_p": tune.uniform(0.05, 0.5),
+        }
+        search_space = dict(hyperparam_mutations)
+        num_samples = args.pbt_population
+        args.eval = True
+        assert args.max_steps > 0, "PBT trials are trained for --max_steps steps"
+        pbt_scheduler = PopulationBasedTraining(
+            time_attr="training_iteration",
+            metric="objective",
+            mode="max",
+            perturbation_interval=1,
+            hyperparam_mutations=hyperparam_mutations)
     scheduler = ASHAScheduler(
         metric="accuracy",
         mode="max",
@@ -696,11 +878,12 @@ def main(args, gpus_per_trial=4):
 
     reporter = CLIReporter(
         # parameter_columns=["l1", "l2", "lr", "batch_size"],
-        metric_columns=["score"])
+        metric_columns=["score", "objective", "steps_per_second", "seconds_per_eval", "peak_memory_mb"])
     from functools import partial
+    shared_assets = prepare_shared_assets(args, search_space)
     if args.ddp:
         train_fn = DistributedTrainableCreator(
-            remote_fn,
+            partial(remote_fn, shared_assets=shared_assets),
             num_workers=4,
             num_gpus_per_worker=1,
             num_cpus_per_worker=8,
@@ -722,20 +905,24 @@ def main(args, gpus_per_trial=4):
     #     progress_reporter=reporter,
     #     queue_trials=True)
     else:
-        train_fn = remote_fn
+        train_fn = tune.with_parameters(remote_fn, shared_assets=shared_assets)
+    if args.ray_local_cpus > 0:
+        resources_per_trial = {"cpu": max(1, args.ray_local_cpus // num_samples), "gpu": 0 if args.no_cuda else gpus_per_trial}
+    else:
+        resources_per_trial = {"cpu": 8, "gpu": gpus_per_trial}
     result = tune.run(
         train_fn,
-        resources_per_trial=None if args.ddp else {
-            "cpu": 8,
-            "gpu": gpus_per_trial
-        },
+        resources_per_trial=None if args.ddp else resources_per_trial,
         config=search_space,
+        num_samples=num_samples,
+        scheduler=pbt_scheduler if args.pbt else None,
+        # trials projected to exceed --trial_time_budget report over_budget=1
+        stop={"over_budget": 1} if args.trial_time_budget > 0 else None,
         progress_reporter=reporter,
         queue_trials=True,
     )
-    with open('/home/ray/ray_results.json','w') as f:
-        json.dump(result, f)
-    best_trial = result.get_best_trial("score", "max", "last")
+    result.dataframe().to_csv(os.path.join(args.output_dir, "ray_results.csv"), index=False)
+    best_trial = result.get_best_trial("objective", "max", "last")
     print("Best trial config: {}".format(best_trial.config))
     # print("Best trial final validation loss: {}".format(
     #     best_trial.last_result["loss"]))
@@ -748,8 +935,13 @@ def main(args, gpus_per_trial=4):
 
 
 if __name__ == '__main__':
-    ray.init(address='auto', _redis_password='5241590000000000', ignore_reinit_error=True)
     args = parse()
+    assert not args.pack_sequences, "run.py does not train on packed sequences"
+    if args.ray_local_cpus > 0:
+        # local run, e.g. a small PBT population of tiny models on CPU
+        ray.init(num_cpus=args.ray_local_cpus, ignore_reinit_error=True)
+    else:
+        ray.init(address='auto', _redis_password='5241590000000000', ignore_reinit_error=True)
     import time
     # time.sleep(30)
     # set_start_method('spawn')
@@ -15,4 +15,14 @@ def BertForGLUEAdptor(batch, model_outputs, no_mask=False, no_logits=False):
         dict_obj['inputs_mask'] = batch['attention_mask']
     if no_logits is False:
         dict_obj['logits'] = (model_outputs.logits)
-    return dict_obj
\ No newline at end of file
+    return dict_obj
+
+def PackedGLUEAdaptor(batch, model_outputs, no_mask=False, no_logits=False):
+    # packed rows (see Distiller.packing): logits are per example, hidden states per packed token
+    dict_obj = {'hidden': model_outputs.hidden_states, 'attention': model_outputs.attentions,
+                "loss": model_outputs.loss}
+    if no_mask is False:
+        dict_obj['inputs_mask'] = (batch['segment_ids'] > 0).long() if 'segment_ids' in batch else batch['attention_mask']
+    if no_logits is False:
+        dict_obj['logits'] = (model_outputs.logits)
+    return dict_obj
@@ -0,0 +1,94 @@
+import os
+import gzip
+import json
+import queue
+import atexit
+import logging
+import threading
+# Background writer of evaluation artifacts (predictions, n-best lists, null odds, GLUE submission files). The
+# evaluation hands over the finished structures and returns; a daemon thread serializes them to a temporary file that
+# is renamed to its final name once complete, so a file with the final name is never partially written.
+
+logger = logging.getLogger(__name__)
+
+
+class ArtifactWriter(object):
+    """
+    Writes files in a background thread, in the order they are submitted.
+
+    Args:
+        max_pending (int): number of artifacts waiting to be written before :meth:`submit` blocks, which bounds the
+            memory held by artifacts of evaluations running faster than the disk.
+    """
+    def __init__(self, max_pending=4):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.errors = []
+        self.thread = threading.Thread(target=self._run, name="artifact-writer", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            path, write_fn, compress = self.queue.get()
+            tmp_path = f"{path}.tmp{os.getpid()}"
+            try:
+                with (gzip.open(tmp_path, "wt", encoding="utf-8") if compress
+                      else open(tmp_path, "w", encoding="utf-8")) as writer:
+                    write_fn(writer)
+                os.replace(tmp_path, path)
+            except Exception as e:
+                logger.error(f"Failed to write {path}: {e!r}")
+                self.errors.append((path, e))
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            finally:
+                self.queue.task_done()
+
+    def submit(self, path, write_fn, compress=False):
+        """
+        Queues `write_fn(writer)` to write `path` (``path + ".gz"`` with gzip when `compress`).
+
+        Returns:
+            the path of the file that will be written
+        """
+        if compress and not path.endswith(".gz"):
+            path += ".gz"
+        self.queue.put((path, write_fn, compress))
+        return path
+
+    def write_json(self, path, obj, compress=False):
+        """Queues `obj` as compact json (no indentation). `obj` must not be modified afterwards."""
+        return self.submit(path, lambda writer: writer.write(json.dumps(obj, separators=(",", ":")) + "\n"),
+                           compress)
+
+    def write_tsv(self, path, columns, compress=False):
+        """Queues a tab separated file with a header, `columns` maps the column names to lists of values."""
+        def write(writer):
+            writer.write("\t".join(columns) + "\n")
+            for row in zip(*columns.values()):
+                writer.write("\t".join(str(value) for value in row) + "\n")
+        return self.submit(path, write, compress)
+
+    def flush(self):
+        """Waits until every queued artifact is written, and raises if some of them failed."""
+        self.queue.join()
+        if self.errors:
+            errors, self.errors = self.errors, []
+            raise IOError(f"Failed to write {[path for path, _ in errors]}")
+
+
+_writer = None
+
+
+def get_artifact_writer():
+    """The writer shared by the process, started on first use and flushed at exit."""
+    global _writer
+    if _writer is None:
+        _writer = ArtifactWriter()
+        atexit.register(_writer.queue.join)
+    return _writer
+
+
+def flush_artifacts():
+    """Waits for the artifacts queued so far, e.g. before reading a predictions file back."""
+    if _writer is not None:
+        _writer.flush()
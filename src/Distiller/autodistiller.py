@@ -0,0 +1,281 @@
+import os
+import json
+import pickle
+import argparse
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import GradientBoostingRegressor
+from .utils import Logger
+# Learned predictor of distillation outcomes. It is trained on the AutoDistiller tables
+# (autodistiller_experiments/*.csv) and ranks candidate configurations for a task before any of them is trained.
+
+logger = Logger("all.log",level="debug").logger
+
+CATEGORICAL_COLUMNS = ["Model", "Teacher", "intermediate_loss_type", "intermediate_strategy", "kd_loss_type"]
+NUMERICAL_COLUMNS = ["alpha", "mixup", "repeated_aug", "aug_p", "contextual", "backtranslation", "random"]
+TARGETS = ["score", "ratio"]
+
+
+def _to_fraction(score):
+    # the baseline tables store percentages, the experiment tables fractions
+    return score / 100. if score > 1.5 else score
+
+
+def load_tabular_data(data_dir):
+    """
+    Reads the AutoDistiller tables of `data_dir`.
+    Returns:
+        (results, dataset_features, student_baseline, teacher_baseline) as DataFrames
+    """
+    results = pd.read_csv(os.path.join(data_dir, "auto_distiller_tabular_data.csv"))
+    dataset_features = pd.read_csv(os.path.join(data_dir, "dataset_features_50_concat.csv"))
+    student_baseline = pd.read_csv(os.path.join(data_dir, "student_baseline.csv"), encoding="utf-8-sig")
+    teacher_baseline = pd.read_csv(os.path.join(data_dir, "teacher_baseline.csv"), encoding="utf-8-sig")
+    return results, dataset_features, student_baseline, teacher_baseline
+
+
+def clean_configurations(df):
+    """Drops the empty rows and normalizes the types of a results or candidates table."""
+    df = df.dropna(how="all").copy()
+    df = df.dropna(subset=["Model", "Teacher", "task"])
+    for column in CATEGORICAL_COLUMNS + ["task"]:
+        df[column] = df[column].astype(str).str.strip()
+    df["mixup"] = df["mixup"].map(lambda x: str(x).strip().upper() == "TRUE").astype(float)
+    for column in NUMERICAL_COLUMNS:
+        df[column] = pd.to_numeric(df[column], errors="coerce")
+    return df.reset_index(drop=True)
+
+
+def join_tables(df, dataset_features, student_baseline=None, teacher_baseline=None):
+    """Adds the task descriptor (100 dims + #example/#label) and the teacher/student baseline scores to `df`."""
+    features = dataset_features.copy()
+    features["task"] = features["task"].astype(str).str.strip()
+    df = df.drop(columns=[c for c in ["#example", "#label"] if c in df.columns])
+    df = df.merge(features, on="task", how="left")
+    if student_baseline is not None:
+        student = student_baseline.rename(columns={"student_score": "student_baseline"})
+        df = df.merge(student[["task", "Model", "student_baseline"]], on=["task", "Model"], how="left")
+    if teacher_baseline is not None:
+        teacher = teacher_baseline.rename(columns={"model": "Teacher", "score": "teacher_baseline"})
+        df = df.merge(teacher[["task", "Teacher", "teacher_baseline"]], on=["task", "Teacher"], how="left")
+    for column in ["student_baseline", "teacher_baseline"]:
+        if column in df.columns:
+            df[column] = df[column].map(lambda x: _to_fraction(x) if pd.notnull(x) else x)
+    return df
+
+
+class DistillationOutcomePredictor(object):
+    """
+    Predicts the dev score and the teacher ratio reached by a distillation configuration on a task.
+    The task is only described by its dataset descriptor, so the predictor also applies to unseen tasks.
+
+    Args:
+        n_estimators, max_depth, learning_rate: parameters of the gradient boosting regressors (one per target).
+    """
+
+    def __init__(self, n_estimators=300, max_depth=3, learning_rate=0.05, seed=42):
+        self.params = dict(n_estimators=n_estimators, max_depth=max_depth, learning_rate=learning_rate,
+                           subsample=0.8, random_state=seed)
+        self.models = {}
+        self.categories = {}
+        self.descriptor_columns = []
+        self.feature_columns = []
+        self.fill_values = {}
+
+    def _design_matrix(self, df):
+        columns = {}
+        for column in CATEGORICAL_COLUMNS:
+            for category in self.categories[column]:
+                columns[f"{column}={category}"] = (df[column] == category).astype(float).values
+        for column in NUMERICAL_COLUMNS + ["student_baseline", "teacher_baseline"] + self.descriptor_columns:
+            values = df[column].astype(float).values if column in df.columns else np.full(len(df), np.nan)
+            columns[column] = values
+        if "#example" in df.columns:
+            columns["log_example"] = np.log1p(df["#example"].astype(float).values)
+        matrix = pd.DataFrame(columns)
+        if not self.feature_columns:
+            self.feature_columns = list(matrix.columns)
+        # unknown values (e.g. a missing baseline) are imputed with the training means
+        return matrix[self.feature_columns].fillna(self.fill_values).values
+
+    def fit(self, df):
+        """`df` is a cleaned and joined results table, see :func:`clean_configurations` and :func:`join_tables`."""
+        self.categories = {column: sorted(df[column].unique()) for column in CATEGORICAL_COLUMNS}
+        self.descriptor_columns = [c for c in df.columns if c.isdigit()] + ["#label"]
+        self.feature_columns = []
+        self.fill_values = {}
+        matrix = pd.DataFrame(self._design_matrix(df), columns=self.feature_columns)
+        self.fill_values = matrix.mean().to_dict()
+        matrix = matrix.fillna(self.fill_values).values
+        for target in TARGETS:
+            y = df[target].astype(float).values
+            mask = ~np.isnan(y)
+            self.models[target] = GradientBoostingRegressor(**self.params).fit(matrix[mask], y[mask])
+        return self
+
+    def predict(self, df):
+        matrix = self._design_matrix(df)
+        return pd.DataFrame({f"predicted_{target}": model.predict(matrix) for target, model in self.models.items()},
+                            index=df.index)
+
+    def rank(self, candidates, top_k=None, target="score"):
+        """Returns the candidates sorted by predicted `target`, keeping the `top_k` best ones."""
+        ranked = pd.concat([candidates, self.predict(candidates)], axis=1)
+        ranked = ranked.sort_values(f"predicted_{target}", ascending=False)
+        return ranked.head(top_k) if top_k else ranked
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            pickle.dump(self, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+
+def leave_one_task_out(df, **predictor_kwargs):
+    """Estimates the error on unseen tasks: mean absolute error and spearman correlation of every held out task."""
+    report = {}
+    for task in sorted(df["task"].unique()):
+        train_df, test_df = df[df["task"] != task], df[df["task"] == task]
+        predictions = DistillationOutcomePredictor(**predictor_kwargs).fit(train_df).predict(test_df)
+        report[task] = {
+            "mae": float(np.mean(np.abs(predictions["predicted_score"].values - test_df["score"].values))),
+            "spearman": float(pd.Series(predictions["predicted_score"].values).corr(
+                pd.Series(test_df["score"].values), method="spearman")),
+        }
+    return report
+
+
+def train_predictor(data_dir):
+    results, dataset_features, student_baseline, teacher_baseline = load_tabular_data(data_dir)
+    results = join_tables(clean_configurations(results), dataset_features, student_baseline, teacher_baseline)
+    return DistillationOutcomePredictor().fit(results)
+
+
+def rank_candidates(data_dir, candidates_file, top_k=None, task=None, target="score", dataset_features=None):
+    """
+    Trains a predictor on the tables of `data_dir` and ranks the configurations of `candidates_file`.
+
+    Args:
+        data_dir: directory of the AutoDistiller tables.
+        candidates_file: csv with the columns of `audo_distiller_candidates.csv`.
+        top_k: number of configurations to keep, None keeps all of them.
+        task: if set, overrides the task of every candidate.
+        dataset_features: a descriptor table (same columns as `dataset_features_50_concat.csv`) replacing it, e.g.
+            to rank a task missing from it. All its rows must come from the same extractor (see
+            :func:`~Distiller.dataset_features.describe_training_tasks`), the results of the tasks missing from it
+            are left out of the training of the predictor.
+    """
+    results, features, student_baseline, teacher_baseline = load_tabular_data(data_dir)
+    results = clean_configurations(results)
+    if dataset_features is not None:
+        # descriptors of different pipelines are not comparable, they are never mixed
+        features = dataset_features
+        left_out = sorted(set(results["task"]) - set(features["task"].astype(str).str.strip()))
+        if left_out:
+            logger.warning(f"No descriptor for the tasks {left_out}, their results are not used by the predictor")
+        results = results[~results["task"].isin(left_out)]
+        if results.empty:
+            raise ValueError("None of the tasks of the results has a descriptor in dataset_features")
+    results = join_tables(results, features, student_baseline, teacher_baseline)
+    predictor = DistillationOutcomePredictor().fit(results)
+    candidates = clean_configurations(pd.read_csv(candidates_file))
+    if task is not None:
+        candidates["task"] = task
+    candidates = candidates.drop(columns=[c for c in TARGETS if c in candidates.columns])
+    candidates = join_tables(candidates, features, student_baseline, teacher_baseline)
+    ranked = predictor.rank(candidates, top_k=top_k, target=target)
+    return ranked[[c for c in ranked.columns if not c.isdigit() and c != "#label"]]
+
+
+class SuccessiveHalving(object):
+    """
+    Multi-fidelity search over a fixed list of candidates. Every candidate of the first rung is trained for
+    `min_steps`, then only the best ``1/eta`` of a rung are promoted to the next one, trained for `eta` times more
+    steps, until `max_steps` is reached. The results are written to `state_file` after every trial, so an
+    interrupted search resumes from the first trial without a result.
+
+    Args:
+        candidates (list): ids of the candidates (e.g. row indices of the candidates table).
+        min_steps (int): training steps of the first rung.
+        max_steps (int): training steps of the last rung.
+        eta (int): reduction factor between two rungs.
+        state_file (str): json file of the search state.
+    """
+
+    def __init__(self, candidates, min_steps, max_steps, eta=3, state_file=None):
+        assert eta > 1 and 0 < min_steps <= max_steps
+        self.candidates = list(candidates)
+        self.eta = eta
+        self.budgets = [min_steps]
+        while self.budgets[-1] * eta <= max_steps:
+            self.budgets.append(self.budgets[-1] * eta)
+        if self.budgets[-1] != max_steps:
+            self.budgets.append(max_steps)
+        self.state_file = state_file
+        self.results = [{} for _ in self.budgets]
+        if state_file is not None and os.path.exists(state_file):
+            with open(state_file) as f:
+                state = json.load(f)
+            if state["candidates"] == self.candidates and state["budgets"] == self.budgets:
+                self.results = [{int(k): v for k, v in rung.items()} for rung in state["results"]]
+                logger.info(f"Resuming successive halving from {state_file}")
+            else:
+                logger.warning(f"{state_file} was written for another search, starting over")
+
+    def save(self):
+        if self.state_file is None:
+            return
+        with open(self.state_file + ".tmp", "w") as f:
+            json.dump({"candidates": self.candidates, "budgets": self.budgets, "results": self.results}, f, indent=2)
+        os.replace(self.state_file + ".tmp", self.state_file)
+
+    def promoted(self, rung):
+        """Candidates trained in `rung`: all of them in the first rung, the top ``1/eta`` of the previous one after."""
+        if rung == 0:
+            return self.candidates
+        previous = self.promoted(rung - 1)
+        ranked = sorted(previous, key=lambda c: self.results[rung - 1][c], reverse=True)
+        return ranked[:max(1, len(previous) // self.eta)]
+
+    def run(self, trial_fn):
+        """
+        Args:
+            trial_fn (Callable): called as ``trial_fn(candidate, num_steps, rung)``, returns the score of the
+                candidate (higher is better).
+        Returns:
+            the candidates of the last rung, best first, with their scores
+        """
+        for rung, num_steps in enumerate(self.budgets):
+            for candidate in self.promoted(rung):
+                if candidate in self.results[rung]:
+                    continue
+                logger.info(f"Rung {rung}: training candidate {candidate} for {num_steps} steps")
+                self.results[rung][candidate] = float(trial_fn(candidate, num_steps, rung))
+                self.save()
+        last = self.results[-1]
+        return sorted(last.items(), key=lambda item: item[1], reverse=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Rank distillation configurations with a learned predictor")
+    parser.add_argument("--data_dir", type=str, default="autodistiller_experiments",
+                        help="directory of the AutoDistiller tables")
+    parser.add_argument("--candidates", type=str, required=True, help="csv file of the candidate configurations")
+    parser.add_argument("--task", type=str, default=None, help="task of the candidates, overrides the csv")
+    parser.add_argument("--top_k", type=int, default=None)
+    parser.add_argument("--target", type=str, default="score", choices=TARGETS)
+    parser.add_argument("--output", type=str, default="ranked_candidates.csv")
+    parser.add_argument("--cross_validate", action="store_true",
+                        help="report the leave-one-task-out error of the predictor")
+    args = parser.parse_args()
+    if args.cross_validate:
+        results, dataset_features, student_baseline, teacher_baseline = load_tabular_data(args.data_dir)
+        results = join_tables(clean_configurations(results), dataset_features, student_baseline, teacher_baseline)
+        for task, metrics in leave_one_task_out(results).items():
+            logger.info(f"{task}: {metrics}")
+    ranked = rank_candidates(args.data_dir, args.candidates, args.top_k, args.task, args.target)
+    ranked.to_csv(args.output, index=False)
+    logger.info(f"Wrote {len(ranked)} ranked candidates to {args.output}")
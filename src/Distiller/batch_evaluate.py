@@ -0,0 +1,249 @@
+import os
+import copy
+import glob
+import json
+import torch
+import pandas as pd
+import torch.multiprocessing as mp
+from .transformers import AutoTokenizer, AutoModelForSequenceClassification, AutoModelForQuestionAnswering, WEIGHTS_NAME
+from .evaluate import evaluate_glue, evaluate_squad, glue_eval_tensors, squad_eval_data
+from .autodistiller import load_tabular_data, _to_fraction
+from .utils import Logger, glue_criterion
+from .resources import ResourceManager, available_cores, split_cores, pin
+# Batch evaluation of the checkpoints of a sweep. The dev data is loaded once in the parent process, then a pool of
+# CPU workers forked from it (so they share the dev tensors and features) evaluates the checkpoints concurrently. The
+# scores are written as one table with the columns of autodistiller_experiments/auto_distiller_tabular_data.csv.
+
+logger = Logger("all.log",level="debug").logger
+
+RESULT_COLUMNS = ["Model", "Teacher", "intermediate_loss_type", "alpha", "intermediate_strategy", "kd_loss_type",
+                  "mixup", "repeated_aug", "aug_p", "#example", "score", "task", "ratio", "baseline_score",
+                  "contextual", "backtranslation", "random"]
+# names of the models in the AutoDistiller tables
+MODEL_NAMES = {"howey/electra-large-rte": "ELECTRA_LARGE",
+               "google/bert_uncased_L-12_H-768_A-12": "BERT_BASE",
+               "google/bert_uncased_L-8_H-512_A-8": "BERT_MEDIUM",
+               "huawei-noah/TinyBERT_General_6L_768D": "TinyBERT6",
+               "google/bert_uncased_L-4_H-512_A-8": "BERT_SMALL",
+               "huawei-noah/TinyBERT_General_4L_312D": "TinyBERT4",
+               "google/bert_uncased_L-4_H-256_A-4": "BERT_MINI",
+               "google/bert_uncased_L-2_H-128_A-2": "BERT_TINY",
+               "google/electra-small-discriminator": "ELECTRA_SMALL"}
+AUGMENTERS = ["contextual", "backtranslation", "random"]
+
+# set in the parent before the pool is forked, so that the workers inherit it instead of receiving a copy
+_worker_state = {}
+
+
+def find_checkpoints(root):
+    """Directories under `root` holding saved model weights."""
+    return sorted(os.path.dirname(c) for c in glob.glob(os.path.join(root, "**", WEIGHTS_NAME), recursive=True))
+
+
+def checkpoint_training_args(checkpoint, root):
+    """The training_args.json of `checkpoint`, or of the closest directory above it (e.g. for best_model)."""
+    directory = os.path.abspath(checkpoint)
+    root = os.path.abspath(root)
+    while True:
+        path = os.path.join(directory, "training_args.json")
+        if os.path.exists(path):
+            with open(path) as f:
+                return json.load(f)
+        if directory == root or os.path.dirname(directory) == directory:
+            return {}
+        directory = os.path.dirname(directory)
+
+
+def load_student_tokenizer(checkpoint, train_args, root):
+    """
+    The tokenizer of the student of `checkpoint`, loaded from the ``S_model_name_or_path`` of its training arguments,
+    else from the checkpoint or the closest directory above it holding one: the tokenizer is only saved to the output
+    directory of a run, not to its best_model and stage_* checkpoints.
+    """
+    candidates = [train_args.get("S_model_name_or_path")]
+    directory = os.path.abspath(checkpoint)
+    root = os.path.abspath(root)
+    while True:
+        candidates.append(directory)
+        if directory == root or os.path.dirname(directory) == directory:
+            break
+        directory = os.path.dirname(directory)
+    error = None
+    for candidate in filter(None, candidates):
+        try:
+            return AutoTokenizer.from_pretrained(candidate, use_fast=False)
+        except Exception as e:
+            error = e
+    raise OSError(f"No tokenizer found for {checkpoint}, last error: {error!r}")
+
+
+def model_name(name_or_path):
+    if not name_or_path:
+        return None
+    return MODEL_NAMES.get(name_or_path, list(filter(None, name_or_path.split("/"))).pop())
+
+
+def _augmentation_columns(train_args):
+    # inverse of the w list built from the contextual/backtranslation/random columns in auto_distiller_exp.py
+    columns = {name: 0 for name in AUGMENTERS}
+    if train_args.get("aug_pipeline"):
+        for position, augmenter in enumerate(train_args.get("w") or []):
+            columns[AUGMENTERS[int(augmenter)]] = position + 1
+    return columns
+
+
+def _lookup(table, column, **keys):
+    if table is None:
+        return None
+    rows = table
+    for key, value in keys.items():
+        rows = rows[rows[key].astype(str).str.strip() == str(value)]
+    return rows[column].iloc[0] if len(rows) else None
+
+
+def result_row(args, train_args, evaluation, tables=None):
+    """
+    Row of the results table of one checkpoint.
+
+    Args:
+        args: arguments of the evaluation (task).
+        train_args (dict): training arguments of the checkpoint, see :func:`checkpoint_training_args`.
+        evaluation (dict): output of ``evaluate_glue`` or ``evaluate_squad``.
+        tables: the AutoDistiller tables (see :func:`~Distiller.autodistiller.load_tabular_data`), used for the
+            number of training examples and the baselines, or None.
+    """
+    if args.task_type == "glue":
+        task = args.task_name
+        score = evaluation[glue_criterion(task)[0]]
+    else:
+        task = args.task_type
+        score = _to_fraction(evaluation["f1"])
+    results, dataset_features, student_baseline, teacher_baseline = tables if tables else (None,) * 4
+    student = model_name(train_args.get("S_model_name_or_path"))
+    teacher = model_name(train_args.get("T_model_name_or_path") or args.T_model_name_or_path)
+    teacher_score = _lookup(teacher_baseline, "score", task=task, model=teacher)
+    row = {
+        "Model": student,
+        "Teacher": teacher,
+        "intermediate_loss_type": train_args.get("intermediate_loss_type"),
+        "alpha": train_args.get("alpha"),
+        "intermediate_strategy": train_args.get("intermediate_strategy"),
+        "kd_loss_type": train_args.get("kd_loss_type"),
+        "mixup": "TRUE" if train_args.get("mixup") else "FALSE",
+        "repeated_aug": train_args.get("repeated_aug"),
+        "aug_p": train_args.get("aug_p"),
+        "#example": _lookup(dataset_features, "#example", task=task),
+        "score": score,
+        "task": task,
+        "ratio": score / _to_fraction(teacher_score) if teacher_score is not None else None,
+        "baseline_score": _lookup(student_baseline, "student_score", task=task, Model=student),
+    }
+    row.update(_augmentation_columns(train_args))
+    return row
+
+
+def _init_worker(core_queue):
+    # every worker takes its own set of cores, so that the workers do not compete for the same cores
+    pin(core_queue.get())
+
+
+def _evaluate_checkpoint(checkpoint):
+    args, tokenizer = _worker_state["args"], _worker_state["tokenizer"]
+    try:
+        if args.task_type == "glue":
+            model = AutoModelForSequenceClassification.from_pretrained(checkpoint)
+            evaluate_fn = evaluate_glue
+        else:
+            model = AutoModelForQuestionAnswering.from_pretrained(checkpoint)
+            evaluate_fn = evaluate_squad
+        model.to(args.device)
+        checkpoint_args = copy.copy(args)
+        checkpoint_args.output_dir = checkpoint
+        checkpoint_args.model_type = model.config.model_type
+        return checkpoint, evaluate_fn(checkpoint_args, model, tokenizer, prefix="batch_eval", write_prediction=False)
+    except Exception as e:
+        logger.error(f"Evaluation of {checkpoint} failed: {e!r}")
+        return checkpoint, None
+
+
+def num_workers_for_budget(checkpoints, num_workers, memory_budget=0):
+    """
+    Number of workers that fit in `memory_budget` GB: a worker holds the weights of a checkpoint, the copy made while
+    loading them and the activations of an evaluation batch, about 3 times the size of the weights file.
+    """
+    if memory_budget > 0:
+        largest = max(os.path.getsize(os.path.join(c, WEIGHTS_NAME)) for c in checkpoints)
+        num_workers = min(num_workers, int(memory_budget * 2 ** 30 // (3 * largest)))
+    return max(1, min(num_workers, len(checkpoints)))
+
+
+def evaluate_checkpoints(args, checkpoints_dir, num_workers=4, memory_budget=0, output_file=None):
+    """
+    Evaluates every checkpoint under `checkpoints_dir` on the dev set of the task of `args`.
+
+    Checkpoints are grouped by student tokenizer. For every group the dev data is loaded once and cached (see
+    :func:`~Distiller.evaluate.glue_eval_tensors` and :func:`~Distiller.evaluate.squad_eval_data`) before the
+    workers are forked, so they all read the same tensors and features. Every worker is pinned to its own share of the cores, their
+    utilisation is appended to cpu_usage.jsonl in `checkpoints_dir` (see :mod:`~Distiller.resources`).
+
+    Args:
+        args: parsed arguments of the task (task_type, task_name, data_dir, max_seq_length, ...).
+        checkpoints_dir (str): directory searched recursively for checkpoints.
+        num_workers (int): maximum number of worker processes, each pinned to its share of the available cores.
+        memory_budget (float): If > 0, memory in GB the workers may use, see :func:`num_workers_for_budget`.
+        output_file (str): csv file of the results table, defaults to checkpoint_results.csv in `checkpoints_dir`.
+    Returns:
+        the results table, as a DataFrame
+    """
+    checkpoints = find_checkpoints(checkpoints_dir)
+    if not checkpoints:
+        logger.warning(f"No checkpoint found in {checkpoints_dir}")
+        return pd.DataFrame(columns=RESULT_COLUMNS)
+    args = copy.copy(args)
+    args.device = torch.device("cpu")
+    args.n_gpu = 0
+    tables = None
+    if os.path.exists(os.path.join(args.autodistiller_data_dir, "auto_distiller_tabular_data.csv")):
+        tables = load_tabular_data(args.autodistiller_data_dir)
+    train_args = {c: checkpoint_training_args(c, checkpoints_dir) for c in checkpoints}
+    groups = {}
+    for c in checkpoints:
+        groups.setdefault(train_args[c].get("S_model_name_or_path") or c, []).append(c)
+
+    evaluations = {}
+    context = mp.get_context("fork")
+    resources = ResourceManager({"evaluation": available_cores()}, os.path.join(checkpoints_dir, "cpu_usage.jsonl"))
+    for group in groups.values():
+        try:
+            tokenizer = load_student_tokenizer(group[0], train_args[group[0]], checkpoints_dir)
+            # loaded before the fork, the workers find it in the cache of the evaluate module
+            if args.task_type == "glue":
+                glue_eval_tensors(args, tokenizer)
+            else:
+                squad_eval_data(args, tokenizer)
+        except Exception as e:
+            # the other groups are still evaluated
+            logger.error(f"Skipping the {len(group)} checkpoints of {group[0]}: {e!r}")
+            continue
+        _worker_state.update(args=args, tokenizer=tokenizer)
+        core_sets = split_cores(available_cores(), num_workers_for_budget(group, num_workers, memory_budget))
+        core_queue = context.Queue()
+        for cores in core_sets:
+            core_queue.put(cores)
+        logger.info(f"Evaluating {len(group)} checkpoints with {len(core_sets)} workers on the cores {core_sets}")
+        with resources.track("evaluation"):
+            with context.Pool(len(core_sets), initializer=_init_worker, initargs=(core_queue,)) as pool:
+                for checkpoint, evaluation in pool.imap_unordered(_evaluate_checkpoint, group):
+                    logger.info(f"{checkpoint}: {evaluation}")
+                    evaluations[checkpoint] = evaluation
+        _worker_state.clear()
+
+    rows = [result_row(args, train_args[c], evaluations[c], tables) for c in checkpoints if evaluations.get(c)]
+    results = pd.DataFrame(rows, columns=RESULT_COLUMNS)
+    output_file = output_file or os.path.join(checkpoints_dir, "checkpoint_results.csv")
+    results.to_csv(output_file, index=False)
+    # the raw evaluations, keyed by checkpoint, which the table does not record
+    with open(os.path.splitext(output_file)[0] + ".json", "w") as f:
+        json.dump(evaluations, f, indent=2)
+    logger.info(f"Wrote the results of {len(rows)} checkpoints to {output_file}")
+    return results
@@ -39,6 +39,13 @@ def parse():
     parser.add_argument("--aug_type", type=str, default=None, choices=["random","contextual","back_translation"])
     parser.add_argument("--aug_pipeline", type=ast.literal_eval)
     parser.add_argument("--layer_mapping_strategy", default='skip', choices=["skip", "first", "last"])
+    parser.add_argument("--student_init_from_teacher", action="store_true",
+                        help="initialize the student (S_config_file) from the embeddings, the teacher layers selected "
+                             "by layer_mapping_strategy and the head of the teacher")
+    parser.add_argument("--student_init_truncate", action="store_true",
+                        help="copy the leading slice of teacher weights wider than the student ones (e.g. fewer heads)")
+    parser.add_argument("--student_init_cache_dir", type=str, default=None,
+                        help="directory of the cached initialized students, defaults to data_dir")
     parser.add_argument("--random_student", action="store_true", help="If true, the student model will initiate "
                                                                       "randomly")
     parser.add_argument("--eval_all_checkpoints", action="store_true",
@@ -78,6 +85,89 @@ def parse():
     parser.add_argument("--weight_decay", default=0.1, type=float,
                         help="Weight decay if we apply some.")
     parser.add_argument("--repeated_aug", default=1, type=int)
+    parser.add_argument("--tensor_aug", nargs="+", default=[], choices=["mask", "disorder", "delete"],
+                        help="Token level augmentations applied to the tokenized batches when repeated_aug > 1, "
+                             "replacing the text augmentation pipeline")
+    parser.add_argument("--tensor_aug_p", default=0.1, type=float, help="probability to perturb each token")
+    parser.add_argument("--predictor_top_k", default=0, type=int,
+                        help="If > 0, only the k candidates ranked best by the distillation outcome predictor are "
+                             "trained by auto_distiller_exp.py")
+    parser.add_argument("--autodistiller_data_dir", default="../autodistiller_experiments", type=str,
+                        help="directory of the AutoDistiller tables the outcome predictor is trained on")
+    parser.add_argument("--descriptor_encoder", default="prajjwal1/bert-tiny", type=str,
+                        help="encoder used to describe tasks missing from the descriptor table of the predictor")
+    parser.add_argument("--descriptor_glue_dir", default="../datasets/glue_data", type=str,
+                        help="GLUE data directory the training tasks of the predictor are read from, to describe "
+                             "them with --descriptor_encoder as well when the task is missing from the table")
+    parser.add_argument("--descriptor_cache_dir", default="./descriptor_cache", type=str,
+                        help="directory of the cached task descriptors")
+    parser.add_argument("--successive_halving", action="store_true",
+                        help="search the candidates of auto_distiller_exp.py with successive halving instead of "
+                             "training all of them to completion")
+    parser.add_argument("--sh_min_steps", default=500, type=int, help="training steps of the first rung")
+    parser.add_argument("--sh_max_steps", default=-1, type=int,
+                        help="training steps of the last rung, defaults to sh_min_steps * sh_eta^2")
+    parser.add_argument("--sh_eta", default=3, type=int,
+                        help="only the best 1/sh_eta candidates of a rung are promoted to the next one")
+    parser.add_argument("--pbt", action="store_true",
+                        help="search temperature, kd_loss_weight, alpha, learning rate and aug_p with population based "
+                             "training in ray_directory/run.py (requires --max_steps)")
+    parser.add_argument("--pbt_population", default=4, type=int, help="number of trials of the population")
+    parser.add_argument("--pbt_interval", default=200, type=int,
+                        help="training steps between two checkpoints (and possible perturbations) of a trial")
+    parser.add_argument("--ray_local_cpus", default=0, type=int,
+                        help="If > 0, starts a local ray instance with this number of cpus instead of joining a cluster")
+    parser.add_argument("--trial_time_budget", default=0, type=float,
+                        help="If > 0, wall clock budget (in seconds) of every sweep trial. Trials projected to exceed "
+                             "it are terminated")
+    parser.add_argument("--sweep_objective", default="score", choices=["score", "budget"],
+                        help="rank sweep trials by dev score, or by dev score scaled down when over the time budget")
+    parser.add_argument("--prune_heads", default=[0.25, 0.5], type=float, nargs="+",
+                        help="fraction of the attention heads of the student removed after every pruning stage")
+    parser.add_argument("--prune_ffn", default=[0.25, 0.5], type=float, nargs="+",
+                        help="fraction of the FFN neurons of the student removed after every pruning stage")
+    parser.add_argument("--prune_steps", default=1000, type=int,
+                        help="distillation steps after every pruning stage")
+    parser.add_argument("--prune_importance_batches", default=32, type=int,
+                        help="number of training batches the head and neuron importance is estimated on")
+    parser.add_argument("--early_exit_steps", default=1000, type=int,
+                        help="training steps of the exit classifiers of an early exit student")
+    parser.add_argument("--early_exit_thresholds", default=[0.9, 0.95, 0.99], type=float, nargs="+",
+                        help="exit thresholds the early exit student is evaluated at")
+    parser.add_argument("--early_exit_criterion", default="confidence", choices=["confidence", "entropy"],
+                        help="exit once the maximum class probability is above, or the entropy below, the threshold")
+    parser.add_argument("--pack_sequences", action="store_true",
+                        help="pack several short GLUE training examples into every max_seq_length row (bert, electra "
+                             "and roberta classifiers, distiller.py and auto_distiller_exp.py only)")
+    parser.add_argument("--pack_max_segments", default=8, type=int, help="maximum number of examples per packed row")
+    parser.add_argument("--eval_checkpoints_dir", type=str, default=None,
+                        help="directory searched (recursively) for the checkpoints evaluated by evaluate_checkpoints.py")
+    parser.add_argument("--eval_workers", default=4, type=int, help="number of CPU processes evaluating checkpoints")
+    parser.add_argument("--eval_memory_budget", default=0, type=float,
+                        help="If > 0, memory (in GB) the checkpoint evaluation workers may use, fewer workers are "
+                             "started when the checkpoints are too large for it")
+    parser.add_argument("--compress_predictions", action="store_true",
+                        help="gzip the prediction, n-best and null odds files written at evaluation")
+    parser.add_argument("--blockwise_attention", action="store_true",
+                        help="compute the attention (and nst) distillation losses over blocks of query rows from the "
+                             "captured queries and keys, without keeping the attention maps of every layer")
+    parser.add_argument("--attention_block_size", default=64, type=int, help="query rows per block of the blockwise losses")
+    parser.add_argument("--compile_objective", action="store_true",
+                        help="compute the KD and intermediate losses with graphs traced once per input shape "
+                             "(textbrewer/compiled_objective.py), eagerly for the shapes beyond the traced ones")
+    parser.add_argument("--cpu_resources", action="store_true",
+                        help="pin the trainer and the augmentation process to disjoint core sets and size their thread "
+                             "and worker pools to them (resources.py), utilisation is logged to cpu_usage.jsonl")
+    parser.add_argument("--augmentation_cores", default=0, type=int,
+                        help="cores of the augmentation process with --cpu_resources, 0 for a quarter of the cores")
+    parser.add_argument("--interop_threads", default=1, type=int,
+                        help="torch inter-op threads of every process with --cpu_resources")
+    parser.add_argument("--replay_log", default=None, type=str,
+                        help="binary log of the example indices, augmented data and mixup parameters of every step, "
+                             "written by the run (textbrewer/replay.py)")
+    parser.add_argument("--replay", action="store_true",
+                        help="train on the batches recorded in --replay_log instead of recording them, "
+                             "without running the augmentation process")
     parser.add_argument("--do_lower_case", default=False, action="store_true")
     parser.add_argument("--adam_epsilon", default=1e-8, type=float,
                         help="Epsilon for Adam optimizer.")
@@ -97,6 +187,8 @@ def parse():
     parser.add_argument("--local_rank", default=-1, type=int, help="local_rank for distributed training on gpus")
 
     args = parser.parse_args()
+    if args.tensor_aug and args.repeated_aug <= 1:
+        parser.error("--tensor_aug perturbs repeated copies of the batches, it requires --repeated_aug > 1")
     return args
 
 if __name__ == "__main__":
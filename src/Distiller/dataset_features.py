@@ -0,0 +1,264 @@
+import os
+import json
+import hashlib
+import argparse
+import numpy as np
+import torch
+from tqdm import tqdm
+from .transformers import AutoTokenizer, AutoModel
+from .utils import Logger
+# Task descriptors used by the distillation outcome predictor (see autodistiller.py): the mean and the standard
+# deviation of the projected sentence embeddings of a training set, followed by #example and #label, in the format of
+# autodistiller_experiments/dataset_features_50_concat.csv. The rows of that table were computed by another pipeline,
+# so a task described here is only comparable with training tasks described by the same extractor, see
+# describe_training_tasks.
+
+logger = Logger("all.log",level="debug").logger
+
+# directories of the training tasks of the predictor in a GLUE data directory, as laid out by ray_directory/run.py
+TASK_DIRS = {"mnli": "MNLI", "qqp": "QQP", "qnli": "QNLI", "sst-2": "SST-2", "cola": "CoLA", "mrpc": "MRPC",
+             "rte": "RTE", "stsb": "STS-B", "cloth": "CLOTH", "boolq": "BOOLQ"}
+
+
+def read_task_examples(task_type, task_name, data_dir, mode="train"):
+    """
+    Reads the examples of a task with the same readers as the training scripts. GLUE examples are read lazily from
+    the example store (see :mod:`~Distiller.example_store`), so describing a task does not hold its texts in memory.
+    Returns:
+        (examples, num_labels): examples is a sequence of InputExample or SquadExample
+    """
+    if task_type == "glue":
+        from .glue_preprocess import glue_processors, glue_output_modes
+        processor = glue_processors[task_name]()
+        examples = processor.get_dev_examples(data_dir) if mode == "dev" else processor.get_train_examples(data_dir)
+        num_labels = 1 if glue_output_modes[task_name] == "regression" else len(processor.get_labels())
+    elif task_type in ["squad", "squad2"]:
+        from .squad_preprocess import read_examples_from_file
+        examples = read_examples_from_file(data_dir, mode, task_type)
+        # span extraction has a single output head, as cloth in the descriptor table
+        num_labels = 1
+    else:
+        raise NotImplementedError(f"No example reader for task type {task_type}")
+    return examples, num_labels
+
+
+def example_fields(example):
+    """(text_a, text_b, label) of an InputExample or a SquadExample."""
+    if hasattr(example, "question_text"):
+        return example.question_text, example.context_text, example.answer_text
+    return example.text_a, example.text_b, example.label
+
+
+def source_files_key(task_type, task_name, data_dir, mode="train"):
+    """
+    Key of the data files of a split: path, size and modification time of the files of `data_dir` named after
+    `mode` (e.g. train.tsv, train-v1.1.json), with the task and the split. None when there is no such file (e.g.
+    the datasets downloaded by BoolQProcessor), the content hash is the only key then.
+    """
+    if data_dir is None or not os.path.isdir(data_dir):
+        return None
+    files = []
+    for name in sorted(os.listdir(data_dir)):
+        path = os.path.join(data_dir, name)
+        if name.startswith(mode) and os.path.isfile(path):
+            stat = os.stat(path)
+            files.append([os.path.abspath(path), stat.st_size, stat.st_mtime_ns])
+    if not files:
+        return None
+    return json.dumps([task_type, task_name, mode, files])
+
+
+def dataset_content_hash(examples):
+    """sha1 of the texts and labels of a dataset, it changes whenever the data does."""
+    sha1 = hashlib.sha1()
+    for example in examples:
+        sha1.update(json.dumps(example_fields(example)).encode("utf-8"))
+    return sha1.hexdigest()
+
+
+class DatasetFeatureExtractor:
+    """
+    Computes task descriptors with a small encoder on CPU. The sentence embeddings (mean pooled last hidden states)
+    are projected to `dim` dimensions by a fixed random matrix, the descriptor is the concatenation of their mean and
+    standard deviation (2 * `dim` values). Descriptors are cached in `cache_dir`, keyed by the extractor settings and
+    the path, size and modification time of the data files, or the content hash of the dataset when these changed
+    (e.g. a copy of the data), so a task is only encoded once.
+
+    Descriptors of different encoders are not comparable: the tasks the predictor is trained on must be described
+    by the same extractor settings as the new task (see :func:`describe_training_tasks`).
+
+    Args:
+        encoder_name_or_path (str): encoder model name or path.
+        dim (int): size of the projected embeddings.
+        max_examples (int): number of examples encoded, evenly spread over the dataset. None encodes all of them.
+        max_length (int): maximum sequence length of the encoder.
+        batch_size (int): encoding batch size.
+        cache_dir (str): directory of the cached descriptors, None disables the cache.
+        seed (int): seed of the projection matrix.
+        device: device of the encoder.
+    """
+    def __init__(self, encoder_name_or_path="prajjwal1/bert-tiny", dim=50, max_examples=20000, max_length=128,
+                 batch_size=64, cache_dir=None, seed=0, device="cpu"):
+        self.encoder_name_or_path = encoder_name_or_path
+        self.dim = dim
+        self.max_examples = max_examples
+        self.max_length = max_length
+        self.batch_size = batch_size
+        self.cache_dir = cache_dir
+        self.seed = seed
+        self.device = torch.device(device)
+        self._encoder = None
+        self._tokenizer = None
+        self._projection = None
+
+    def _load_encoder(self):
+        if self._encoder is None:
+            self._tokenizer = AutoTokenizer.from_pretrained(self.encoder_name_or_path, use_fast=True)
+            self._encoder = AutoModel.from_pretrained(self.encoder_name_or_path).to(self.device).eval()
+            generator = torch.Generator().manual_seed(self.seed)
+            hidden_size = self._encoder.config.hidden_size
+            self._projection = (torch.randn(hidden_size, self.dim, generator=generator) / self.dim ** 0.5).to(self.device)
+
+    def settings_key(self):
+        return f"{self.encoder_name_or_path}|{self.dim}|{self.max_examples}|{self.max_length}|{self.seed}"
+
+    def _cache_file(self, data_key):
+        key = hashlib.sha1(f"{data_key}|{self.settings_key()}".encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, f"descriptor_{key[:16]}.json")
+
+    def _load_cached(self, data_key):
+        if self.cache_dir is None or data_key is None:
+            return None
+        cache_file = self._cache_file(data_key)
+        if not os.path.exists(cache_file):
+            return None
+        with open(cache_file) as f:
+            return json.load(f)
+
+    def _save_cached(self, data_key, cached):
+        cache_file = self._cache_file(data_key)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(cache_file + ".tmp", "w") as f:
+            json.dump(cached, f)
+        os.replace(cache_file + ".tmp", cache_file)
+        return cache_file
+
+    def _subsample(self, num_examples):
+        if self.max_examples is None or num_examples <= self.max_examples:
+            return np.arange(num_examples)
+        return np.linspace(0, num_examples - 1, self.max_examples).astype(int)
+
+    @torch.no_grad()
+    def embed(self, examples, indices):
+        """Returns the sum and the sum of squares of the projected embeddings of ``examples[indices]``, and their number."""
+        self._load_encoder()
+        total = torch.zeros(self.dim, dtype=torch.float64)
+        total_sq = torch.zeros(self.dim, dtype=torch.float64)
+        for start in tqdm(range(0, len(indices), self.batch_size), desc="Encoding dataset"):
+            # only the texts of the current batch are read from the examples
+            texts = [example_fields(examples[i])[:2] for i in indices[start:start + self.batch_size]]
+            text_a, text_b = zip(*texts)
+            text_b = None if all(t is None for t in text_b) else [t or "" for t in text_b]
+            inputs = self._tokenizer(list(text_a), text_b, max_length=self.max_length, truncation=True,
+                                     padding=True, return_tensors="pt").to(self.device)
+            hidden = self._encoder(**inputs)[0]
+            mask = inputs["attention_mask"].unsqueeze(-1).type_as(hidden)
+            embeddings = ((hidden * mask).sum(1) / mask.sum(1)) @ self._projection
+            embeddings = embeddings.double().cpu()
+            total += embeddings.sum(0)
+            total_sq += (embeddings ** 2).sum(0)
+        return total, total_sq, len(indices)
+
+    def describe(self, task, examples, num_labels, source_key=None):
+        """
+        Returns the descriptor of a dataset (a sequence of examples) as a dict with the columns of
+        `dataset_features_50_concat.csv`: ``task``, ``"0"`` ... ``str(2 * dim - 1)``, ``#example`` and ``#label``.
+        The descriptor is also cached under `source_key` (see :func:`source_files_key`) when it is given.
+        """
+        content_hash = dataset_content_hash(examples)
+        cached = self._load_cached(content_hash)
+        if cached is not None:
+            logger.info(f"Loaded the descriptor of {task} from {self._cache_file(content_hash)}")
+        else:
+            total, total_sq, count = self.embed(examples, self._subsample(len(examples)))
+            mean = total / count
+            std = (total_sq / count - mean ** 2).clamp(min=0).sqrt()
+            values = torch.cat([mean, std]).tolist()
+            descriptor = {str(i): value for i, value in enumerate(values)}
+            descriptor["#example"] = len(examples)
+            descriptor["#label"] = num_labels
+            cached = {"content_hash": content_hash, "settings": self.settings_key(), "descriptor": descriptor}
+            if self.cache_dir is not None:
+                logger.info(f"Saved the descriptor of {task} to {self._save_cached(content_hash, cached)}")
+        if self.cache_dir is not None and source_key is not None:
+            self._save_cached(source_key, cached)
+        return {"task": task, **cached["descriptor"]}
+
+    def describe_task(self, task_type, task_name, data_dir, mode="train"):
+        # the cheap key of the data files is tried first, the examples are only read and hashed when it misses
+        source_key = source_files_key(task_type, task_name, data_dir, mode)
+        cached = self._load_cached(source_key)
+        if cached is not None:
+            logger.info(f"Loaded the descriptor of {task_name} from {self._cache_file(source_key)}")
+            return {"task": task_name, **cached["descriptor"]}
+        examples, num_labels = read_task_examples(task_type, task_name, data_dir, mode)
+        return self.describe(task_name, examples, num_labels, source_key=source_key)
+
+
+def describe_training_tasks(extractor, tasks, glue_data_dir):
+    """
+    Descriptors of the training tasks of the predictor computed by `extractor`, so that they are comparable with the
+    descriptor of a new task computed by the same extractor. The data of every task is read from its directory of
+    :data:`TASK_DIRS` in `glue_data_dir`, tasks whose data cannot be read are skipped.
+
+    Returns:
+        list of descriptors, see :meth:`DatasetFeatureExtractor.describe`
+    """
+    descriptors = []
+    for task in tasks:
+        data_dir = os.path.join(glue_data_dir, TASK_DIRS.get(task, task.upper()))
+        try:
+            descriptors.append(extractor.describe_task("glue", task, data_dir))
+        except (OSError, KeyError) as e:
+            logger.warning(f"Cannot describe the training task {task} from {data_dir}, it is left out: {e!r}")
+    return descriptors
+
+
+def update_descriptor_table(descriptors, table_file):
+    """Adds (or replaces) the rows of `descriptors` in a csv in the format of `dataset_features_50_concat.csv`."""
+    import pandas as pd
+    rows = pd.DataFrame(descriptors)
+    if os.path.exists(table_file):
+        table = pd.read_csv(table_file)
+        table = pd.concat([table[~table["task"].isin(rows["task"])], rows], ignore_index=True)
+    else:
+        table = rows
+    table.to_csv(table_file, index=False)
+    return table
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compute the task descriptor of a dataset")
+    parser.add_argument("--task_type", type=str, required=True, choices=["glue", "squad", "squad2"])
+    parser.add_argument("--task_name", type=str, required=True)
+    parser.add_argument("--data_dir", type=str, required=True)
+    parser.add_argument("--encoder", type=str, default="prajjwal1/bert-tiny", help="encoder model name or path")
+    parser.add_argument("--dim", type=int, default=50, help="the descriptor has 2 * dim dimensions")
+    parser.add_argument("--max_examples", type=int, default=20000)
+    parser.add_argument("--cache_dir", type=str, default="./descriptor_cache")
+    parser.add_argument("--glue_data_dir", type=str, default=None,
+                        help="if set, the training tasks of the predictor are described too, from their directories "
+                             "in this GLUE data directory")
+    parser.add_argument("--output", type=str, default=None,
+                        help="descriptor table (csv) the rows of the tasks are written to")
+    args = parser.parse_args()
+    extractor = DatasetFeatureExtractor(args.encoder, dim=args.dim, max_examples=args.max_examples,
+                                        cache_dir=args.cache_dir)
+    descriptor = extractor.describe_task(args.task_type, args.task_name, args.data_dir)
+    descriptors = [descriptor]
+    if args.glue_data_dir is not None:
+        tasks = [task for task in TASK_DIRS if task != args.task_name]
+        descriptors = describe_training_tasks(extractor, tasks, args.glue_data_dir) + descriptors
+    if args.output is not None:
+        update_descriptor_table(descriptors, args.output)
+    logger.info(f"{args.task_name}: #example={descriptor['#example']} #label={descriptor['#label']}")
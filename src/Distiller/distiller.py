@@ -9,6 +9,7 @@ import numpy as np
 from .configs import parse
 from .autoaug import AutoAugmenter
 from .utils import Logger, cal_layer_mapping
+from .student_init import init_student_from_teacher
 from .mp_aug import aug_process
 from .transformers import AutoConfig, AutoTokenizer
 from .transformers import AutoModelForSequenceClassification, AutoModelForQuestionAnswering
@@ -213,7 +214,12 @@ def main(args):
     t_model = model_class.from_pretrained(args.T_model_name_or_path, config=t_config)
     ## If the student borrow layers from teachers, it must borrow complete layers. Their hidden size and attention size
     # must be the same
-    if args.random_student:
+    if args.student_init_from_teacher:
+        # copy the embeddings, the mapped teacher layers and the head into the student (cached)
+        s_model = init_student_from_teacher(t_model, s_config, args.layer_mapping_strategy,
+                                            truncate=args.student_init_truncate,
+                                            cache_dir=args.student_init_cache_dir or args.data_dir)
+    elif args.random_student:
         s_model = model_class.from_config(s_config)
     else:
         s_model = model_class.from_pretrained(args.S_model_name_or_path, config=s_config)
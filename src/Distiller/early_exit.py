@@ -0,0 +1,78 @@
+import torch
+from tqdm import tqdm
+from .modeling import SequenceClassificationModel, exit_distillation_loss
+from .transformers import AdamW, get_linear_schedule_with_warmup
+from .utils import Logger
+# Early exit students: the exit classifiers of a SequenceClassificationModel are distilled from the teacher logits
+# once the student itself is distilled, the encoder and the final classifier are left untouched.
+
+logger = Logger("all.log",level="debug").logger
+
+
+def train_exit_classifiers(model, t_model, dataloader, device, num_steps=1000, learning_rate=1e-3, warmup_proportion=0.1,
+                           kd_loss_type="ce", temperature=1, hard_label_weight=0.0):
+    """
+    Trains the exit classifiers of `model` to match the logits of `t_model`.
+
+    Args:
+        model (SequenceClassificationModel): student with exit classifiers.
+        t_model: teacher, its outputs have ``logits``.
+        dataloader: training batches, dicts of inputs or ``{'teacher': ..., 'student': ...}`` dicts.
+        kd_loss_type (str), temperature (float): KD loss of :data:`~textbrewer.presets.KD_LOSS_MAP` and its temperature.
+        hard_label_weight (float): weight of the cross entropy of the exits with the labels.
+    """
+    assert isinstance(model, SequenceClassificationModel) and model.exit_classifiers is not None
+    for name, param in model.named_parameters():
+        param.requires_grad = name.startswith("exit_classifiers.")
+    optimizer = AdamW(model.exit_classifiers.parameters(), lr=learning_rate)
+    scheduler = get_linear_schedule_with_warmup(optimizer, int(num_steps * warmup_proportion), num_steps)
+    model.train()
+    t_model.eval()
+    step = 0
+    with tqdm(total=num_steps, desc="Exit classifiers") as progress:
+        while step < num_steps:
+            for batch in dataloader:
+                if 'teacher' in batch:
+                    teacher_batch, student_batch = batch['teacher'], batch['student']
+                else:
+                    teacher_batch = student_batch = batch
+                teacher_batch = {key: value.to(device) for key, value in teacher_batch.items()}
+                student_batch = {key: value.to(device) for key, value in student_batch.items()}
+                with torch.no_grad():
+                    teacher_logits = t_model(**teacher_batch).logits
+                labels = student_batch.pop('labels', None)
+                exit_logits = model(**student_batch).exit_logits
+                loss = exit_distillation_loss(exit_logits, teacher_logits, kd_loss_type, temperature)
+                if hard_label_weight > 0 and labels is not None and model.num_labels > 1:
+                    loss = loss + hard_label_weight * sum(torch.nn.functional.cross_entropy(logits, labels)
+                                                          for logits in exit_logits) / len(exit_logits)
+                loss.backward()
+                optimizer.step()
+                scheduler.step()
+                optimizer.zero_grad()
+                step += 1
+                progress.update(1)
+                if step % 100 == 0:
+                    logger.info(f"Exit classifiers step {step}: loss {loss.item():.4f}")
+                if step >= num_steps:
+                    break
+    for param in model.parameters():
+        param.requires_grad = True
+    model.eval()
+    return model
+
+
+def evaluate_exit_thresholds(evaluate_fn, model, thresholds, criterion="confidence"):
+    """
+    Evaluates `model` at every exit threshold. `evaluate_fn(model)` returns the metrics of the model, e.g.
+    :func:`Distiller.evaluate.evaluate_glue`, which adds the average number of layers run (``avg_layers``).
+    """
+    results = []
+    for threshold in [None] + list(thresholds):
+        model.set_early_exit(threshold, criterion)
+        result = evaluate_fn(model)
+        result.update({"exit_threshold": threshold, "exit_criterion": criterion})
+        logger.info(f"Exit threshold {threshold}: {result}")
+        results.append(result)
+    model.set_early_exit(None)
+    return results
@@ -1,19 +1,41 @@
 from tqdm import tqdm
 import os
+import copy
+import collections
 import numpy as np
 import torch
 from .squad_preprocess import SquadResult
 from torch.utils.data import DataLoader, SequentialSampler
-from .utils import write_predictions_squad, get_raw_scores, apply_no_ans_threshold, make_eval_dict, merge_eval, find_all_best_thresh_v2
+from .utils import write_predictions_squad
 import argparse
 import logging
 from .glue_preprocess import glue_compute_metrics
+from .squad_scoring import squad_evaluate_predictions
+from .feature_arrays import feature_column
 logger = logging.getLogger(__name__ )
 
 
-def evaluate_squad(args, model, tokenizer, prefix="",write_prediction=False):
+_squad_eval_cache = {}
+
+
+def squad_eval_data(args, tokenizer):
+    """
+    Dev dataset, features and examples of a squad style task, loaded once per task, tokenizer and feature parameters
+    and then reused by every evaluation of the run (and by the workers of :mod:`Distiller.batch_evaluate`).
+    """
     from .squad_preprocess import load_and_cache_examples
-    dataset, s_dataset, features, s_features, examples = load_and_cache_examples(args, tokenizer, mode="dev", return_examples=True)
+    key = (args.task_type, args.data_dir, tokenizer.name_or_path, args.max_seq_length, args.doc_stride,
+           args.max_query_length)
+    if key not in _squad_eval_cache:
+        dataset, s_dataset, features, s_features, examples = load_and_cache_examples(args, tokenizer, mode="dev",
+                                                                                     return_examples=True)
+        _squad_eval_cache.clear()
+        _squad_eval_cache[key] = (dataset, features, examples)
+    return _squad_eval_cache[key]
+
+
+def evaluate_squad(args, model, tokenizer, prefix="",write_prediction=False):
+    dataset, features, examples = squad_eval_data(args, tokenizer)
 
     if not os.path.exists(args.output_dir) and args.local_rank in [-1, 0]:
         os.makedirs(args.output_dir)
@@ -39,6 +61,8 @@ def evaluate_squad(args, model, tokenizer, prefix="",write_prediction=False):
     logger.info("  Batch size = %d", args.eval_batch_size)
 
     all_results = []
+    # read the ids from the unique_id column instead of building every feature
+    unique_ids = feature_column(features, "unique_id")
 
     for batch in tqdm(eval_dataloader, desc="Evaluating"):
         model.eval()
@@ -68,8 +92,7 @@ def evaluate_squad(args, model, tokenizer, prefix="",write_prediction=False):
         batch_start_logits = outputs.start_logits.detach().cpu().tolist()
         batch_end_logits = outputs.end_logits.detach().cpu().tolist()
         for i, feature_index in enumerate(feature_indices):
-            eval_feature = features[feature_index.item()]
-            unique_id = int(eval_feature.unique_id)
+            unique_id = int(unique_ids[feature_index.item()])
 
             # output = [output[i].detach().cpu().tolist() for output in outputs.to_tuple()]
             start_logits= batch_start_logits[i]
@@ -112,104 +135,83 @@ def _squad_evaluate(args, tokenizer, eval_examples, eval_features, all_results,
                                                True, output_prediction_file,
                                                output_nbest_file, output_null_log_odds_file,
                                                version_2_with_negative,
-                                               args.null_score_diff_threshold, write_prediction=write_prediction)
-    qas_id_to_has_answer = {example.qas_id: bool(example.answers) for example in eval_examples}
-    has_answer_qids = [qas_id for qas_id, has_answer in qas_id_to_has_answer.items() if has_answer]
-    no_answer_qids = [qas_id for qas_id, has_answer in qas_id_to_has_answer.items() if not has_answer]
-
-    if no_answer_probs is None:
-        no_answer_probs = {k: 0.0 for k in all_predictions}
-
-    exact, f1 = get_raw_scores(eval_examples, all_predictions)
+                                               args.null_score_diff_threshold, write_prediction=write_prediction,
+                                               compress=getattr(args, "compress_predictions", False))
+    # array based scoring, same numbers as get_raw_scores, apply_no_ans_threshold, make_eval_dict and
+    # find_all_best_thresh_v2
+    evaluation = squad_evaluate_predictions(eval_examples, all_predictions, no_answer_probs,
+                                            no_answer_probability_threshold)
+    return evaluation
 
-    exact_threshold = apply_no_ans_threshold(
-        exact, no_answer_probs, qas_id_to_has_answer, no_answer_probability_threshold
-    )
-    f1_threshold = apply_no_ans_threshold(f1, no_answer_probs, qas_id_to_has_answer, no_answer_probability_threshold)
 
-    evaluation = make_eval_dict(exact_threshold, f1_threshold)
+_glue_eval_cache = {}
 
-    if has_answer_qids:
-        has_ans_eval = make_eval_dict(exact_threshold, f1_threshold, qid_list=has_answer_qids)
-        merge_eval(evaluation, has_ans_eval, "HasAns")
 
-    if no_answer_qids:
-        no_ans_eval = make_eval_dict(exact_threshold, f1_threshold, qid_list=no_answer_qids)
-        merge_eval(evaluation, no_ans_eval, "NoAns")
+def glue_eval_tensors(args, tokenizer):
+    """
+    Dev splits of a GLUE task (matched and mismatched for MNLI) as tensors resident on `args.device`, concatenated
+    into one set of inputs. They are loaded once per task, tokenizer and sequence length, and then reused by every
+    evaluation of the run.
 
-    if no_answer_probs:
-        find_all_best_thresh_v2(evaluation, all_predictions, exact, f1, no_answer_probs, qas_id_to_has_answer)
-    return evaluation
+    Returns:
+        (inputs, splits): a dict of tensors, and the (task_name, start, end) rows of every split
+    """
+    from .glue_preprocess import load_and_cache_examples
+    key = (args.task_name, args.data_dir, tokenizer.name_or_path, args.max_seq_length, str(args.device))
+    if key not in _glue_eval_cache:
+        task_names = [args.task_name, 'mnli-mm'] if args.task_name == 'mnli' else [args.task_name]
+        tensors, splits, start = collections.defaultdict(list), [], 0
+        for task_name in task_names:
+            split_args = copy.copy(args)
+            split_args.task_name = task_name
+            dataset = load_and_cache_examples(split_args, tokenizer, mode="dev")
+            tensors['input_ids'].append(dataset.all_input_ids)
+            tensors['attention_mask'].append(dataset.all_attention_masks)
+            tensors['token_type_ids'].append(dataset.all_token_type_ids)
+            tensors['labels'].append(dataset.all_labels)
+            splits.append((task_name, start, start + len(dataset)))
+            start += len(dataset)
+        inputs = {k: torch.cat(v).to(args.device) for k, v in tensors.items()}
+        _glue_eval_cache.clear()
+        _glue_eval_cache[key] = (inputs, splits)
+    return _glue_eval_cache[key]
 
 
 def evaluate_glue(args, model, tokenizer, prefix="",write_prediction=False):
-    from .glue_preprocess import load_and_cache_examples
-    dataset, s_dataset, features, s_features, examples = load_and_cache_examples(args, tokenizer, mode="dev",
-                                                                                 return_examples=True)
     if not os.path.exists(args.output_dir) and args.local_rank in [-1, 0]:
         os.makedirs(args.output_dir)
-
+    inputs, splits = glue_eval_tensors(args, tokenizer)
     args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
-    # Note that DistributedSampler samples randomly
-    eval_sampler = SequentialSampler(dataset)
-    eval_dataloader = DataLoader(dataset, sampler=eval_sampler, batch_size=args.eval_batch_size)
-    # if args.task_name is not None:
-    #     metric = load_metric("glue", args.task_name)
+    regression = args.task_name in ["stsb","cloth"]
+    # one pass over all the splits, predictions stay on the device until the end
     preds = []
-    label_list = []
+    exit_layers = []
     model.eval()
-    for step, batch in enumerate(eval_dataloader):
-
-        # labels = batch['labels']
-        # batch = tuple(t.to(args.device) for t in batch)
-        batch = {key: value.to(args.device) for key, value in batch.items()}
-        with torch.no_grad():
+    with torch.no_grad():
+        for start in range(0, inputs['input_ids'].size(0), args.eval_batch_size):
+            batch = {key: value[start:start + args.eval_batch_size] for key, value in inputs.items()}
             outputs = model(**batch)
-        # outputs = model(**batch)
-        predictions = outputs.logits.detach().cpu()
-        if args.task_name not in ["stsb","cloth"]:
-            predictions = predictions.argmax(dim=-1)
+            if getattr(outputs, "exit_layers", None) is not None:
+                exit_layers.append(outputs.exit_layers)
+            preds.append(outputs.logits[:, 0] if regression else outputs.logits.argmax(dim=-1))
+    preds = torch.cat(preds)
+    preds = (preds.double() if regression else preds).cpu().numpy()
+    labels = inputs['labels']
+    labels = (labels.double() if labels.is_floating_point() else labels).cpu().numpy()
+    exit_layers = torch.cat(exit_layers).cpu().numpy() if exit_layers else None
+
+    eval_metric = {}
+    for task_name, start, end in splits:
+        split_metric = glue_compute_metrics(task_name, preds[start:end], labels[start:end])
+        if task_name == 'mnli-mm':
+            eval_metric['mnli-mm/acc'] = split_metric['mnli-mm/acc']
+            eval_metric['m_mm_acc'] = (eval_metric['mnli/acc'] + eval_metric['mnli-mm/acc'])/2
         else:
-            predictions = predictions[:,0]
-        label_list.extend(batch['labels'].cpu().tolist())
-        preds.extend(predictions.tolist())
-
-    # eval_metric_compute = metric.compute()
-    eval_metric = glue_compute_metrics(args.task_name,np.array(preds), np.array(label_list))
-    if args.task_name == 'mnli':
-        # new_args = args.copy()
-        args.task_name = 'mnli-mm'
-        dataset, s_dataset, features, s_features, examples = load_and_cache_examples(args, tokenizer, mode="dev",
-                                                                                     return_examples=True)
-
-        if not os.path.exists(args.output_dir) and args.local_rank in [-1, 0]:
-            os.makedirs(args.output_dir)
-
-        args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
-        # Note that DistributedSampler samples randomly
-        eval_sampler = SequentialSampler(dataset)
-        eval_dataloader = DataLoader(dataset, sampler=eval_sampler, batch_size=args.eval_batch_size)
-        # if args.task_name is not None:
-        #     metric = load_metric("glue", args.task_name)
-        preds = []
-        label_list = []
-
-        for step, batch in enumerate(eval_dataloader):
-            # labels = batch['labels']
-            # batch = tuple(t.to(args.device) for t in batch)
-            batch = {key: value.to(args.device) for key, value in batch.items()}
-            with torch.no_grad():
-                outputs = model(**batch)
-            # outputs = model(**batch)
-            predictions = outputs.logits.detach().cpu().argmax(dim=-1)
-            label_list.extend(batch['labels'].cpu().tolist())
-            preds.extend(predictions.tolist())
-
-        # eval_metric_compute = metric.compute()
-        mm_eval_metric = glue_compute_metrics(args.task_name, np.array(preds), np.array(label_list))
-        eval_metric['mnli-mm/acc'] = mm_eval_metric['mnli-mm/acc']
-        eval_metric['m_mm_acc'] = (eval_metric['mnli/acc'] + eval_metric['mnli-mm/acc'])/2
-        args.task_name='mnli'
+            eval_metric.update(split_metric)
+        if exit_layers is not None:
+            # early exit students (see SequenceClassificationModel) report the number of layers they ran
+            eval_metric['mnli-mm/avg_layers' if task_name == 'mnli-mm' else 'avg_layers'] = \
+                float(np.mean(exit_layers[start:end]))
     logger.info(f"step {prefix}: {eval_metric}")
     return eval_metric
 
@@ -0,0 +1,145 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+from collections.abc import Sequence
+from .utils import Logger
+# Columnar store of parsed GLUE examples. A split is parsed once (csv reader / pandas and InputExample construction),
+# then its guid, text_a and text_b columns are saved as one utf-8 buffer plus offsets each, and its labels as codes
+# into the list of distinct labels. Later runs memory-map the columns and only build the examples they access.
+
+logger = Logger("all.log",level="debug").logger
+
+STORE_VERSION = 1
+TEXT_COLUMNS = ("guid", "text_a", "text_b")
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """sha1 of the content of `path`."""
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def _storable(examples):
+    for example in examples:
+        for name in TEXT_COLUMNS:
+            value = getattr(example, name)
+            if value is not None and not isinstance(value, str):
+                return False
+        if example.label is not None and not isinstance(example.label, (str, int, float)):
+            return False
+    return True
+
+
+def _write_text_column(directory, name, values):
+    encoded = [b"" if value is None else value.encode("utf-8") for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    np.save(os.path.join(directory, f"{name}.data.npy"), np.frombuffer(b"".join(encoded), dtype=np.uint8))
+    np.save(os.path.join(directory, f"{name}.offsets.npy"), offsets)
+    np.save(os.path.join(directory, f"{name}.null.npy"), np.array([value is None for value in values], dtype=bool))
+
+
+class _TextColumn:
+    def __init__(self, directory, name):
+        self.data = np.load(os.path.join(directory, f"{name}.data.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(directory, f"{name}.offsets.npy"), mmap_mode="r")
+        self.null = np.load(os.path.join(directory, f"{name}.null.npy"), mmap_mode="r")
+
+    def __getitem__(self, index):
+        if self.null[index]:
+            return None
+        return self.data[self.offsets[index]:self.offsets[index + 1]].tobytes().decode("utf-8")
+
+
+class ExampleStore(Sequence):
+    """
+    Read only sequence of the :class:`~Distiller.glue_preprocess.InputExample` of a split, materialized on access from
+    the memory-mapped columns of `directory`. Every access builds a new example, slices return lists.
+
+    Args:
+        directory (str): directory written by :meth:`ExampleStore.write`.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+        self.label_values = meta["labels"]
+        self.columns = {name: _TextColumn(directory, name) for name in TEXT_COLUMNS}
+        self.label_codes = np.load(os.path.join(directory, "label.codes.npy"), mmap_mode="r")
+
+    @staticmethod
+    def write(directory, examples):
+        """Saves the columns of `examples` to `directory`."""
+        os.makedirs(directory)
+        for name in TEXT_COLUMNS:
+            _write_text_column(directory, name, [getattr(example, name) for example in examples])
+        codes = {}
+        for example in examples:
+            codes.setdefault((type(example.label).__name__, example.label), len(codes))
+        label_values = [label for _, label in codes]
+        np.save(os.path.join(directory, "label.codes.npy"),
+                np.array([codes[(type(example.label).__name__, example.label)] for example in examples], dtype=np.int32))
+        with open(os.path.join(directory, "meta.json"), "w") as f:
+            json.dump({"version": STORE_VERSION, "size": len(examples), "labels": label_values}, f)
+
+    def __len__(self):
+        return len(self.label_codes)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("example index out of range")
+        from .glue_preprocess import InputExample
+        return InputExample(guid=self.columns["guid"][index], text_a=self.columns["text_a"][index],
+                            text_b=self.columns["text_b"][index], label=self.label_values[self.label_codes[index]])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __reduce__(self):
+        # processes receiving the examples (e.g. the augmentation pool) map the same files
+        return ExampleStore, (self.directory,)
+
+
+def cached_examples(input_file, name, parse_fn, cache_dir=None):
+    """
+    Examples of `input_file`: read from the store keyed by the content hash of the file, or parsed by `parse_fn` and
+    saved to a new store. Examples the store cannot hold (e.g. NaN texts read by pandas) are returned as parsed.
+
+    Args:
+        input_file (str): the file `parse_fn` reads.
+        name (str): what the examples are, e.g. the processor and split, part of the store key.
+        parse_fn: function returning the list of examples.
+        cache_dir (str): where the stores are kept, defaults to a ``cached_examples`` directory next to the file.
+    """
+    cache_dir = cache_dir or os.path.join(os.path.dirname(os.path.abspath(input_file)), "cached_examples")
+    directory = os.path.join(cache_dir, f"{os.path.basename(input_file)}_{name}_{file_hash(input_file)[:16]}"
+                                        f"_v{STORE_VERSION}")
+    if os.path.exists(os.path.join(directory, "meta.json")):
+        logger.info(f"Loading examples of {input_file} from {directory}")
+        return ExampleStore(directory)
+    examples = parse_fn()
+    if not _storable(examples):
+        logger.info(f"Examples of {input_file} have non text fields, they are not stored")
+        return examples
+    # written to a temporary directory first, so that concurrent processes never read a partial store
+    tmp_directory = f"{directory}.tmp{os.getpid()}"
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        ExampleStore.write(tmp_directory, examples)
+        os.rename(tmp_directory, directory)
+        logger.info(f"Saved {len(examples)} examples of {input_file} to {directory}")
+    except OSError as e:
+        # another process saved the store first, or the data directory is read only
+        logger.info(f"Examples of {input_file} not stored: {e}")
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+    return examples
@@ -0,0 +1,144 @@
+import numpy as np
+# Columnar containers of the features of a data set. Every field is one contiguous numpy array: 2D arrays for the padded
+# token level fields, flat values plus per feature offsets for the ragged ones (tokens, token_to_orig_map,
+# token_is_max_context), instead of one python object with lists and dicts per feature. They take a fraction of the
+# memory of the lists of features and are pickled (torch.save / torch.load of the feature caches) as a few buffers.
+# Indexing or iterating builds the usual feature objects, so the code reading features attribute by attribute
+# (write_predictions_squad, PackedDataset, ...) works unchanged.
+
+
+class RaggedArray:
+    """Rows of different lengths: row ``i`` is ``values[offsets[i]:offsets[i + 1]]``."""
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = offsets
+
+    @classmethod
+    def from_lists(cls, rows, dtype):
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum([len(row) for row in rows], out=offsets[1:])
+        values = np.fromiter((value for row in rows for value in row), dtype=dtype, count=int(offsets[-1]))
+        return cls(values, offsets)
+
+    def __getitem__(self, index):
+        return self.values[self.offsets[index]:self.offsets[index + 1]]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+def _padded(rows, dtype):
+    """2D array of equal length rows, or None when the field is not set."""
+    if rows and rows[0] is None:
+        return None
+    return np.array(rows, dtype=dtype)
+
+
+class FeatureArrays:
+    """Base class of the containers: a read only sequence of features."""
+
+    def __len__(self):
+        raise NotImplementedError()
+
+    def feature(self, index):
+        """Builds feature ``index``."""
+        raise NotImplementedError()
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.feature(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("feature index out of range")
+        return self.feature(index)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.feature(i)
+
+
+class GlueFeatureArrays(FeatureArrays):
+    """
+    Features of a GLUE data set, see :class:`~Distiller.glue_preprocess.InputFeatures`. Integer labels are stored as
+    int64 and the regression ones as float32, the dtypes ``torch.tensor`` gives to the python labels.
+    """
+    def __init__(self, features):
+        self.input_ids = _padded([f.input_ids for f in features], np.int32)
+        self.attention_mask = _padded([f.attention_mask for f in features], np.int8)
+        self.token_type_ids = _padded([f.token_type_ids for f in features], np.int8)
+        labels = [f.label for f in features]
+        if any(label is None for label in labels):
+            self.label = None
+        else:
+            self.label = np.array(labels, dtype=np.float32 if any(isinstance(l, float) for l in labels) else np.int64)
+
+    def __len__(self):
+        return len(self.input_ids)
+
+    def feature(self, index):
+        from .glue_preprocess import InputFeatures
+        return InputFeatures(input_ids=self.input_ids[index].tolist(),
+                             attention_mask=None if self.attention_mask is None else self.attention_mask[index].tolist(),
+                             token_type_ids=None if self.token_type_ids is None else self.token_type_ids[index].tolist(),
+                             label=None if self.label is None else self.label[index].item())
+
+
+class SquadFeatureArrays(FeatureArrays):
+    """
+    Features of a squad style data set, see :class:`~Distiller.squad_preprocess.InputFeatures`. The tokens are stored
+    as ids into the list of distinct tokens. The ``encoding`` of fast tokenizers is not kept.
+    """
+    def __init__(self, features):
+        self.input_ids = _padded([f.input_ids for f in features], np.int32)
+        self.attention_mask = _padded([f.attention_mask for f in features], np.int8)
+        self.token_type_ids = _padded([f.token_type_ids for f in features], np.int8)
+        self.p_mask = _padded([f.p_mask for f in features], np.int8)
+        for name in ["cls_index", "example_index", "unique_id", "paragraph_len", "start_position", "end_position"]:
+            setattr(self, name, np.array([getattr(f, name) for f in features], dtype=np.int64))
+        self.is_impossible = np.array([f.is_impossible for f in features], dtype=bool)
+        self.qas_id = [f.qas_id for f in features]
+        token_ids = {}
+        self.tokens = RaggedArray.from_lists(
+            [[token_ids.setdefault(token, len(token_ids)) for token in f.tokens] for f in features], np.int32)
+        self.token_vocab = list(token_ids)
+        self.orig_map_keys = RaggedArray.from_lists([list(f.token_to_orig_map) for f in features], np.int32)
+        self.orig_map_values = np.fromiter((v for f in features for v in f.token_to_orig_map.values()), dtype=np.int32,
+                                           count=len(self.orig_map_keys.values))
+        self.max_context_keys = RaggedArray.from_lists([list(f.token_is_max_context) for f in features], np.int32)
+        self.max_context_values = np.fromiter((v for f in features for v in f.token_is_max_context.values()),
+                                              dtype=bool, count=len(self.max_context_keys.values))
+
+    def __len__(self):
+        return len(self.unique_id)
+
+    def feature(self, index):
+        from .squad_preprocess import InputFeatures
+        orig_map = slice(self.orig_map_keys.offsets[index], self.orig_map_keys.offsets[index + 1])
+        max_context = slice(self.max_context_keys.offsets[index], self.max_context_keys.offsets[index + 1])
+        return InputFeatures(
+            input_ids=self.input_ids[index].tolist(),
+            attention_mask=self.attention_mask[index].tolist(),
+            token_type_ids=self.token_type_ids[index].tolist(),
+            cls_index=int(self.cls_index[index]),
+            p_mask=self.p_mask[index].tolist(),
+            example_index=int(self.example_index[index]),
+            unique_id=int(self.unique_id[index]),
+            paragraph_len=int(self.paragraph_len[index]),
+            token_is_max_context=dict(zip(self.max_context_keys.values[max_context].tolist(),
+                                          self.max_context_values[max_context].tolist())),
+            tokens=[self.token_vocab[t] for t in self.tokens[index].tolist()],
+            token_to_orig_map=dict(zip(self.orig_map_keys.values[orig_map].tolist(),
+                                       self.orig_map_values[orig_map].tolist())),
+            start_position=int(self.start_position[index]),
+            end_position=int(self.end_position[index]),
+            is_impossible=bool(self.is_impossible[index]),
+            qas_id=self.qas_id[index],
+        )
+
+
+def feature_column(features, name):
+    """Field `name` of all the features: the array of a :class:`FeatureArrays`, a list for a list of features."""
+    if isinstance(features, FeatureArrays):
+        return getattr(features, name)
+    return [getattr(f, name) for f in features]
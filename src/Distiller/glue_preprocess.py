@@ -27,6 +27,8 @@ from tqdm import tqdm
 from typing import List, Optional, Union
 from .transformers import PreTrainedTokenizer
 from .utils import Logger
+from .example_store import cached_examples
+from .feature_arrays import GlueFeatureArrays, feature_column
 from torch.utils.data import Dataset, DataLoader, RandomSampler, SequentialSampler, TensorDataset, ConcatDataset
 from torch.utils.data.distributed import DistributedSampler
 from scipy.stats import pearsonr, spearmanr
@@ -177,6 +179,17 @@ class DataProcessor:
         with open(input_file, "r", encoding="utf-8-sig") as f:
             return list(csv.reader(f, delimiter="\t", quotechar=quotechar))
 
+    def _cached_examples(self, input_file, set_type):
+        """
+        Examples of `input_file` created by :meth:`_create_examples`. The file is parsed once, then the examples are
+        read lazily from a memory-mapped store (see :func:`~Distiller.example_store.cached_examples`). ``.csv`` files
+        are read with pandas, the other files as tab separated values.
+        """
+        def parse():
+            lines = pd.read_csv(input_file) if input_file.endswith(".csv") else self._read_tsv(input_file)
+            return self._create_examples(lines, set_type)
+        return cached_examples(input_file, f"{self.__class__.__name__}_{set_type}", parse)
+
 
 class Processor:
     def __init__(self, args, tokenizer, task, max_length, s_tokenizer=None):
@@ -389,7 +402,11 @@ class Processor:
         return features
 
 
-def load_and_cache_examples(args, tokenizer, mode, return_examples=False, s_tokenizer=None):
+def load_and_cache_examples(args, tokenizer, mode, return_examples=False, s_tokenizer=None, pack=False):
+    """
+    Features and dataset of a split. With `pack`, the training set is a :class:`~Distiller.packing.PackedDataset`, for
+    models wrapped in :class:`~Distiller.packing.PackedSequenceClassifier`.
+    """
     s_dataset = None
     s_features = None
     s_cached_features_file = None
@@ -416,11 +433,14 @@ def load_and_cache_examples(args, tokenizer, mode, return_examples=False, s_toke
     if os.path.exists(cached_features_file) and not args.overwrite_cache:
         logger.info("Loading features from cached file %s", cached_features_file)
         features = torch.load(cached_features_file)
-        ## This place need to be more flexible
+        if not isinstance(features, GlueFeatureArrays):
+            # cache written as a list of features
+            features = GlueFeatureArrays(features)
     else:
         logger.info("Creating features from dataset file at %s", args.data_dir)
         features = convert_examples_to_features(examples, tokenizer, task=args.task_name, max_length=args.max_seq_length,
                                                 label_list=processor.get_labels(), output_mode=glue_output_modes[args.task_name])
+        features = GlueFeatureArrays(features)
         if args.local_rank in [-1, 0]:
             logger.info("Saving features into cached file %s", cached_features_file)
             torch.save(features, cached_features_file)
@@ -429,15 +449,24 @@ def load_and_cache_examples(args, tokenizer, mode, return_examples=False, s_toke
         if os.path.exists(s_cached_features_file) and not args.overwrite_cache:
             logger.info("Loading student features from cached file %s", s_cached_features_file)
             s_features = torch.load(s_cached_features_file)
+            if not isinstance(s_features, GlueFeatureArrays):
+                s_features = GlueFeatureArrays(s_features)
         else:
             logger.info("Creating student features from dataset file at %s", args.data_dir)
             s_features = convert_examples_to_features(examples, s_tokenizer, task=args.task_name, max_length=args.max_seq_length,
                                                     label_list=processor.get_labels(), output_mode=glue_output_modes[args.task_name])
+            s_features = GlueFeatureArrays(s_features)
             if args.local_rank in [-1, 0]:
                 logger.info("Saving student features into cached file %s", s_cached_features_file)
                 torch.save(s_features, s_cached_features_file)
         # s_dataset = convert_features_to_dataset(s_features, is_training=(mode == 'train'))
-    dataset = convert_features_to_dataset(features, s_features, is_testing=(mode == 'test'))
+    if mode == "train" and pack:
+        # several short examples per row instead of one padded example, see packing.py
+        from .packing import PackedDataset
+        dataset = PackedDataset(features, s_features, max_length=args.max_seq_length,
+                                max_segments=args.pack_max_segments)
+    else:
+        dataset = convert_features_to_dataset(features, s_features, is_testing=(mode == 'test'))
     # torch.save(dataset, 'dataset.bin')
     # torch.save(s_dataset, 's_dataset.bin')
     # torch.save(features, 'features.bin')
@@ -465,17 +494,17 @@ def convert_features_to_dataset(features, s_features=None, is_testing=False):
     s_all_input_ids = None
     s_all_attention_masks = None
     s_all_token_type_ids = None
-    all_input_ids = torch.tensor([f.input_ids for f in features], dtype=torch.long)
-    all_attention_masks = torch.tensor([f.attention_mask for f in features], dtype=torch.long)
-    all_token_type_ids = torch.tensor([f.token_type_ids for f in features], dtype=torch.long)
+    all_input_ids = torch.tensor(feature_column(features, "input_ids"), dtype=torch.long)
+    all_attention_masks = torch.tensor(feature_column(features, "attention_mask"), dtype=torch.long)
+    all_token_type_ids = torch.tensor(feature_column(features, "token_type_ids"), dtype=torch.long)
     if s_features:
-        s_all_input_ids = torch.tensor([f.input_ids for f in s_features], dtype=torch.long)
-        s_all_attention_masks = torch.tensor([f.attention_mask for f in s_features], dtype=torch.long)
-        s_all_token_type_ids = torch.tensor([f.token_type_ids for f in s_features], dtype=torch.long)
+        s_all_input_ids = torch.tensor(feature_column(s_features, "input_ids"), dtype=torch.long)
+        s_all_attention_masks = torch.tensor(feature_column(s_features, "attention_mask"), dtype=torch.long)
+        s_all_token_type_ids = torch.tensor(feature_column(s_features, "token_type_ids"), dtype=torch.long)
     if is_testing:
         all_labels = torch.LongTensor([1] * len(features))
     else:
-        all_labels = torch.tensor([f.label for f in features])
+        all_labels = torch.tensor(feature_column(features, "label"))
     return MyDataset(all_input_ids, all_attention_masks, all_token_type_ids, all_labels, s_all_input_ids, s_all_attention_masks, s_all_token_type_ids)
     # if is_training:
     #     return MyDataset(all_input_ids, all_attention_masks, all_token_type_ids, all_labels)
@@ -587,15 +616,15 @@ class MrpcProcessor(DataProcessor):
     def get_train_examples(self, data_dir):
         """See base class."""
         logger.info(f"LOOKING AT {os.path.join(data_dir, 'train.tsv')}")
-        return self._create_examples(self._read_tsv(os.path.join(data_dir, "train.tsv")), "train")
+        return self._cached_examples(os.path.join(data_dir, "train.tsv"), "train")
 
     def get_dev_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(self._read_tsv(os.path.join(data_dir, "dev.tsv")), "dev")
+        return self._cached_examples(os.path.join(data_dir, "dev.tsv"), "dev")
 
     def get_test_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(self._read_tsv(os.path.join(data_dir, "test.tsv")), "test")
+        return self._cached_examples(os.path.join(data_dir, "test.tsv"), "test")
 
     def get_labels(self):
         """See base class."""
@@ -632,15 +661,15 @@ class MnliProcessor(DataProcessor):
 
     def get_train_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(self._read_tsv(os.path.join(data_dir, "train.tsv")), "train")
+        return self._cached_examples(os.path.join(data_dir, "train.tsv"), "train")
 
     def get_dev_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(self._read_tsv(os.path.join(data_dir, "dev_matched.tsv")), "dev_matched")
+        return self._cached_examples(os.path.join(data_dir, "dev_matched.tsv"), "dev_matched")
 
     def get_test_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(self._read_tsv(os.path.join(data_dir, "test_matched.tsv")), "test_matched")
+        return self._cached_examples(os.path.join(data_dir, "test_matched.tsv"), "test_matched")
 
     def get_labels(self):
         """See base class."""
@@ -668,11 +697,11 @@ class MnliMismatchedProcessor(MnliProcessor):
 
     def get_dev_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(self._read_tsv(os.path.join(data_dir, "dev_mismatched.tsv")), "dev_mismatched")
+        return self._cached_examples(os.path.join(data_dir, "dev_mismatched.tsv"), "dev_mismatched")
 
     def get_test_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(self._read_tsv(os.path.join(data_dir, "test_mismatched.tsv")), "test_mismatched")
+        return self._cached_examples(os.path.join(data_dir, "test_mismatched.tsv"), "test_mismatched")
 
 
 class ColaProcessor(DataProcessor):
@@ -692,15 +721,15 @@ class ColaProcessor(DataProcessor):
 
     def get_train_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(self._read_tsv(os.path.join(data_dir, "train.tsv")), "train")
+        return self._cached_examples(os.path.join(data_dir, "train.tsv"), "train")
 
     def get_dev_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(self._read_tsv(os.path.join(data_dir, "dev.tsv")), "dev")
+        return self._cached_examples(os.path.join(data_dir, "dev.tsv"), "dev")
 
     def get_test_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(self._read_tsv(os.path.join(data_dir, "test.tsv")), "test")
+        return self._cached_examples(os.path.join(data_dir, "test.tsv"), "test")
 
     def get_labels(self):
         """See base class."""
@@ -738,15 +767,15 @@ class Sst2Processor(DataProcessor):
 
     def get_train_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(self._read_tsv(os.path.join(data_dir, "train.tsv")), "train")
+        return self._cached_examples(os.path.join(data_dir, "train.tsv"), "train")
 
     def get_dev_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(self._read_tsv(os.path.join(data_dir, "dev.tsv")), "dev")
+        return self._cached_examples(os.path.join(data_dir, "dev.tsv"), "dev")
 
     def get_test_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(self._read_tsv(os.path.join(data_dir, "test.tsv")), "test")
+        return self._cached_examples(os.path.join(data_dir, "test.tsv"), "test")
 
     def get_labels(self):
         """See base class."""
@@ -783,15 +812,15 @@ class FakeProcessor(DataProcessor):
 
     def get_train_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(pd.read_csv(os.path.join(data_dir, "train.csv")), "train")
+        return self._cached_examples(os.path.join(data_dir, "train.csv"), "train")
 
     def get_dev_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(pd.read_csv(os.path.join(data_dir, "dev.csv")), "dev")
+        return self._cached_examples(os.path.join(data_dir, "dev.csv"), "dev")
 
     def get_test_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(pd.read_csv(os.path.join(data_dir, "dev.csv")), "dev")
+        return self._cached_examples(os.path.join(data_dir, "dev.csv"), "dev")
 
     def get_labels(self):
         """See base class."""
@@ -825,15 +854,15 @@ class ProdProcessor(DataProcessor):
 
     def get_train_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(pd.read_csv(os.path.join(data_dir, "train.csv")), "train")
+        return self._cached_examples(os.path.join(data_dir, "train.csv"), "train")
 
     def get_dev_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(pd.read_csv(os.path.join(data_dir, "dev.csv")), "dev")
+        return self._cached_examples(os.path.join(data_dir, "dev.csv"), "dev")
 
     def get_test_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(pd.read_csv(os.path.join(data_dir, "dev.csv")), "dev")
+        return self._cached_examples(os.path.join(data_dir, "dev.csv"), "dev")
 
     def get_labels(self):
         """See base class."""
@@ -867,15 +896,15 @@ class ClothProcessor(DataProcessor):
 
     def get_train_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(pd.read_csv(os.path.join(data_dir, "train.csv")), "train")
+        return self._cached_examples(os.path.join(data_dir, "train.csv"), "train")
 
     def get_dev_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(pd.read_csv(os.path.join(data_dir, "dev.csv")), "dev")
+        return self._cached_examples(os.path.join(data_dir, "dev.csv"), "dev")
 
     def get_test_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(pd.read_csv(os.path.join(data_dir, "dev.csv")), "dev")
+        return self._cached_examples(os.path.join(data_dir, "dev.csv"), "dev")
 
     def get_labels(self):
         """See base class."""
@@ -908,15 +937,15 @@ class KaggleProcessor(DataProcessor):
 
     def get_train_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(pd.read_csv(os.path.join(data_dir, "Train.csv")), "train")
+        return self._cached_examples(os.path.join(data_dir, "Train.csv"), "train")
 
     def get_dev_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(pd.read_csv(os.path.join(data_dir, "Dev.csv")), "dev")
+        return self._cached_examples(os.path.join(data_dir, "Dev.csv"), "dev")
 
     def get_test_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(pd.read_csv(os.path.join(data_dir, "Test.csv")), "test")
+        return self._cached_examples(os.path.join(data_dir, "Test.csv"), "test")
 
     def get_labels(self):
         """See base class."""
@@ -949,15 +978,15 @@ class StsbProcessor(DataProcessor):
 
     def get_train_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(self._read_tsv(os.path.join(data_dir, "train.tsv")), "train")
+        return self._cached_examples(os.path.join(data_dir, "train.tsv"), "train")
 
     def get_dev_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(self._read_tsv(os.path.join(data_dir, "dev.tsv")), "dev")
+        return self._cached_examples(os.path.join(data_dir, "dev.tsv"), "dev")
 
     def get_test_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(self._read_tsv(os.path.join(data_dir, "test.tsv")), "test")
+        return self._cached_examples(os.path.join(data_dir, "test.tsv"), "test")
 
     def get_labels(self):
         """See base class."""
@@ -994,15 +1023,15 @@ class QqpProcessor(DataProcessor):
 
     def get_train_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(self._read_tsv(os.path.join(data_dir, "train.tsv")), "train")
+        return self._cached_examples(os.path.join(data_dir, "train.tsv"), "train")
 
     def get_dev_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(self._read_tsv(os.path.join(data_dir, "dev.tsv")), "dev")
+        return self._cached_examples(os.path.join(data_dir, "dev.tsv"), "dev")
 
     def get_test_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(self._read_tsv(os.path.join(data_dir, "test.tsv")), "test")
+        return self._cached_examples(os.path.join(data_dir, "test.tsv"), "test")
 
     def get_labels(self):
         """See base class."""
@@ -1045,15 +1074,15 @@ class QnliProcessor(DataProcessor):
 
     def get_train_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(self._read_tsv(os.path.join(data_dir, "train.tsv")), "train")
+        return self._cached_examples(os.path.join(data_dir, "train.tsv"), "train")
 
     def get_dev_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(self._read_tsv(os.path.join(data_dir, "dev.tsv")), "dev")
+        return self._cached_examples(os.path.join(data_dir, "dev.tsv"), "dev")
 
     def get_test_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(self._read_tsv(os.path.join(data_dir, "test.tsv")), "test")
+        return self._cached_examples(os.path.join(data_dir, "test.tsv"), "test")
 
     def get_labels(self):
         """See base class."""
@@ -1090,15 +1119,15 @@ class RteProcessor(DataProcessor):
 
     def get_train_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(self._read_tsv(os.path.join(data_dir, "train.tsv")), "train")
+        return self._cached_examples(os.path.join(data_dir, "train.tsv"), "train")
 
     def get_dev_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(self._read_tsv(os.path.join(data_dir, "dev.tsv")), "dev")
+        return self._cached_examples(os.path.join(data_dir, "dev.tsv"), "dev")
 
     def get_test_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(self._read_tsv(os.path.join(data_dir, "test.tsv")), "test")
+        return self._cached_examples(os.path.join(data_dir, "test.tsv"), "test")
 
     def get_labels(self):
         """See base class."""
@@ -1181,15 +1210,15 @@ class WnliProcessor(DataProcessor):
 
     def get_train_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(self._read_tsv(os.path.join(data_dir, "train.tsv")), "train")
+        return self._cached_examples(os.path.join(data_dir, "train.tsv"), "train")
 
     def get_dev_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(self._read_tsv(os.path.join(data_dir, "dev.tsv")), "dev")
+        return self._cached_examples(os.path.join(data_dir, "dev.tsv"), "dev")
 
     def get_test_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(self._read_tsv(os.path.join(data_dir, "test.tsv")), "test")
+        return self._cached_examples(os.path.join(data_dir, "test.tsv"), "test")
 
     def get_labels(self):
         """See base class."""
@@ -1,6 +1,9 @@
 import torch
-from transformers.activations import ACT2FN, get_activation
-from transformers.modeling_outputs import QuestionAnsweringModelOutput,SequenceClassifierOutput
+from dataclasses import dataclass
+from typing import Optional, Tuple
+from .transformers.activations import ACT2FN, get_activation
+from .transformers.modeling_outputs import QuestionAnsweringModelOutput,SequenceClassifierOutput
+from .textbrewer.presets import KD_LOSS_MAP
 import torch
 import torch.nn as nn
 import torch.utils.checkpoint
@@ -45,12 +48,57 @@ class ElectraClassificationHead(nn.Module):
         return x
 
 
+class ExitClassifier(nn.Module):
+    """Lightweight classifier on the first token of an intermediate layer, used to exit early."""
+
+    def __init__(self, config):
+        super().__init__()
+        self.dropout = nn.Dropout(config.hidden_dropout_prob)
+        self.classifier = nn.Linear(config.hidden_size, config.num_labels)
+
+    def forward(self, hidden_states):
+        return self.classifier(self.dropout(hidden_states[:, 0, :]))
+
+
+@dataclass
+class EarlyExitClassifierOutput(SequenceClassifierOutput):
+    """
+    Output of :class:`SequenceClassificationModel` with exit classifiers.
+
+    Args:
+        exit_logits (:obj:`tuple(torch.FloatTensor)`): logits of the exit classifier of every layer but the last one,
+            only returned when all the layers are run.
+        exit_layers (:obj:`torch.LongTensor` of shape :obj:`(batch_size,)`): number of layers run for every example.
+    """
+    exit_logits: Optional[Tuple[torch.FloatTensor]] = None
+    exit_layers: Optional[torch.LongTensor] = None
+
+
 def cross_entropy(input, target):
     logsoftmax = nn.LogSoftmax(dim=-1)
     return torch.mean(torch.sum(- target * logsoftmax(input), 1))
 
+
+def exit_distillation_loss(exit_logits, teacher_logits, kd_loss_type="ce", temperature=1):
+    """Mean of the KD losses (see :data:`~textbrewer.presets.KD_LOSS_MAP`) between every exit and the teacher."""
+    kd_loss = KD_LOSS_MAP[kd_loss_type]
+    return sum(kd_loss(logits, teacher_logits, temperature) for logits in exit_logits) / len(exit_logits)
+
+
 class SequenceClassificationModel(torch.nn.Module):
-    def __init__(self, model, config):
+    """
+    Sequence classifier on top of a BERT or ELECTRA encoder.
+
+    With `early_exit`, every layer but the last one gets an :class:`ExitClassifier`. They are trained by
+    distillation (see :func:`exit_distillation_loss`) and, once a threshold is set with :meth:`set_early_exit`, an
+    example leaves the encoder at the first layer whose classifier is confident enough in eval mode.
+
+    Args:
+        model: the encoder, e.g. a ``BertModel``.
+        config: config of the encoder, with ``num_labels``.
+        early_exit (bool): whether to add the exit classifiers.
+    """
+    def __init__(self, model, config, early_exit=False):
         super().__init__()
         self.num_labels = config.num_labels
         self.model = model
@@ -63,8 +111,85 @@ class SequenceClassificationModel(torch.nn.Module):
             self.dropout = nn.Dropout(config.hidden_dropout_prob)
         else:
             raise NotImplementedError
+        self.exit_classifiers = nn.ModuleList([ExitClassifier(config) for _ in range(config.num_hidden_layers - 1)]) \
+            if early_exit else None
+        self.exit_threshold = None
+        self.exit_criterion = "confidence"
         self.init_weights()
 
+    def init_weights(self):
+        heads = [self.classifier] + ([self.exit_classifiers] if self.exit_classifiers is not None else [])
+        for head in heads:
+            head.apply(self.model._init_weights)
+
+    @classmethod
+    def from_classifier(cls, classifier_model, early_exit=True):
+        """Wraps a trained ``BertForSequenceClassification`` or ``ElectraForSequenceClassification``."""
+        model = cls(classifier_model.base_model, classifier_model.config, early_exit=early_exit)
+        model.classifier.load_state_dict(classifier_model.classifier.state_dict())
+        return model
+
+    def set_early_exit(self, threshold=None, criterion="confidence"):
+        """
+        Args:
+            threshold (float): an example exits at the first layer whose maximum class probability is at least
+                `threshold` (``"confidence"``) or whose prediction entropy is at most `threshold` (``"entropy"``).
+                None runs all the layers.
+            criterion (str): ``"confidence"`` or ``"entropy"``.
+        """
+        assert criterion in ["confidence", "entropy"]
+        assert threshold is None or self.exit_classifiers is not None, "the model has no exit classifiers"
+        self.exit_threshold = threshold
+        self.exit_criterion = criterion
+
+    def _can_exit(self, logits):
+        if self.num_labels == 1:
+            # no confidence for regression, the examples run all the layers
+            return torch.zeros(logits.size(0), dtype=torch.bool, device=logits.device)
+        probs = logits.softmax(dim=-1)
+        if self.exit_criterion == "confidence":
+            return probs.max(dim=-1).values >= self.exit_threshold
+        entropy = -(probs * probs.clamp(min=1e-12).log()).sum(dim=-1)
+        return entropy <= self.exit_threshold
+
+    def _final_logits(self, sequence_output):
+        if 'electra' in self.model_type:
+            return self.classifier(sequence_output)
+        return self.classifier(self.dropout(self.model.pooler(sequence_output)))
+
+    def _early_exit_forward(self, input_ids=None, attention_mask=None, token_type_ids=None, position_ids=None,
+                            inputs_embeds=None):
+        """Runs the encoder layer by layer, only on the examples which did not exit yet."""
+        input_shape = input_ids.size() if input_ids is not None else inputs_embeds.size()[:-1]
+        device = input_ids.device if input_ids is not None else inputs_embeds.device
+        if attention_mask is None:
+            attention_mask = torch.ones(input_shape, device=device)
+        if token_type_ids is None:
+            token_type_ids = torch.zeros(input_shape, dtype=torch.long, device=device)
+        hidden_states = self.model.embeddings(input_ids=input_ids, position_ids=position_ids,
+                                              token_type_ids=token_type_ids, inputs_embeds=inputs_embeds)
+        if hasattr(self.model, "embeddings_project"):
+            hidden_states = self.model.embeddings_project(hidden_states)
+        extended_attention_mask = self.model.get_extended_attention_mask(attention_mask, input_shape, device)
+        layers = self.model.encoder.layer
+        logits = hidden_states.new_zeros(input_shape[0], self.num_labels)
+        exit_layers = torch.full((input_shape[0],), len(layers), dtype=torch.long, device=device)
+        active = torch.arange(input_shape[0], device=device)
+        for i, layer in enumerate(layers):
+            hidden_states = layer(hidden_states, extended_attention_mask)[0]
+            if i == len(layers) - 1:
+                logits[active] = self._final_logits(hidden_states)
+                break
+            exit_logits = self.exit_classifiers[i](hidden_states)
+            done = self._can_exit(exit_logits)
+            logits[active[done]] = exit_logits[done]
+            exit_layers[active[done]] = i + 1
+            active, hidden_states = active[~done], hidden_states[~done]
+            extended_attention_mask = extended_attention_mask[~done]
+            if active.numel() == 0:
+                break
+        return logits, exit_layers
+
     def forward(
         self,
         input_ids=None,
@@ -87,6 +212,16 @@ class SequenceClassificationModel(torch.nn.Module):
             If :obj:`config.num_labels > 1` a classification loss is computed (Cross-Entropy).
         """
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
+        if self.exit_threshold is not None and not self.training:
+            logits, exit_layers = self._early_exit_forward(input_ids, attention_mask, token_type_ids, position_ids,
+                                                           inputs_embeds)
+            loss = None
+            if labels is not None:
+                loss = MSELoss()(logits.view(-1), labels.view(-1)) if self.num_labels == 1 else \
+                    CrossEntropyLoss()(logits.view(-1, self.num_labels), labels.view(-1))
+            return EarlyExitClassifierOutput(loss=loss, logits=logits, exit_layers=exit_layers)
+        output_hidden_states = output_hidden_states if output_hidden_states is not None \
+            else self.config.output_hidden_states
         outputs = self.model(
             input_ids,
             attention_mask=attention_mask,
@@ -95,8 +230,8 @@ class SequenceClassificationModel(torch.nn.Module):
             head_mask=head_mask,
             inputs_embeds=inputs_embeds,
             output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
-            return_dict=return_dict,
+            output_hidden_states=output_hidden_states or self.exit_classifiers is not None,
+            return_dict=True,
         )
         if 'electra' in self.model_type:
             sequence_output = outputs[0]
@@ -106,6 +241,11 @@ class SequenceClassificationModel(torch.nn.Module):
         else:
             raise NotImplementedError
         logits = self.classifier(sequence_output)
+        exit_logits = None
+        if self.exit_classifiers is not None:
+            # hidden_states[0] is the embedding output and the last layer uses the main classifier
+            exit_logits = tuple(exit_classifier(hidden_states) for exit_classifier, hidden_states
+                                in zip(self.exit_classifiers, outputs.hidden_states[1:-1]))
 
         loss = None
         if labels is not None:
@@ -129,14 +269,29 @@ class SequenceClassificationModel(torch.nn.Module):
                 # loss_fct = CrossEntropyLoss()
                 # loss = loss_fct(logits.view(-1, self.num_labels), labels.view(-1))
 
+        hidden_states = outputs.hidden_states if output_hidden_states else None
         if not return_dict:
-            output = (logits,) + outputs[1:]
+            # the layout of the encoder tuple the caller asked for: without the hidden states only computed for the
+            # exit classifiers
+            base_outputs = tuple(value for name, value in outputs.items()
+                                 if name != "hidden_states" or output_hidden_states)
+            output = (logits,) + base_outputs[1:]
             return ((loss,) + output) if loss is not None else output
 
+        if self.exit_classifiers is not None:
+            return EarlyExitClassifierOutput(
+                loss=loss,
+                logits=logits,
+                hidden_states=hidden_states,
+                attentions=outputs.attentions,
+                exit_logits=exit_logits,
+                exit_layers=torch.full((logits.size(0),), self.config.num_hidden_layers, dtype=torch.long,
+                                       device=logits.device),
+            )
         return SequenceClassifierOutput(
             loss=loss,
             logits=logits,
-            hidden_states=outputs.hidden_states,
+            hidden_states=hidden_states,
             attentions=outputs.attentions,
         )
 
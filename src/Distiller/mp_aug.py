@@ -2,6 +2,8 @@ import torch
 from torch.multiprocessing import cpu_count, Pool, Queue, Manager
 from tqdm import tqdm
 from torch.utils.data import ConcatDataset
+from .resources import ResourceManager
+import contextlib
 import time
 
 def example_iter(examples, batch_size):
@@ -159,9 +161,14 @@ def generate_aug_data(examples, original_dataset, augmenter, args, tokenizer, s_
         return original_dataset
 
 def aug_process(rank, queue:Queue, examples, original_dataset, augmenter, args, tokenizer, s_tokenizer=None):
+    resources = None
+    if getattr(args, "cpu_resources", False):
+        resources = ResourceManager.from_args(args)
+        resources.apply("augmentation")
     while True:
         if queue.empty():
-            new_dataset = generate_aug_data(examples, original_dataset, augmenter, args, tokenizer, s_tokenizer)
+            with resources.track("augmentation") if resources else contextlib.nullcontext():
+                new_dataset = generate_aug_data(examples, original_dataset, augmenter, args, tokenizer, s_tokenizer)
             queue.put(new_dataset)
         else:
             time.sleep(10)
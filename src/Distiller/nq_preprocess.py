@@ -0,0 +1,259 @@
+import os
+import gzip
+import json
+import zlib
+import torch
+from multiprocessing import Pool
+from tqdm import tqdm
+from .utils import Logger
+from .resources import pool_size
+from .squad_preprocess import Example, convert_examples_to_features, squad_convert_example_to_features_init
+# Streaming preprocessing for NaturalQuestions. The gzip JSONL shards are decoded line by line, every example is
+# simplified to a squad style Example and the features are written chunk by chunk to an on-disk feature store, so
+# the whole pipeline runs in constant memory and can resume after an interruption.
+
+logger = Logger("all.log",level="debug").logger
+
+MANIFEST_NAME = "manifest.json"
+
+
+def _is_html_token(token):
+    return token.startswith("<") and token.endswith(">")
+
+
+def _document_tokens(entry):
+    """Returns the list of (token, is_html) of a simplified or an original NaturalQuestions entry."""
+    if "document_text" in entry:
+        return [(t, _is_html_token(t)) for t in entry["document_text"].split(" ")]
+    return [(t["token"], t["html_token"]) for t in entry["document_tokens"]]
+
+
+def _span_text(tokens, start, end):
+    """Joins the non html tokens in [start, end) and returns the text with the char offset of every kept token."""
+    words = []
+    offsets = {}
+    length = 0
+    for i in range(start, end):
+        token, is_html = tokens[i]
+        if is_html:
+            continue
+        if words:
+            length += 1
+        offsets[i] = length
+        words.append(token)
+        length += len(token)
+    return " ".join(words), offsets
+
+
+def _answer_from_span(tokens, offsets, start, end):
+    kept = [i for i in range(start, end) if i in offsets]
+    if not kept:
+        return None
+    text = " ".join(tokens[i][0] for i in kept)
+    return {"text": text, "answer_start": offsets[kept[0]]}
+
+
+def simplify_nq_example(entry, mode, keep_null_prob=1.0):
+    """
+        Simplify one NaturalQuestions entry to a squad style Example. The context is the long answer candidate
+        selected by the annotators (the first top level candidate for unanswerable questions) and the answer is the
+        first short answer inside it.
+        Args:
+            entry: the decoded json line
+            mode: "train" or "dev"
+            keep_null_prob: fraction of unanswerable questions to keep, selected deterministically by example id so
+                that a resumed run keeps the same examples
+        Returns:
+            An :class:`Example` or None if the entry is filtered out.
+    """
+    tokens = _document_tokens(entry)
+    candidates = entry.get("long_answer_candidates", [])
+    qas_id = str(entry["example_id"])
+    long_answer = None
+    short_answers = []
+    for annotation in entry.get("annotations", []):
+        candidate_index = annotation["long_answer"]["candidate_index"]
+        if candidate_index < 0:
+            continue
+        if long_answer is None:
+            long_answer = candidate_index
+        if candidate_index == long_answer:
+            short_answers.extend(annotation["short_answers"])
+
+    if long_answer is None:
+        if keep_null_prob < 1.0 and (zlib.crc32(qas_id.encode("utf-8")) % 10000) / 10000. >= keep_null_prob:
+            return None
+        top_level = [c for c in candidates if c.get("top_level", True)]
+        if not top_level:
+            return None
+        candidate = top_level[0]
+    else:
+        candidate = candidates[long_answer]
+    context, offsets = _span_text(tokens, candidate["start_token"], candidate["end_token"])
+    if not context:
+        return None
+
+    answers = []
+    for short_answer in short_answers:
+        answer = _answer_from_span(tokens, offsets, short_answer["start_token"], short_answer["end_token"])
+        if answer is not None:
+            answers.append(answer)
+    # Long answers without a short answer (and yes/no answers) are kept as unanswerable spans
+    is_impossible = len(answers) == 0
+    answer_text = None
+    start_position = None
+    if mode == "train":
+        if not is_impossible:
+            answer_text = answers[0]["text"]
+            start_position = answers[0]["answer_start"]
+        answers = []
+    return Example(qas_id=qas_id,
+                   question_text=entry["question_text"],
+                   paragraph=context,
+                   answer_text=answer_text,
+                   start_position=start_position,
+                   is_impossible=is_impossible,
+                   answers=answers)
+
+
+def iter_nq_examples(input_file, mode, skip_lines=0, keep_null_prob=1.0):
+    """
+        Decode a NaturalQuestions gzip (or plain) JSONL file line by line.
+        Yields:
+            (line_number, example) where example is None for filtered out lines, so that callers can keep track of
+            how many lines have been consumed.
+    """
+    opener = gzip.open if input_file.endswith(".gz") else open
+    with opener(input_file, "rt", encoding="utf-8") as reader:
+        for line_number, line in enumerate(reader):
+            if line_number < skip_lines:
+                continue
+            line = line.strip()
+            if not line:
+                yield line_number, None
+                continue
+            yield line_number, simplify_nq_example(json.loads(line), mode, keep_null_prob)
+
+
+class FeatureStore(object):
+    """
+        Append only on-disk store of squad style features, written as numbered shards plus a json manifest.
+        The manifest is only updated once a shard has been fully written, which makes the store resumable.
+        Args:
+            store_dir: directory of the store
+            save_examples: whether to keep the examples alongside the features (needed for evaluation)
+    """
+
+    def __init__(self, store_dir, save_examples=False):
+        self.store_dir = store_dir
+        self.save_examples = save_examples
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+        self.manifest_path = os.path.join(store_dir, MANIFEST_NAME)
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r") as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {"shards": [], "lines_consumed": 0, "num_examples": 0, "num_features": 0,
+                             "next_unique_id": 1000000000, "finished": False}
+
+    @property
+    def finished(self):
+        return self.manifest["finished"]
+
+    def reset(self):
+        for shard in self.manifest["shards"]:
+            shard_path = os.path.join(self.store_dir, shard["file"])
+            if os.path.exists(shard_path):
+                os.remove(shard_path)
+        self.manifest = {"shards": [], "lines_consumed": 0, "num_examples": 0, "num_features": 0,
+                         "next_unique_id": 1000000000, "finished": False}
+        self._write_manifest()
+
+    def _write_manifest(self):
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def append(self, features, examples, lines_consumed):
+        shard_name = f"shard_{len(self.manifest['shards']):05d}.bin"
+        shard_path = os.path.join(self.store_dir, shard_name)
+        torch.save({"features": features, "examples": examples if self.save_examples else None}, shard_path + ".tmp")
+        os.replace(shard_path + ".tmp", shard_path)
+        self.manifest["shards"].append({"file": shard_name, "num_examples": len(examples),
+                                        "num_features": len(features)})
+        self.manifest["lines_consumed"] = lines_consumed
+        self.manifest["num_examples"] += len(examples)
+        self.manifest["num_features"] += len(features)
+        if features:
+            self.manifest["next_unique_id"] = features[-1].unique_id + 1
+        self._write_manifest()
+
+    def mark_finished(self, lines_consumed):
+        self.manifest["lines_consumed"] = lines_consumed
+        self.manifest["finished"] = True
+        self._write_manifest()
+
+    def iter_shards(self):
+        for shard in self.manifest["shards"]:
+            yield torch.load(os.path.join(self.store_dir, shard["file"]))
+
+    def load(self):
+        """Returns all the stored features (and examples if they were saved)."""
+        features = []
+        examples = [] if self.save_examples else None
+        for shard in self.iter_shards():
+            features.extend(shard["features"])
+            if examples is not None:
+                examples.extend(shard["examples"])
+        return features, examples
+
+
+def stream_nq_features(input_file, store_dir, tokenizer, mode, max_seq_length=384, doc_stride=128,
+                       max_query_length=64, chunk_size=2000, threads=1, keep_null_prob=1.0, overwrite=False):
+    """
+        Convert a NaturalQuestions JSONL shard into squad style features with bounded memory. Examples are buffered
+        up to `chunk_size`, converted with :func:`convert_examples_to_features` and appended to a
+        :class:`FeatureStore`. An interrupted run restarts from the last shard written to the store.
+        Returns:
+            the :class:`FeatureStore`
+    """
+    assert mode in ['train', 'dev']
+    store = FeatureStore(store_dir, save_examples=(mode == 'dev'))
+    if overwrite:
+        store.reset()
+    if store.finished:
+        logger.info("Features of %s already stored in %s", input_file, store_dir)
+        return store
+    if store.manifest["lines_consumed"]:
+        logger.info("Resuming %s from line %d", input_file, store.manifest["lines_consumed"])
+
+    def flush(buffer, lines_consumed, pool):
+        features = convert_examples_to_features(buffer, tokenizer, max_seq_length, doc_stride, max_query_length,
+                                                is_training=(mode == 'train'), tqdm_enabled=False,
+                                                unique_id_start=store.manifest["next_unique_id"],
+                                                example_index_start=store.manifest["num_examples"], pool=pool)
+        store.append(features, buffer, lines_consumed)
+
+    buffer = []
+    lines_consumed = store.manifest["lines_consumed"]
+    # one pool for the whole shard, the tokenizer is sent to the workers once
+    with Pool(pool_size(threads), initializer=squad_convert_example_to_features_init, initargs=(tokenizer,)) as pool:
+        for line_number, example in tqdm(iter_nq_examples(input_file, mode, skip_lines=lines_consumed,
+                                                          keep_null_prob=keep_null_prob),
+                                         desc="Streaming NaturalQuestions", initial=lines_consumed):
+            lines_consumed = line_number + 1
+            if example is None:
+                continue
+            buffer.append(example)
+            if len(buffer) >= chunk_size:
+                flush(buffer, lines_consumed, pool)
+                buffer = []
+        if buffer:
+            flush(buffer, lines_consumed, pool)
+    store.mark_finished(lines_consumed)
+    logger.info("Stored %d features of %d examples in %s", store.manifest["num_features"],
+                store.manifest["num_examples"], store_dir)
+    return store
+
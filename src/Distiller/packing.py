@@ -0,0 +1,180 @@
+import torch
+import torch.nn as nn
+from torch.nn import CrossEntropyLoss, MSELoss
+from torch.utils.data import Dataset
+from .transformers.modeling_outputs import SequenceClassifierOutput
+from .utils import Logger
+from .feature_arrays import feature_column
+# Sequence packing for GLUE: short examples are concatenated into rows of max_seq_length tokens. Every example keeps
+# its own [CLS] token, its positions restart at 0 and it only attends to itself (block diagonal attention mask), so
+# the forward of a packed row computes the same representations as the forwards of its examples, without padding.
+
+logger = Logger("all.log",level="debug").logger
+
+# model types whose classification head only reads the first token of its input (after the pooler for bert)
+PACKED_MODEL_TYPES = ("bert", "electra", "roberta")
+
+
+def _feature_length(feature):
+    return sum(feature.attention_mask)
+
+
+def _feature_lengths(features):
+    return torch.tensor(feature_column(features, "attention_mask"), dtype=torch.long).sum(1).tolist()
+
+
+def pack_groups(lengths, max_length, max_segments=8):
+    """
+    Groups examples into rows of at most `max_length` tokens and `max_segments` examples (first fit decreasing).
+
+    Returns:
+        a list of lists of example indices
+    """
+    order = sorted(range(len(lengths)), key=lambda i: -lengths[i])
+    groups, free = [], []
+    for i in order:
+        for g, space in enumerate(free):
+            if lengths[i] <= space and len(groups[g]) < max_segments:
+                groups[g].append(i)
+                free[g] -= lengths[i]
+                break
+        else:
+            groups.append([i])
+            free.append(max_length - lengths[i])
+    # keep the original order of the examples inside a row
+    return [sorted(group) for group in groups]
+
+
+def _pack_tensors(features, groups, max_length, max_segments, labels):
+    num_rows = len(groups)
+    input_ids = torch.zeros(num_rows, max_length, dtype=torch.long)
+    token_type_ids = torch.zeros(num_rows, max_length, dtype=torch.long)
+    position_ids = torch.zeros(num_rows, max_length, dtype=torch.long)
+    segment_ids = torch.zeros(num_rows, max_length, dtype=torch.long)
+    cls_positions = torch.zeros(num_rows, max_segments, dtype=torch.long)
+    cls_mask = torch.zeros(num_rows, max_segments, dtype=torch.long)
+    packed_labels = torch.zeros(num_rows, max_segments, dtype=labels.dtype)
+    for row, group in enumerate(groups):
+        offset = 0
+        for segment, i in enumerate(group):
+            feature = features[i]
+            length = _feature_length(feature)
+            input_ids[row, offset:offset + length] = torch.tensor(feature.input_ids[:length])
+            token_type_ids[row, offset:offset + length] = torch.tensor(feature.token_type_ids[:length])
+            position_ids[row, offset:offset + length] = torch.arange(length)
+            segment_ids[row, offset:offset + length] = segment + 1
+            cls_positions[row, segment] = offset
+            cls_mask[row, segment] = 1
+            packed_labels[row, segment] = labels[i]
+            offset += length
+    return {'input_ids': input_ids, 'token_type_ids': token_type_ids, 'position_ids': position_ids,
+            'segment_ids': segment_ids, 'cls_positions': cls_positions, 'cls_mask': cls_mask,
+            'labels': packed_labels}
+
+
+class PackedDataset(Dataset):
+    """
+    Packed rows of GLUE features. The items have the keys ``input_ids``, ``token_type_ids``, ``position_ids``,
+    ``segment_ids`` (1-based index of the example of every token, 0 for padding), ``cls_positions``, ``cls_mask``
+    (which of the ``max_segments`` slots hold an example) and ``labels`` (one per slot), and are split into
+    ``teacher`` and ``student`` inputs when the student has its own tokenizer. Both are packed with the same groups,
+    so the examples of a row come in the same order for the teacher and the student.
+
+    Args:
+        features: teacher features, as returned by ``convert_examples_to_features``.
+        s_features: student features, or None.
+        max_length (int): length of the packed rows.
+        max_segments (int): maximum number of examples per row.
+    """
+    def __init__(self, features, s_features=None, max_length=128, max_segments=8):
+        super(PackedDataset, self).__init__()
+        lengths = _feature_lengths(features)
+        if s_features:
+            lengths = [max(length, s_length) for length, s_length in zip(lengths, _feature_lengths(s_features))]
+        self.groups = pack_groups(lengths, max_length, max_segments)
+        labels = torch.tensor(feature_column(features, "label"))
+        self.teacher = _pack_tensors(features, self.groups, max_length, max_segments, labels)
+        self.student = _pack_tensors(s_features, self.groups, max_length, max_segments, labels) \
+            if s_features else None
+        real_tokens = sum(lengths)
+        logger.info(f"Packed {len(features)} examples into {len(self.groups)} rows, "
+                    f"{real_tokens / (len(self.groups) * max_length):.1%} of the tokens are real tokens "
+                    f"(vs {real_tokens / (len(features) * max_length):.1%} with padding)")
+
+    def __getitem__(self, index):
+        teacher = {k: v[index] for k, v in self.teacher.items()}
+        if self.student is None:
+            return teacher
+        return {'teacher': teacher, 'student': {k: v[index] for k, v in self.student.items()}}
+
+    def __len__(self):
+        return len(self.groups)
+
+
+def packed_attention_mask(segment_ids):
+    """Block diagonal mask of shape (batch_size, seq_len, seq_len): tokens attend to the tokens of their example."""
+    return ((segment_ids[:, :, None] == segment_ids[:, None, :]) & (segment_ids[:, None, :] > 0)).long()
+
+
+class PackedSequenceClassifier(nn.Module):
+    """
+    Runs a ``*ForSequenceClassification`` model on packed rows. The logits, loss and labels are unpacked: they have
+    one row per example (in the order of the slots of the packed rows). Hidden states and attentions stay packed,
+    which keeps the teacher and student ones aligned when they share a tokenizer; the padding is masked out by
+    :func:`~Distiller.adapters.PackedGLUEAdaptor`.
+
+    Batches without ``segment_ids`` (e.g. the dev set in ``evaluate_glue``) are passed to the model unchanged.
+    The wrapped model is ``self.module``, as for ``DataParallel``, so callbacks saving ``model.module`` still work.
+    Only the ``*ForSequenceClassification`` models of :data:`PACKED_MODEL_TYPES` are supported.
+    """
+    def __init__(self, model):
+        super().__init__()
+        model_type = model.config.model_type
+        if model_type not in PACKED_MODEL_TYPES:
+            raise ValueError(f"Sequence packing supports the {', '.join(PACKED_MODEL_TYPES)} classifiers, "
+                             f"not {model_type}")
+        if model_type == 'bert' and not hasattr(model, 'bert'):
+            raise ValueError(f"Sequence packing needs a BertForSequenceClassification, got {type(model).__name__}")
+        self.module = model
+        self.config = model.config
+        self.num_labels = model.config.num_labels
+
+    def save_pretrained(self, save_directory):
+        self.module.save_pretrained(save_directory)
+
+    def _classify(self, cls_hidden):
+        model = self.module
+        # the heads read the first token of their input
+        head_input = cls_hidden[:, None, :]
+        if self.config.model_type == 'bert':
+            return model.classifier(model.dropout(model.bert.pooler(head_input)))
+        # the electra and roberta heads take the first token themselves
+        return model.classifier(head_input)
+
+    def forward(self, input_ids=None, attention_mask=None, token_type_ids=None, position_ids=None, segment_ids=None,
+                cls_positions=None, cls_mask=None, labels=None, output_attentions=None, output_hidden_states=None,
+                **kwargs):
+        if segment_ids is None:
+            return self.module(input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids,
+                               position_ids=position_ids, labels=labels, output_attentions=output_attentions,
+                               output_hidden_states=output_hidden_states, **kwargs)
+        if self.config.model_type == 'roberta':
+            # roberta positions start after the padding index
+            position_ids = position_ids + self.config.pad_token_id + 1
+        outputs = self.module.base_model(input_ids, attention_mask=packed_attention_mask(segment_ids),
+                                         token_type_ids=token_type_ids, position_ids=position_ids,
+                                         output_attentions=output_attentions,
+                                         output_hidden_states=output_hidden_states, return_dict=True)
+        slots = cls_mask.bool()
+        rows = torch.arange(input_ids.size(0), device=input_ids.device)[:, None].expand_as(cls_positions)
+        cls_hidden = outputs.last_hidden_state[rows[slots], cls_positions[slots]]
+        logits = self._classify(cls_hidden)
+        loss = None
+        if labels is not None:
+            labels = labels[slots]
+            if self.num_labels == 1:
+                loss = MSELoss()(logits.view(-1), labels.view(-1).type_as(logits))
+            else:
+                loss = CrossEntropyLoss()(logits.view(-1, self.num_labels), labels.view(-1))
+        return SequenceClassifierOutput(loss=loss, logits=logits, hidden_states=outputs.hidden_states,
+                                        attentions=outputs.attentions)
@@ -0,0 +1,195 @@
+import copy
+import time
+import torch
+import torch.nn.functional as F
+from .transformers.modeling_utils import prune_linear_layer
+from .utils import Logger
+# Structured pruning of BERT-like students: attention heads and FFN neurons are scored by the sensitivity of the
+# distillation loss and physically removed, so the pruned student is smaller and faster, not only sparser.
+
+logger = Logger("all.log",level="debug").logger
+
+
+def _split_batch(batch, device):
+    """Returns the teacher and student inputs of a batch of MyDataset (plain or teacher/student dicts)."""
+    if 'teacher' in batch:
+        teacher_batch, student_batch = batch['teacher'], batch['student']
+    else:
+        teacher_batch = student_batch = batch
+    names = ['input_ids', 'attention_mask', 'token_type_ids', 'labels', 'start_positions', 'end_positions']
+    teacher_batch = {k: v.to(device) for k, v in teacher_batch.items() if k in names}
+    student_batch = {k: v.to(device) for k, v in student_batch.items() if k in names}
+    return teacher_batch, student_batch
+
+
+def _logits(outputs):
+    if hasattr(outputs, 'start_logits'):
+        return [outputs.start_logits, outputs.end_logits]
+    return [outputs.logits]
+
+
+def _distillation_loss(outputs_S, outputs_T, temperature):
+    loss = 0
+    for logits_S, logits_T in zip(_logits(outputs_S), _logits(outputs_T)):
+        if logits_S.size(-1) == 1:
+            loss = loss + F.mse_loss(logits_S, logits_T)
+        else:
+            loss = loss + F.kl_div(F.log_softmax(logits_S / temperature, dim=-1),
+                                   F.softmax(logits_T / temperature, dim=-1), reduction='batchmean')
+    return loss
+
+
+def compute_importance(model_S, dataloader, device, model_T=None, temperature=1.0, num_batches=None):
+    """
+    Scores the attention heads and the FFN neurons of `model_S` by the first order sensitivity of the loss: the
+    gradient with respect to a head mask for heads, ``|weight * grad|`` summed over the input weights for neurons.
+    The loss is the distillation loss to `model_T` if given, the supervised loss of the student otherwise.
+
+    Returns:
+        (head_importance, ffn_importance): a list with a tensor of shape (num_heads,) per layer and a list with a
+        tensor of shape (intermediate_size,) per layer
+    """
+    layers = model_S.base_model.encoder.layer
+    head_masks = [torch.ones(layer.attention.self.num_attention_heads, device=device, requires_grad=True)
+                  for layer in layers]
+    head_importance = [torch.zeros(mask.size(0), device=device) for mask in head_masks]
+    ffn_importance = [torch.zeros(layer.intermediate.dense.out_features, device=device) for layer in layers]
+
+    # the head mask argument of the models expects the same number of heads in every layer, which no longer holds
+    # once heads are pruned, so the mask is applied to the context of every self-attention module instead
+    def mask_hook(mask):
+        def hook(module, inputs, outputs):
+            context = outputs[0]
+            head_size = context.size(-1) // mask.size(0)
+            return (context * mask.repeat_interleave(head_size),) + tuple(outputs[1:])
+        return hook
+    handles = [layer.attention.self.register_forward_hook(mask_hook(mask)) for layer, mask in zip(layers, head_masks)]
+    model_S.eval()
+    if model_T is not None:
+        model_T.eval()
+    try:
+        for step, batch in enumerate(dataloader):
+            if num_batches is not None and step >= num_batches:
+                break
+            teacher_batch, student_batch = _split_batch(batch, device)
+            outputs_S = model_S(**student_batch)
+            if model_T is not None:
+                with torch.no_grad():
+                    outputs_T = model_T(**teacher_batch)
+                loss = _distillation_loss(outputs_S, outputs_T, temperature)
+            else:
+                loss = outputs_S.loss
+            model_S.zero_grad()
+            for mask in head_masks:
+                mask.grad = None
+            loss.backward()
+            for i, (layer, mask) in enumerate(zip(layers, head_masks)):
+                head_importance[i] += mask.grad.abs().detach()
+                dense = layer.intermediate.dense
+                ffn_importance[i] += ((dense.weight * dense.weight.grad).abs().sum(1)
+                                      + (dense.bias * dense.bias.grad).abs()).detach()
+    finally:
+        for handle in handles:
+            handle.remove()
+    model_S.zero_grad()
+    return head_importance, ffn_importance
+
+
+def prune_heads(model, head_importance, num_heads):
+    """Removes the `num_heads` least important heads over all layers, keeping at least one head per layer."""
+    candidates = sorted((score.item(), layer, head) for layer, scores in enumerate(head_importance)
+                        for head, score in enumerate(scores))
+    remaining = [scores.size(0) for scores in head_importance]
+    to_prune = {}
+    for _, layer, head in candidates:
+        if num_heads <= 0:
+            break
+        if remaining[layer] > 1:
+            to_prune.setdefault(layer, []).append(head)
+            remaining[layer] -= 1
+            num_heads -= 1
+    # prune_heads expects the indices of the original heads, it maps them to the current ones itself
+    already_pruned = model.config.pruned_heads
+    original = {}
+    for layer, heads in to_prune.items():
+        kept = [h for h in range(head_importance[layer].size(0) + len(already_pruned.get(layer, [])))
+                if h not in already_pruned.get(layer, [])]
+        original[layer] = [kept[h] for h in heads]
+    model.prune_heads(original)
+    return original
+
+
+def prune_ffn(model, ffn_importance, num_neurons):
+    """Removes the `num_neurons` least important FFN neurons of every layer (the same number in every layer, so that
+    ``config.intermediate_size`` still describes the pruned model)."""
+    for layer, scores in zip(model.base_model.encoder.layer, ffn_importance):
+        keep = scores.argsort(descending=True)[:scores.size(0) - num_neurons].sort().values
+        layer.intermediate.dense = prune_linear_layer(layer.intermediate.dense, keep, dim=0)
+        layer.output.dense = prune_linear_layer(layer.output.dense, keep, dim=1)
+    model.config.intermediate_size = model.base_model.encoder.layer[0].intermediate.dense.out_features
+
+
+def count_parameters(model):
+    return sum(p.numel() for p in model.parameters())
+
+
+@torch.no_grad()
+def cpu_latency(model, batch, repeats=10, warmup=2):
+    """Median latency in milliseconds of a forward pass of a copy of `model` on CPU."""
+    model = copy.deepcopy(model).cpu().eval()
+    _, inputs = _split_batch(batch, torch.device("cpu"))
+    inputs = {k: v for k, v in inputs.items() if k in ['input_ids', 'attention_mask', 'token_type_ids']}
+    timings = []
+    for i in range(warmup + repeats):
+        start = time.perf_counter()
+        model(**inputs)
+        if i >= warmup:
+            timings.append((time.perf_counter() - start) * 1000)
+    return sorted(timings)[len(timings) // 2]
+
+
+def prune_and_distill(model_S, dataloader, device, stages, distill_fn, model_T=None, temperature=1.0,
+                      importance_batches=32, evaluate_fn=None):
+    """
+    Prunes `model_S` in stages, distilling after every stage.
+
+    Args:
+        stages (list): ``(head_fraction, ffn_fraction)`` per stage, the fractions of the original heads and FFN
+            neurons removed once the stage is done (cumulative, e.g. ``[(0.25, 0.25), (0.5, 0.5)]``).
+        distill_fn (Callable): called as ``distill_fn(model_S, stage)`` to continue the distillation of the pruned
+            student, e.g. with a :class:`GeneralDistiller`.
+        evaluate_fn (Callable): called as ``evaluate_fn(model_S, stage)``, returns a dict of metrics.
+    Returns:
+        a list with the report of every stage (parameters, CPU latency and metrics), the first one being the
+        unpruned student
+    """
+    layers = model_S.base_model.encoder.layer
+    total_heads = sum(layer.attention.self.num_attention_heads for layer in layers)
+    total_ffn = layers[0].intermediate.dense.out_features
+    example_batch = next(iter(dataloader))
+
+    def report(stage):
+        result = {"stage": stage, "parameters": count_parameters(model_S),
+                  "heads": sum(layer.attention.self.num_attention_heads for layer in layers),
+                  "intermediate_size": layers[0].intermediate.dense.out_features,
+                  "cpu_latency_ms": cpu_latency(model_S, example_batch)}
+        if evaluate_fn is not None:
+            result.update(evaluate_fn(model_S, stage))
+        logger.info(f"Pruning stage {stage}: {result}")
+        return result
+
+    reports = [report(0)]
+    for stage, (head_fraction, ffn_fraction) in enumerate(stages, 1):
+        head_importance, ffn_importance = compute_importance(model_S, dataloader, device, model_T, temperature,
+                                                             importance_batches)
+        current_heads = sum(scores.size(0) for scores in head_importance)
+        num_heads = int(round(head_fraction * total_heads)) - (total_heads - current_heads)
+        if num_heads > 0:
+            prune_heads(model_S, head_importance, num_heads)
+        num_neurons = int(round(ffn_fraction * total_ffn)) - (total_ffn - ffn_importance[0].size(0))
+        if num_neurons > 0:
+            prune_ffn(model_S, ffn_importance, num_neurons)
+        model_S.to(device)
+        distill_fn(model_S, stage)
+        reports.append(report(stage))
+    return reports
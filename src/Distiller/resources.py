@@ -0,0 +1,131 @@
+import os
+import json
+import time
+import resource
+import contextlib
+import torch
+from .utils import Logger
+# CPU resources of a run. The cores the run may use are split into disjoint sets for the components that run at the
+# same time: the trainer process (training, and the tokenization and evaluations it runs between steps) and the
+# augmentation process (nlpaug / MarianMT models and the tokenization of the augmented examples). Every process pins
+# itself to the cores of its component and sizes its torch thread pools and its worker pools to them, instead of each
+# of them assuming it has the whole machine. The utilisation achieved by every component is appended to
+# cpu_usage.jsonl in the output directory.
+
+logger = Logger("all.log",level="debug").logger
+
+COMPONENTS = ("trainer", "augmentation")
+
+
+def available_cores():
+    """The cores the current process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def pool_size(requested):
+    """Number of workers of a pool of `requested` workers that fits in the cores of the current process."""
+    return max(1, min(requested, len(available_cores())))
+
+
+def split_cores(cores, parts):
+    """`cores` split into at most `parts` contiguous sets, of sizes differing by at most one."""
+    parts = max(1, min(parts, len(cores)))
+    size, extra = divmod(len(cores), parts)
+    sets = []
+    start = 0
+    for i in range(parts):
+        end = start + size + (1 if i < extra else 0)
+        sets.append(list(cores[start:end]))
+        start = end
+    return sets
+
+
+def pin(cores, interop_threads=1):
+    """
+    Restricts the current process to `cores`, and sizes its torch intra-op pool and the OpenMP / MKL pools of the
+    processes it starts to one thread per core.
+    """
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    try:
+        torch.set_num_interop_threads(interop_threads)
+    except RuntimeError:
+        # it can only be set before the first inter-op parallel work of the process
+        pass
+    os.environ["OMP_NUM_THREADS"] = str(len(cores))
+    os.environ["MKL_NUM_THREADS"] = str(len(cores))
+
+
+def _cpu_seconds():
+    # includes the workers of the pools the process has joined (tokenization pools)
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage_self.ru_utime + usage_self.ru_stime + usage_children.ru_utime + usage_children.ru_stime
+
+
+class ResourceManager(object):
+    """
+    Core sets of the components of a run, see :data:`COMPONENTS`.
+
+    Args:
+        plan (dict): cores of every component. A component without cores shares the cores of the trainer.
+        usage_file (str): jsonl file the utilisation recorded by :meth:`track` is appended to, or None.
+        interop_threads (int): size of the torch inter-op pool of every process.
+    """
+    def __init__(self, plan, usage_file=None, interop_threads=1):
+        self.plan = plan
+        self.usage_file = usage_file
+        self.interop_threads = interop_threads
+
+    @classmethod
+    def from_args(cls, args):
+        """
+        The manager of the run of `args`. The plan is computed by the first process and stored in ``args.cpu_plan``, so
+        that the processes it starts with `args` (which only see the cores of the trainer) get the same plan.
+        """
+        if getattr(args, "cpu_plan", None) is None:
+            cores = available_cores()
+            augmentation = 0
+            # no augmentation process when the batches are replayed from a log (textbrewer/replay.py)
+            if args.aug_pipeline and args.repeated_aug <= 1 and not getattr(args, "replay", False):
+                augmentation = args.augmentation_cores or len(cores) // 4
+            augmentation = max(0, min(augmentation, len(cores) - 1))
+            args.cpu_plan = {"trainer": cores[:len(cores) - augmentation],
+                             "augmentation": cores[len(cores) - augmentation:]}
+        return cls(args.cpu_plan, os.path.join(args.output_dir, "cpu_usage.jsonl"), args.interop_threads)
+
+    def cores(self, component):
+        return self.plan.get(component) or self.plan["trainer"]
+
+    def threads(self, component):
+        """Number of threads (or pool workers) `component` may use."""
+        return len(self.cores(component))
+
+    def apply(self, component):
+        """Pins the current process to the cores of `component`."""
+        cores = self.cores(component)
+        pin(cores, self.interop_threads)
+        logger.info(f"Pinned the {component} process {os.getpid()} to {len(cores)} cores {cores}, "
+                    f"{torch.get_num_threads()} intra-op threads")
+
+    @contextlib.contextmanager
+    def track(self, component):
+        """Records the CPU utilisation of the current process (and of the pools it joins) while the block runs."""
+        start_wall, start_cpu = time.time(), _cpu_seconds()
+        try:
+            yield
+        finally:
+            wall = time.time() - start_wall
+            cpu = _cpu_seconds() - start_cpu
+            cores = self.threads(component)
+            usage = {"component": component, "pid": os.getpid(), "cores": cores, "threads": torch.get_num_threads(),
+                     "wall_seconds": round(wall, 3), "cpu_seconds": round(cpu, 3),
+                     "utilisation": round(cpu / (wall * cores), 4) if wall > 0 else None}
+            logger.info(f"CPU usage: {usage}")
+            if self.usage_file is not None:
+                # one short line per write, appends of the processes do not interleave
+                with open(self.usage_file, "a") as f:
+                    f.write(json.dumps(usage) + "\n")
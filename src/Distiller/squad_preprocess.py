@@ -1,7 +1,10 @@
 import os
 import json
+import contextlib
 from tqdm import tqdm
 from .utils import Logger
+from .feature_arrays import SquadFeatureArrays, feature_column
+from .resources import pool_size
 import torch
 from multiprocessing import Pool, cpu_count
 import numpy as np
@@ -233,7 +236,8 @@ class InputFeatures(object):
         self.encoding = encoding
 
 
-def load_and_cache_examples(args, tokenizer, mode, return_examples=False, s_tokenizer=None):
+def load_and_cache_examples(args, tokenizer, mode, return_examples=False, s_tokenizer=None, pack=False):
+    assert not pack, "sequence packing is only implemented for GLUE"
     s_dataset = None
     s_features = None
     s_cached_features_file = None
@@ -256,7 +260,9 @@ def load_and_cache_examples(args, tokenizer, mode, return_examples=False, s_toke
     if os.path.exists(cached_features_file) and not args.overwrite_cache:
         logger.info("Loading features from cached file %s", cached_features_file)
         features = torch.load(cached_features_file)
-        # dataset = convert_features_to_dataset(features, is_training=(mode == 'train'))
+        if not isinstance(features, SquadFeatureArrays):
+            # cache written as a list of features
+            features = SquadFeatureArrays(features)
         ## This place need to be more flexible
     else:
         logger.info("Creating features from dataset file at %s", args.data_dir)
@@ -266,6 +272,7 @@ def load_and_cache_examples(args, tokenizer, mode, return_examples=False, s_toke
                                                          is_training=(mode == 'train'),
                                                          threads=args.thread
                                                          )
+        features = SquadFeatureArrays(features)
         if args.local_rank in [-1, 0]:
             logger.info("Saving features into cached file %s", cached_features_file)
             torch.save(features, cached_features_file)
@@ -273,7 +280,8 @@ def load_and_cache_examples(args, tokenizer, mode, return_examples=False, s_toke
         if os.path.exists(s_cached_features_file) and not args.overwrite_cache:
             logger.info("Loading student features from cached file %s", s_cached_features_file)
             s_features = torch.load(s_cached_features_file)
-            # s_dataset = convert_features_to_dataset(s_features, is_training=(mode == 'train'))
+            if not isinstance(s_features, SquadFeatureArrays):
+                s_features = SquadFeatureArrays(s_features)
         else:
             logger.info("Creating student features from dataset file at %s", args.data_dir)
             s_features = convert_examples_to_features(examples, s_tokenizer, args.max_seq_length,
@@ -282,6 +290,7 @@ def load_and_cache_examples(args, tokenizer, mode, return_examples=False, s_toke
                                                              is_training=(mode == 'train'),
                                                              threads=args.thread
                                                              )
+            s_features = SquadFeatureArrays(s_features)
             if args.local_rank in [-1, 0]:
                 logger.info("Saving student features into cached file %s", s_cached_features_file)
                 torch.save(s_features, s_cached_features_file)
@@ -404,6 +413,9 @@ def convert_examples_to_features(
         padding_strategy="max_length",
         threads=1,
         tqdm_enabled=True,
+        unique_id_start=1000000000,
+        example_index_start=0,
+        pool=None,
 ):
     """
     Converts a list of examples into a list of features that can be directly given as input to a model. It is
@@ -418,6 +430,10 @@ def convert_examples_to_features(
         padding_strategy: Default to "max_length". Which padding strategy to use
         threads: multiple processing threads.
         tqdm_enabled: whether enable tqdm
+        unique_id_start: unique id given to the first feature, used when examples are converted chunk by chunk
+        example_index_start: example index given to the first example, used when examples are converted chunk by chunk
+        pool: a pool started with :func:`squad_convert_example_to_features_init` and `tokenizer`, reused across the
+            chunks of a conversion. None starts a pool of `threads` processes for this call.
     Returns:
         list of :class:`~transformers.data.processors.squad.SquadFeatures`
     Example::
@@ -435,9 +451,13 @@ def convert_examples_to_features(
     # Defining helper methods
     features = []
 
-    threads = min(threads, cpu_count())
     from functools import partial
-    with Pool(threads, initializer=squad_convert_example_to_features_init, initargs=(tokenizer,)) as p:
+    if pool is None:
+        pool = Pool(pool_size(threads), initializer=squad_convert_example_to_features_init, initargs=(tokenizer,))
+    else:
+        # owned by the caller, it stays open
+        pool = contextlib.nullcontext(pool)
+    with pool as p:
         annotate_ = partial(
             convert_example_to_features,
             max_seq_length=max_seq_length,
@@ -456,8 +476,8 @@ def convert_examples_to_features(
         )
 
     new_features = []
-    unique_id = 1000000000
-    example_index = 0
+    unique_id = unique_id_start
+    example_index = example_index_start
     for example_features in tqdm(
             features, total=len(features), desc="add example index and unique id", disable=not tqdm_enabled
     ):
@@ -485,19 +505,19 @@ def convert_features_to_dataset(features, s_features=None, is_testing=False):
     s_all_start_positions = None
     s_all_end_positions = None
     # Convert to Tensors and build dataset
-    all_input_ids = torch.tensor([f.input_ids for f in features], dtype=torch.long)
-    all_attention_masks = torch.tensor([f.attention_mask for f in features], dtype=torch.long)
-    all_token_type_ids = torch.tensor([f.token_type_ids for f in features], dtype=torch.long)
-    all_cls_index = torch.tensor([f.cls_index for f in features], dtype=torch.long)
-    all_p_mask = torch.tensor([f.p_mask for f in features], dtype=torch.float)
-    all_is_impossible = torch.tensor([f.is_impossible for f in features], dtype=torch.float)
+    all_input_ids = torch.tensor(feature_column(features, "input_ids"), dtype=torch.long)
+    all_attention_masks = torch.tensor(feature_column(features, "attention_mask"), dtype=torch.long)
+    all_token_type_ids = torch.tensor(feature_column(features, "token_type_ids"), dtype=torch.long)
+    all_cls_index = torch.tensor(feature_column(features, "cls_index"), dtype=torch.long)
+    all_p_mask = torch.tensor(feature_column(features, "p_mask"), dtype=torch.float)
+    all_is_impossible = torch.tensor(feature_column(features, "is_impossible"), dtype=torch.float)
     if s_features:
-        s_all_input_ids = torch.tensor([f.input_ids for f in s_features], dtype=torch.long)
-        s_all_attention_masks = torch.tensor([f.attention_mask for f in s_features], dtype=torch.long)
-        s_all_token_type_ids = torch.tensor([f.token_type_ids for f in s_features], dtype=torch.long)
-        s_all_cls_index = torch.tensor([f.cls_index for f in s_features], dtype=torch.long)
-        s_all_p_mask = torch.tensor([f.p_mask for f in s_features], dtype=torch.float)
-        s_all_is_impossible = torch.tensor([f.is_impossible for f in s_features], dtype=torch.float)
+        s_all_input_ids = torch.tensor(feature_column(s_features, "input_ids"), dtype=torch.long)
+        s_all_attention_masks = torch.tensor(feature_column(s_features, "attention_mask"), dtype=torch.long)
+        s_all_token_type_ids = torch.tensor(feature_column(s_features, "token_type_ids"), dtype=torch.long)
+        s_all_cls_index = torch.tensor(feature_column(s_features, "cls_index"), dtype=torch.long)
+        s_all_p_mask = torch.tensor(feature_column(s_features, "p_mask"), dtype=torch.float)
+        s_all_is_impossible = torch.tensor(feature_column(s_features, "is_impossible"), dtype=torch.float)
 
     if is_testing:
         all_feature_index = torch.arange(all_input_ids.size(0), dtype=torch.long)
@@ -505,11 +525,11 @@ def convert_features_to_dataset(features, s_features=None, is_testing=False):
             all_input_ids, all_attention_masks, all_token_type_ids, all_feature_index, all_cls_index, all_p_mask
         )
     else:
-        all_start_positions = torch.tensor([f.start_position for f in features], dtype=torch.long)
-        all_end_positions = torch.tensor([f.end_position for f in features], dtype=torch.long)
+        all_start_positions = torch.tensor(feature_column(features, "start_position"), dtype=torch.long)
+        all_end_positions = torch.tensor(feature_column(features, "end_position"), dtype=torch.long)
         if s_features:
-            s_all_start_positions = torch.tensor([f.start_position for f in s_features], dtype=torch.long)
-            s_all_end_positions = torch.tensor([f.end_position for f in s_features], dtype=torch.long)
+            s_all_start_positions = torch.tensor(feature_column(s_features, "start_position"), dtype=torch.long)
+            s_all_end_positions = torch.tensor(feature_column(s_features, "end_position"), dtype=torch.long)
         dataset = MyDataset(
             all_input_ids,
             all_attention_masks,
@@ -0,0 +1,203 @@
+import collections
+import functools
+import numpy as np
+from .utils import normalize_answer
+# Array based SQuAD scoring, used by evaluate._squad_evaluate. It returns the same numbers as get_raw_scores,
+# apply_no_ans_threshold, make_eval_dict and find_all_best_thresh_v2 of utils.py: the sums are taken in the same
+# order (np.cumsum adds sequentially, like the python sums) so that the floating point results are identical.
+
+_gold_cache = collections.OrderedDict()
+_GOLD_CACHE_SIZE = 4
+
+
+@functools.lru_cache(maxsize=2 ** 17)
+def _normalize(text):
+    """Normalized text of an answer, its distinct tokens and their counts."""
+    normalized = normalize_answer(text) if text else ""
+    counts = collections.Counter(normalized.split())
+    return normalized, tuple(counts), np.array(list(counts.values()), dtype=np.int64)
+
+
+class GoldAnswers:
+    """
+    The gold answers of a dev set, normalized and tokenized once. The answers of question ``i`` are
+    ``answer_offsets[i]:answer_offsets[i + 1]`` of the flat answer arrays. Token ids index ``vocabulary``, the
+    tokens of these gold answers only, so it is released with them.
+    """
+    def __init__(self, examples):
+        self.qids = [example.qas_id for example in examples]
+        self.has_ans = np.array([bool(example.answers) for example in examples])
+        texts, offsets = [], [0]
+        for example in examples:
+            gold_answers = [answer["text"] for answer in example.answers if _normalize(answer["text"])[0]]
+            if not gold_answers:
+                # For unanswerable questions, only correct answer is empty string
+                gold_answers = [""]
+            texts.extend(gold_answers)
+            offsets.append(len(texts))
+        self.answer_offsets = np.array(offsets, dtype=np.int64)
+        self.answer_question = np.repeat(np.arange(len(examples)), np.diff(self.answer_offsets))
+        normalized = [_normalize(text) for text in texts]
+        self.vocabulary = {}
+        token_ids = [[self.vocabulary.setdefault(token, len(self.vocabulary)) for token in n[1]] for n in normalized]
+        self.answer_strings = [n[0] for n in normalized]
+        self.answer_lengths = np.array([n[2].sum() for n in normalized], dtype=np.int64)
+        self.token_pairs = np.concatenate([np.repeat(i, len(n[1])) for i, n in enumerate(normalized)] + [[]]).astype(np.int64)
+        self.token_ids = np.concatenate(token_ids + [[]]).astype(np.int64)
+        self.token_counts = np.concatenate([n[2] for n in normalized] + [[]]).astype(np.int64)
+
+    @classmethod
+    def from_examples(cls, examples):
+        """Cached by the ids and answers of the examples, which do not change between two evaluations."""
+        key = hash(tuple((example.qas_id, tuple(answer["text"] for answer in example.answers)) for example in examples))
+        if key not in _gold_cache:
+            _gold_cache[key] = cls(examples)
+            while len(_gold_cache) > _GOLD_CACHE_SIZE:
+                _gold_cache.popitem(last=False)
+        return _gold_cache[key]
+
+
+def _sequential_sum(values):
+    return float(np.cumsum(values, dtype=np.float64)[-1]) if len(values) else 0.0
+
+
+def raw_scores(gold, preds):
+    """
+    Exact match and F1 of every question with a prediction, the maximum over its gold answers.
+
+    Returns:
+        (questions, exact, f1): the indices of the questions with a prediction and their scores
+    """
+    questions = np.array([i for i, qid in enumerate(gold.qids) if qid in preds], dtype=np.int64)
+    for qid in gold.qids:
+        if qid not in preds:
+            print("Missing prediction for %s" % qid)
+    # (normalized text, ids and counts of the tokens also in a gold answer, number of tokens) of every prediction;
+    # the other tokens cannot be in common with a gold answer
+    pred_normalized = {}
+    for i in questions:
+        normalized, tokens, counts = _normalize(preds[gold.qids[i]])
+        ids = np.array([gold.vocabulary.get(token, -1) for token in tokens], dtype=np.int64)
+        known = ids >= 0
+        pred_normalized[i] = normalized, ids[known], counts[known], counts.sum()
+    # one (gold answer, prediction) pair per gold answer of the questions with a prediction
+    pairs = np.concatenate([np.arange(gold.answer_offsets[i], gold.answer_offsets[i + 1]) for i in questions] + [[]]).astype(np.int64)
+    pair_question = gold.answer_question[pairs]
+    exact = np.array([gold.answer_strings[a] == pred_normalized[q][0] for a, q in zip(pairs, pair_question)],
+                     dtype=np.float64)
+    pred_lengths = np.array([pred_normalized[q][3] for q in pair_question], dtype=np.int64)
+    gold_lengths = gold.answer_lengths[pairs]
+
+    # tokens in common: sum over the tokens of min(gold count, prediction count), as the Counter intersection
+    pair_index = np.full(len(gold.answer_strings), -1, dtype=np.int64)
+    pair_index[pairs] = np.arange(len(pairs))
+    selected = pair_index[gold.token_pairs] >= 0
+    num_tokens = len(gold.vocabulary) + 1
+    gold_keys = pair_index[gold.token_pairs[selected]] * num_tokens + gold.token_ids[selected]
+    gold_counts = gold.token_counts[selected]
+    pred_keys = np.concatenate([p * num_tokens + pred_normalized[q][1] for p, q in enumerate(pair_question)] + [[]]).astype(np.int64)
+    pred_counts = np.concatenate([pred_normalized[q][2] for q in pair_question] + [[]]).astype(np.int64)
+    _, gold_at, pred_at = np.intersect1d(gold_keys, pred_keys, assume_unique=True, return_indices=True)
+    num_same = np.bincount(gold_keys[gold_at] // num_tokens,
+                           weights=np.minimum(gold_counts[gold_at], pred_counts[pred_at]), minlength=len(pairs))
+
+    f1 = np.zeros(len(pairs), dtype=np.float64)
+    # If either is no-answer, then F1 is 1 if they agree, 0 otherwise
+    empty = (gold_lengths == 0) | (pred_lengths == 0)
+    f1[empty] = (gold_lengths[empty] == pred_lengths[empty])
+    overlap = ~empty & (num_same > 0)
+    precision = 1.0 * num_same[overlap] / pred_lengths[overlap]
+    recall = 1.0 * num_same[overlap] / gold_lengths[overlap]
+    f1[overlap] = (2 * precision * recall) / (precision + recall)
+
+    if not len(pairs):
+        return questions, np.zeros(0), np.zeros(0)
+    starts = np.searchsorted(pair_question, questions)
+    return questions, np.maximum.reduceat(exact, starts), np.maximum.reduceat(f1, starts)
+
+
+def _eval_dict(exact, f1, selection=None):
+    if selection is not None:
+        exact, f1 = exact[selection], f1[selection]
+    total = len(exact)
+    return collections.OrderedDict(
+        [
+            ("exact", 100.0 * _sequential_sum(exact) / total),
+            ("f1", 100.0 * _sequential_sum(f1) / total),
+            ("total", total),
+        ]
+    )
+
+
+def best_thresholds(gold, preds, questions, scores, na_probs):
+    """
+    Best no answer threshold of every row of `scores` (e.g. exact and f1), in a single cumulative sum over the
+    questions sorted by no answer probability. Same as find_best_thresh_v2 for every metric.
+
+    Returns:
+        a list of (best score, best threshold, score on the questions with an answer) per metric
+    """
+    qid_list = list(na_probs)
+    probs = np.array([na_probs[qid] for qid in qid_list], dtype=np.float64)
+    order = np.argsort(probs, kind="stable")
+    question_of = {qid: i for i, qid in enumerate(gold.qids)}
+    scored = {gold.qids[q]: k for k, q in enumerate(questions)}
+    has_ans = np.array([gold.has_ans[question_of[qid]] for qid in qid_list])[order]
+    in_scores = np.array([qid in scored for qid in qid_list])[order]
+    score_at = np.array([scored.get(qid, 0) for qid in qid_list], dtype=np.int64)[order]
+    no_ans_diff = np.array([-1.0 if preds.get(qid) else 0.0 for qid in qid_list])[order]
+    num_no_ans = int((~gold.has_ans).sum())
+    results = []
+    for row in scores:
+        diff = np.where(has_ans, row[score_at] if len(row) else 0.0, no_ans_diff)[in_scores]
+        cumulative = np.cumsum(np.concatenate([[num_no_ans], diff]))[1:]
+        best_score, best_thresh = num_no_ans, 0.0
+        if len(cumulative) and cumulative.max() > num_no_ans:
+            best = int(np.argmax(cumulative))
+            best_score = float(cumulative[best])
+            best_thresh = float(probs[order][in_scores][best])
+        has_ans_score = _sequential_sum(row[score_at[has_ans & in_scores]]) if len(row) else 0
+        results.append((100.0 * best_score / len(questions), best_thresh, 1.0 * has_ans_score / int(has_ans.sum())))
+    return results
+
+
+def squad_evaluate_predictions(examples, preds, no_answer_probs=None, no_answer_probability_threshold=1.0):
+    """
+    Scores the predictions of a SQuAD dev set, same output as the scoring of :func:`Distiller.evaluate._squad_evaluate`.
+
+    Args:
+        examples: the dev examples.
+        preds (dict): predicted answer text of every qas_id.
+        no_answer_probs (dict): no answer probability of every qas_id, defaults to 0 for every prediction.
+        no_answer_probability_threshold (float): questions above it are predicted unanswerable.
+    """
+    gold = GoldAnswers.from_examples(examples)
+    if no_answer_probs is None:
+        no_answer_probs = {k: 0.0 for k in preds}
+    questions, exact, f1 = raw_scores(gold, preds)
+
+    pred_na = np.array([no_answer_probs[gold.qids[q]] > no_answer_probability_threshold for q in questions],
+                       dtype=bool)
+    no_ans_score = (~gold.has_ans[questions]).astype(np.float64)
+    exact_threshold = np.where(pred_na, no_ans_score, exact)
+    f1_threshold = np.where(pred_na, no_ans_score, f1)
+
+    evaluation = _eval_dict(exact_threshold, f1_threshold)
+    has_ans = gold.has_ans[questions]
+    if has_ans.any():
+        for k, v in _eval_dict(exact_threshold, f1_threshold, has_ans).items():
+            evaluation["HasAns_%s" % k] = v
+    if (~has_ans).any():
+        for k, v in _eval_dict(exact_threshold, f1_threshold, ~has_ans).items():
+            evaluation["NoAns_%s" % k] = v
+
+    if no_answer_probs:
+        (best_exact, exact_thresh, has_ans_exact), (best_f1, f1_thresh, has_ans_f1) = \
+            best_thresholds(gold, preds, questions, np.stack([exact, f1]), no_answer_probs)
+        evaluation["best_exact"] = best_exact
+        evaluation["best_exact_thresh"] = exact_thresh
+        evaluation["best_f1"] = best_f1
+        evaluation["best_f1_thresh"] = f1_thresh
+        evaluation["has_ans_exact"] = has_ans_exact
+        evaluation["has_ans_f1"] = has_ans_f1
+    return evaluation
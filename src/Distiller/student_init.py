@@ -0,0 +1,104 @@
+import os
+import re
+import json
+import hashlib
+from .textbrewer.pseudo_labels import teacher_checkpoint_hash
+from .utils import Logger
+# Students built from the layers of their teacher: the embeddings, the teacher layers selected by a layer mapping and
+# the task head are copied into a shallower model, and the result is cached so that a sweep builds it only once.
+
+logger = Logger("all.log",level="debug").logger
+
+_LAYER_PATTERN = re.compile(r"(\.layer\.)(\d+)(\.)")
+
+
+def student_layer_map(t_num_layers, s_num_layers, strategy="skip"):
+    """
+    Returns, for every student layer, the teacher layer it is initialized from. The strategies follow the hidden
+    state matches of :func:`Distiller.utils.cal_layer_mapping`.
+
+    Args:
+        strategy (str): ``"skip"`` takes every k-th teacher layer, ``"first"`` the lowest layers and ``"last"`` the
+            highest ones.
+    """
+    assert s_num_layers <= t_num_layers
+    if strategy == "first":
+        return list(range(s_num_layers))
+    elif strategy == "last":
+        return [t_num_layers - s_num_layers + i for i in range(s_num_layers)]
+    elif strategy in ["skip", "emd", None]:
+        k = t_num_layers / s_num_layers
+        return [int((i + 1) * k) - 1 for i in range(s_num_layers)]
+    raise NotImplementedError(f"Unknown layer mapping strategy {strategy}")
+
+
+def copy_teacher_weights(t_model, s_model, layer_map, copy_head=True, truncate=False):
+    """
+    Copies the weights of `t_model` into `s_model`. Student layer ``i`` receives teacher layer ``layer_map[i]``, the
+    other weights are copied by name.
+
+    Args:
+        copy_head (bool): whether to copy the task head (the weights outside of the base model).
+        truncate (bool): if the student is narrower than the teacher (e.g. fewer attention heads or a smaller
+            intermediate size), copies the leading slice of the teacher weights. Otherwise such weights keep their
+            random initialization.
+    Returns:
+        the names of the student weights that were not copied
+    """
+    t_state = t_model.state_dict()
+    s_state = s_model.state_dict()
+    base_prefix = getattr(s_model, "base_model_prefix", "")
+    skipped = []
+    for name, s_tensor in s_state.items():
+        t_name = _LAYER_PATTERN.sub(lambda m: f"{m.group(1)}{layer_map[int(m.group(2))]}{m.group(3)}", name, count=1)
+        if not copy_head and base_prefix and not name.startswith(base_prefix + "."):
+            skipped.append(name)
+            continue
+        t_tensor = t_state.get(t_name)
+        if t_tensor is None:
+            skipped.append(name)
+        elif t_tensor.shape == s_tensor.shape:
+            s_tensor.copy_(t_tensor)
+        elif truncate and t_tensor.dim() == s_tensor.dim() and all(s <= t for s, t in zip(s_tensor.shape, t_tensor.shape)):
+            s_tensor.copy_(t_tensor[tuple(slice(0, size) for size in s_tensor.shape)])
+        else:
+            skipped.append(name)
+    if skipped:
+        logger.warning(f"Not initialized from the teacher: {skipped}")
+    return skipped
+
+
+def init_student_from_teacher(t_model, s_config, strategy="skip", layer_map=None, copy_head=True, truncate=False,
+                              cache_dir=None):
+    """
+    Builds a student of the class of `t_model` with the architecture `s_config`, initialized from the teacher.
+    When `cache_dir` is given, the student is stored there, keyed by the hash of the teacher weights, the student
+    config and the layer mapping, and loaded from there by the following runs.
+
+    Args:
+        t_model: teacher model, e.g. a ``BertForSequenceClassification``.
+        s_config: config of the student, e.g. one of ``experiments/student_configs``.
+        strategy (str): layer mapping strategy, see :func:`student_layer_map`. Ignored if `layer_map` is given.
+        layer_map (list): teacher layer of every student layer.
+        copy_head (bool), truncate (bool): see :func:`copy_teacher_weights`.
+        cache_dir (str): directory of the cached students, None disables the cache.
+    """
+    teacher = t_model.module if hasattr(t_model, "module") else t_model
+    if layer_map is None:
+        layer_map = student_layer_map(teacher.config.num_hidden_layers, s_config.num_hidden_layers, strategy)
+    assert len(layer_map) == s_config.num_hidden_layers
+    model_class = type(teacher)
+    cache_path = None
+    if cache_dir is not None:
+        key = json.dumps({"teacher": teacher_checkpoint_hash(teacher), "student": s_config.to_diff_dict(),
+                          "layer_map": layer_map, "copy_head": copy_head, "truncate": truncate}, sort_keys=True)
+        cache_path = os.path.join(cache_dir, f"student_init_{hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]}")
+        if os.path.exists(os.path.join(cache_path, "config.json")):
+            logger.info(f"Loading the student initialized from the teacher from {cache_path}")
+            return model_class.from_pretrained(cache_path, config=s_config)
+    logger.info(f"Initializing the student from teacher layers {layer_map}")
+    s_model = model_class(s_config)
+    copy_teacher_weights(teacher, s_model, layer_map, copy_head=copy_head, truncate=truncate)
+    if cache_path is not None:
+        s_model.save_pretrained(cache_path)
+    return s_model
@@ -7,6 +7,9 @@ from .distillers import MultiTaskDistiller
 from .distillers import MultiTeacherDistiller
 from .distillers import EMDDistiller
 
+from .ensemble import EnsembleSoftLabelStore, EnsembleSoftLabelDataset
+from .pseudo_labels import PseudoLabelCache, IndexedDataset
+
 from .configurations import TrainingConfig, DistillationConfig
 
 from .presets import FEATURES
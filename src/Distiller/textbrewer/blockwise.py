@@ -0,0 +1,143 @@
+import math
+import functools
+import torch
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+# Blockwise attention distillation. Instead of returning the (batch_size, num_heads, length, length) attention maps of
+# every layer, the models are run with output_attentions=False and AttentionCapture keeps the queries, keys and
+# attention mask of every self-attention layer. The attention losses of losses.py then recompute the attention rows
+# of `block_size` queries at a time, and each block is checkpointed: its rows are recomputed during the backward pass
+# instead of being kept, so no full map of the teacher or of the student is held for the loss.
+
+DEFAULT_BLOCK_SIZE = 64
+# block size of the hidden state (gram matrix) losses, None to compute them in one piece, see set_block_size
+_block_size = None
+
+
+def set_block_size(block_size):
+    """Computes :func:`~textbrewer.losses.mmd_loss` blockwise over `block_size` rows (None to disable)."""
+    global _block_size
+    _block_size = block_size
+
+
+def get_block_size():
+    return _block_size
+
+
+class AttentionFactors(object):
+    '''
+    * The inputs of the attention probabilities of one layer: ``softmax(query @ key^T / scale + attention_mask)``.
+    * Rows are computed by :func:`attention_rows`, before attention dropout (the maps returned with ``output_attentions`` are
+      after dropout, they are the same in eval mode or when ``attention_probs_dropout_prob`` is 0).
+
+    :param torch.Tensor query: tensor of shape (*batch_size*, *num_heads*, *length*, *head_size*)
+    :param torch.Tensor key: tensor of shape (*batch_size*, *num_heads*, *length*, *head_size*)
+    :param torch.Tensor attention_mask: additive mask broadcastable to (*batch_size*, *num_heads*, *length*, *length*), or None
+    :param float scale: divisor of the scores, the square root of the head size
+    :param int block_size: number of query rows per block
+    '''
+    def __init__(self, query, key, attention_mask=None, scale=1.0, block_size=DEFAULT_BLOCK_SIZE):
+        self.query = query
+        self.key = key
+        self.attention_mask = attention_mask
+        self.scale = scale
+        self.block_size = block_size
+
+    def size(self, dim=None):
+        shape = self.query.shape[:3] + (self.key.size(2),)
+        return shape if dim is None else shape[dim]
+
+    def blocks(self):
+        length = self.query.size(2)
+        return [(start, min(start + self.block_size, length)) for start in range(0, length, self.block_size)]
+
+
+def attention_rows(query, key, attention_mask, scale):
+    """Attention probabilities of the rows of `query`, computed as in the self-attention layers."""
+    scores = torch.matmul(query, key.transpose(-1, -2))
+    scores = scores / scale
+    if attention_mask is not None:
+        scores = scores + attention_mask
+    return F.softmax(scores, dim=-1)
+
+
+def _mask_rows(attention_mask, start, end):
+    # (batch_size, 1, 1, length) masks apply to every row, (batch_size, 1, length, length) ones (packed rows) per row
+    if attention_mask is None or attention_mask.size(-2) == 1:
+        return attention_mask
+    return attention_mask[..., start:end, :]
+
+
+def blockwise_sum(block_fn, factors_S, factors_T):
+    '''
+    * Sums ``block_fn(rows_S, rows_T, start, end)`` over the query blocks, where `rows_S` and `rows_T` are the attention
+      rows ``start:end`` of the student and of the teacher. Each block is checkpointed when the student requires grad.
+    '''
+    assert factors_S.query.size(2) == factors_T.query.size(2), "student and teacher sequence lengths differ"
+    total = 0
+    for start, end in factors_S.blocks():
+        def block(q_S, k_S, m_S, q_T, k_T, m_T, start=start, end=end):
+            rows_S = attention_rows(q_S, k_S, m_S, factors_S.scale)
+            rows_T = attention_rows(q_T, k_T, m_T, factors_T.scale)
+            return block_fn(rows_S, rows_T, start, end)
+        inputs = (factors_S.query[:, :, start:end], factors_S.key, _mask_rows(factors_S.attention_mask, start, end),
+                  factors_T.query[:, :, start:end], factors_T.key, _mask_rows(factors_T.attention_mask, start, end))
+        if torch.is_grad_enabled() and factors_S.query.requires_grad:
+            total = total + checkpoint(block, *inputs)
+        else:
+            total = total + block(*inputs)
+    return total
+
+
+class AttentionCapture(object):
+    '''
+    * Keeps the queries, keys and attention masks of the self-attention layers of `model` (BERT style layers, with
+      ``query`` and ``key`` projections and absolute position embeddings) at every forward.
+    * :meth:`pop` returns the :class:`AttentionFactors` of the last forward, in layer order, in place of
+      ``model_outputs.attentions``.
+
+    :param torch.nn.Module model: the model, not wrapped by ``DataParallel``
+    :param int block_size: number of query rows per block
+    '''
+    def __init__(self, model, block_size=DEFAULT_BLOCK_SIZE):
+        self.block_size = block_size
+        self.layers = [m for m in model.modules() if hasattr(m, "query") and hasattr(m, "key")
+                       and hasattr(m, "transpose_for_scores")]
+        assert self.layers, f"no self-attention layer found in {type(model).__name__}"
+        self.handles = []
+        self.captured = {}
+        for index, layer in enumerate(self.layers):
+            assert getattr(layer, "position_embedding_type", "absolute") == "absolute", \
+                "blockwise attention only supports absolute position embeddings"
+            self.handles.append(layer.register_forward_pre_hook(functools.partial(self._save_mask, index)))
+            self.handles.append(layer.query.register_forward_hook(functools.partial(self._save, index, "query")))
+            self.handles.append(layer.key.register_forward_hook(functools.partial(self._save, index, "key")))
+
+    def _save_mask(self, index, module, inputs):
+        self.captured.setdefault(index, {})["attention_mask"] = inputs[1] if len(inputs) > 1 else None
+
+    def _save(self, index, name, module, inputs, output):
+        self.captured.setdefault(index, {})[name] = self.layers[index].transpose_for_scores(output)
+
+    def pop(self):
+        """The :class:`AttentionFactors` of every layer run by the last forward."""
+        factors = tuple(
+            AttentionFactors(self.captured[i]["query"], self.captured[i]["key"], self.captured[i].get("attention_mask"),
+                             scale=math.sqrt(self.layers[i].attention_head_size), block_size=self.block_size)
+            for i in sorted(self.captured))
+        self.captured = {}
+        return factors
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+
+def blockwise_adaptor(adaptor, capture):
+    """Wraps `adaptor` to return the attention factors captured by `capture` as the ``attention`` feature."""
+    def wrapped(batch, model_outputs, *args, **kwargs):
+        dict_obj = adaptor(batch, model_outputs, *args, **kwargs)
+        dict_obj['attention'] = capture.pop()
+        return dict_obj
+    return wrapped
@@ -0,0 +1,194 @@
+import warnings
+from collections import OrderedDict
+import torch
+from torch import nn
+from .presets import FEATURES, KD_LOSS_MAP, MATCH_LOSS_MAP
+from .blockwise import get_block_size
+from Distiller.utils import Logger
+# Compiled distillation objective. For a fixed match configuration the KD loss and the intermediate matches of
+# GeneralDistiller.compute_loss are planned once (loss functions, layers, projections, weights and log names) into an
+# nn.Module, which is traced with torch.jit.trace for every new signature (shapes, dtypes and devices) of the inputs,
+# up to `max_graphs` signatures. Other signatures, e.g. the last partial batch once the graphs are used up, run the
+# same module eagerly, so the loss is the same whichever path computes it.
+
+logger = Logger("all.log",level="debug").logger
+
+# losses whose traced graph does not depend on the values of their inputs (no data dependent shape or control flow)
+TRACEABLE_KD_LOSSES = {'mse', 'ce'}
+TRACEABLE_MATCH_LOSSES = {'attention_mse_sum', 'attention_mse', 'attention_ce_mean', 'attention_ce',
+                          'hidden_mse', 'hidden_ce', 'pkd', 'gram', 'fsp', 'mmd', 'nst'}
+
+
+def unsupported_reason(distill_config, has_custom_matches=False):
+    """Why the objective of `distill_config` cannot be compiled, or None."""
+    if distill_config.temperature_scheduler is not None:
+        return "temperature_scheduler"
+    if distill_config.probability_shift:
+        return "probability_shift"
+    if has_custom_matches:
+        return "custom matches"
+    if distill_config.kd_loss_type not in TRACEABLE_KD_LOSSES:
+        return f"kd loss {distill_config.kd_loss_type}"
+    for match in distill_config.intermediate_matches:
+        if match.loss not in TRACEABLE_MATCH_LOSSES:
+            return f"match loss {match.loss}"
+        if match.loss in ['mmd', 'nst'] and get_block_size() is not None:
+            return "blockwise mmd loss"
+    return None
+
+
+class _ObjectiveModule(nn.Module):
+    '''
+    * The KD and intermediate losses of one input layout, as a module so that tracing keeps the projections as
+      parameters (shared with the distiller and its optimizer) instead of constants.
+    * ``forward`` takes the flat tuple of tensors built by :meth:`CompiledObjective.flatten` and returns the total loss
+      followed by the unweighted losses.
+
+    :param list plan: ``(loss_fn, match_weight, projection_index, num_layers)`` of every match, `num_layers` is 0 for single layer matches
+    :param int num_logits: number of logits tensors of each model, 0 without KD loss
+    :param bool has_mask: whether the last input is the inputs mask of the student
+    '''
+    def __init__(self, plan, projs, kd_loss, temperature, num_logits, has_mask):
+        super(_ObjectiveModule, self).__init__()
+        self.plan = plan
+        self.projs = projs
+        self.kd_loss = kd_loss
+        self.temperature = temperature
+        self.num_logits = num_logits
+        self.has_mask = has_mask
+
+    def forward(self, kd_loss_weight, *tensors):
+        mask = tensors[-1] if self.has_mask else None
+        logits_S = tensors[:self.num_logits]
+        logits_T = tensors[self.num_logits:2 * self.num_logits]
+        position = 2 * self.num_logits
+        total_loss = 0
+        losses = []
+        if self.num_logits > 0:
+            total_kd_loss = 0
+            for l_S, l_T in zip(logits_S, logits_T):
+                total_kd_loss = total_kd_loss + self.kd_loss(l_S, l_T, self.temperature)
+            total_loss = total_loss + total_kd_loss * kd_loss_weight
+            losses.append(total_kd_loss)
+        for loss_fn, match_weight, proj_index, num_layers in self.plan:
+            size = num_layers or 1
+            inter_S = list(tensors[position:position + size])
+            inter_T = list(tensors[position + size:position + 2 * size])
+            position += 2 * size
+            if proj_index is not None:
+                inter_S = [self.projs[proj_index](s) for s in inter_S]
+            if not num_layers:
+                inter_S, inter_T = inter_S[0], inter_T[0]
+            intermediate_loss = loss_fn(inter_S, inter_T, mask=mask)
+            total_loss = total_loss + intermediate_loss * match_weight
+            losses.append(intermediate_loss)
+        return (total_loss,) + tuple(losses)
+
+
+class CompiledObjective(object):
+    '''
+    * Computes the KD loss and the intermediate losses of :meth:`GeneralDistiller.compute_loss` with graphs traced by
+      ``torch.jit.trace``, one per input signature.
+    * Calling it returns ``(total_loss, losses_dict)`` as the eager code does, or None when the outputs of the adaptors
+      cannot be traced (logits masks, attention factors of :mod:`~textbrewer.blockwise`), in which case the caller
+      computes the loss eagerly.
+
+    :param DistillationConfig distill_config: the distillation configuration, its matches must not change afterwards
+    :param list projs: projections of the matches (None for the matches without projection), as in :class:`GeneralDistiller`
+    :param int max_graphs: number of input signatures traced, the others run eagerly
+    '''
+    def __init__(self, distill_config, projs, max_graphs=8):
+        reason = unsupported_reason(distill_config)
+        assert reason is None, f"the distillation objective cannot be compiled: {reason}"
+        self.d_config = distill_config
+        self.max_graphs = max_graphs
+        self.projs = nn.ModuleList([proj if proj is not None else nn.Identity() for proj in projs])
+        self.kd_loss = KD_LOSS_MAP[distill_config.kd_loss_type]
+        self.matches = []
+        self.plan = []
+        for ith, match in enumerate(distill_config.intermediate_matches):
+            if type(match.layer_S) is list and type(match.layer_T) is list:
+                name = f"unweighted_{match.feature}_{match.loss}_{'-'.join(map(str, match.layer_S))}_" \
+                       f"{'-'.join(map(str, match.layer_T))}"
+                num_layers = len(match.layer_S)
+            else:
+                name = f"unweighted_{match.feature}_{match.loss}_{match.layer_S}_{match.layer_T}"
+                num_layers = 0
+            self.matches.append((match.feature, match.layer_S, match.layer_T, name))
+            self.plan.append((MATCH_LOSS_MAP[match.loss], match.weight,
+                              ith if projs[ith] is not None else None, num_layers))
+        self.graphs = OrderedDict()
+        self.eager_modules = {}
+        self.eager_steps = 0
+
+    def flatten(self, results_S, results_T):
+        """The tensors the objective reads from the adaptor outputs, in the order of :class:`_ObjectiveModule`, or None."""
+        if 'logits_mask' in results_S or 'logits_mask' in results_T:
+            return None
+        tensors = []
+        num_logits = 0
+        if 'logits' in results_T and 'logits' in results_S:
+            num_logits = len(results_S['logits'])
+            tensors.extend(results_S['logits'])
+            tensors.extend(results_T['logits'])
+        inters_S = {feature: results_S.get(feature, []) for feature in FEATURES}
+        inters_T = {feature: results_T.get(feature, []) for feature in FEATURES}
+        for feature, layer_S, layer_T, _ in self.matches:
+            if type(layer_S) is list:
+                tensors.extend(inters_S[feature][s] for s in layer_S)
+                tensors.extend(inters_T[feature][t] for t in layer_T)
+            else:
+                tensors.append(inters_S[feature][layer_S])
+                tensors.append(inters_T[feature][layer_T])
+        mask = results_S.get('inputs_mask', None)
+        if mask is not None:
+            tensors.append(mask)
+        if not all(isinstance(t, torch.Tensor) for t in tensors):
+            return None
+        return num_logits, mask is not None, tuple(tensors)
+
+    def module(self, num_logits, has_mask):
+        """The eager module of an input layout."""
+        if (num_logits, has_mask) not in self.eager_modules:
+            self.eager_modules[(num_logits, has_mask)] = _ObjectiveModule(
+                self.plan, self.projs, self.kd_loss, self.d_config.temperature, num_logits, has_mask)
+        return self.eager_modules[(num_logits, has_mask)]
+
+    def graph(self, num_logits, has_mask, inputs):
+        """The traced module of the signature of `inputs`, traced on first use; None once `max_graphs` are traced."""
+        signature = (num_logits, has_mask, torch.is_grad_enabled()) + \
+            tuple((tuple(t.shape), t.dtype, t.device, t.requires_grad) for t in inputs[1:])
+        if signature in self.graphs:
+            return self.graphs[signature]
+        if len(self.graphs) >= self.max_graphs:
+            return None
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", torch.jit.TracerWarning)
+                graph = torch.jit.trace(self.module(num_logits, has_mask), inputs, check_trace=False)
+        except Exception as e:
+            logger.warning(f"Tracing the distillation objective failed, it runs eagerly for these shapes: {e!r}")
+            graph = None
+        self.graphs[signature] = graph
+        logger.info(f"Traced the distillation objective for {len(self.graphs)} input signatures")
+        return graph
+
+    def __call__(self, results_S, results_T):
+        flat = self.flatten(results_S, results_T)
+        if flat is None:
+            return None
+        num_logits, has_mask, tensors = flat
+        kd_loss_weight = torch.tensor(float(self.d_config.kd_loss_weight), device=tensors[0].device)
+        inputs = (kd_loss_weight,) + tensors
+        graph = self.graph(num_logits, has_mask, inputs)
+        if graph is None:
+            self.eager_steps += 1
+            graph = self.module(num_logits, has_mask)
+        outputs = graph(*inputs)
+        losses = iter(outputs[1:])
+        losses_dict = dict()
+        if num_logits > 0:
+            losses_dict['unweighted_kd_loss'] = next(losses)
+        for (_, _, _, name), loss in zip(self.matches, losses):
+            losses_dict[name] = loss
+        return outputs[0], losses_dict
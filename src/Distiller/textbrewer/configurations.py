@@ -48,6 +48,8 @@ class TrainingConfig(Config):
         fp16_opt_level(str): Pure or mixed precision optimization level. Accepted values are "O0", "O1", "O2", and "O3". See Apex documenation for details.
         data_parallel (bool): If ``True``, wraps the models with ``torch.nn.DataParallel``.
         local_rank (int): the local rank of the current processes. A non-nagative value means that we are in the distributed training mode with ``DistributedDataParallel``.  
+        tensor_augmenter (:class:`~textbrewer.data_utils.TensorAugmenter`): if set and ``repeated_aug > 1``, every batch is extended with ``repeated_aug - 1`` token level perturbed copies, in place of the text augmentation of ``augmenter``.
+        replay (:class:`~textbrewer.replay.ReplayLog`): if set, the example indices, augmented training set and mixup parameters of every step are recorded to the log, or replayed from it. Not available with ``repeated_aug > 1``, ``tensor_augmenter``, logits caching or distributed training.
     Note:
         * To perform data parallel (DP) training, you could either wrap the models with ``torch.nn.DataParallel`` outside TextBrewer by yourself, or leave the work for TextBrewer by setting **data_parallel** to ``True``.
         * To enable both data parallel training and mixed precision training, you should set **data_parallel** to ``True``, and DO NOT wrap the models by yourself.
@@ -88,6 +90,8 @@ class TrainingConfig(Config):
                  num_reaug=3,
                  tokenizer=None,
                  max_seq_length=128,
+                 tensor_augmenter=None,
+                 replay=None,
                  ):
         super(TrainingConfig, self).__init__()
 
@@ -112,6 +116,8 @@ class TrainingConfig(Config):
         self.num_reaug = num_reaug
         self.tokenizer = tokenizer
         self.max_seq_length = max_seq_length
+        self.tensor_augmenter = tensor_augmenter
+        self.replay = replay
         if self.local_rank == -1 or torch.distributed.get_rank() == 0:
             if not os.path.exists(self.output_dir):
                 os.makedirs(self.output_dir)
@@ -177,6 +183,8 @@ class DistillationConfig(Config):
         hard_label_weight_scheduler: Dynamically adjusts the weight of the sum of ``losses``. See :data:`~textbrewer.presets.WEIGHT_SCHEDULER` for all available options.
         probability_shift (bool): if ``True``, switch the ground-truth label's logit and the largest logit predicted by the teacher, to make the ground-truth label's logit largest. Requires ``labels`` term returned by the adaptor.
         is_caching_logits (bool): if ``True``, caches the batches and the output logits of the teacher model in memory, so that those logits will only be calcuated once. It will speed up the distillation process. This feature is **only available** for :class:`~textbrewer.BasicDistiller` and :class:`~textbrewer.MultiTeacherDistiller`, and only when distillers' ``train()`` method is called with ``num_steps=None``. It is suitable for small and medium datasets.
+        pseudo_label_cache (:class:`~textbrewer.pseudo_labels.PseudoLabelCache`): if set together with ``soft_label_weight``, the teacher pseudo labels of batches carrying ``example_ids``/``aug_ids`` (see :class:`~textbrewer.pseudo_labels.IndexedDataset`) are computed once and then served from the cache.
+        compile_objective (bool): if ``True``, :class:`~textbrewer.GeneralDistiller` computes the KD loss and the intermediate losses with graphs traced once per input shape (see :class:`~textbrewer.compiled_objective.CompiledObjective`), and eagerly for the shapes beyond the traced ones. Not available with temperature schedulers, probability shift, custom matches or the ``cos``, ``nce`` and ``mi`` losses.
         intermediate_matches (`List[Dict]`) : Configuration for intermediate feature matching. Each element in the list is a dict, representing a pair of matching config. 
     
     The dict in `intermediate_matches` contains the following keys:
@@ -244,7 +252,9 @@ class DistillationConfig(Config):
                       alpha=1.0,
                       emd_args = None,
                       intermediate_matches:Optional[List[Dict]]=None,
-                      is_caching_logits = False):
+                      is_caching_logits = False,
+                      pseudo_label_cache = None,
+                      compile_objective = False):
         super(DistillationConfig, self).__init__()
 
         self.temperature = temperature
@@ -280,4 +290,6 @@ class DistillationConfig(Config):
         if intermediate_matches:
             self.intermediate_matches = [IntermediateMatch.from_dict(im) for im in intermediate_matches]
 
-        self.is_caching_logits = is_caching_logits
\ No newline at end of file
+        self.is_caching_logits = is_caching_logits
+        self.pseudo_label_cache = pseudo_label_cache
+        self.compile_objective = compile_objective
\ No newline at end of file
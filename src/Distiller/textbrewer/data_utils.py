@@ -1,5 +1,6 @@
 import numpy as np
 import random
+import torch
 
 def masking(tokens, p = 0.1, mask='[MASK]'):
     """
@@ -118,4 +119,169 @@ def long_disorder(tokens,p = 0.1, length=20):
             i += length
         else:
             i += 1
-    return outputs
\ No newline at end of file
+    return outputs
+
+# Tensor versions of the perturbations above. They work on whole batches of token ids
+# (batch_size, length) instead of python lists, and never touch special tokens, padding
+# or the tokens of the answer span, so that `labels`, `start_positions` and `end_positions`
+# stay valid.
+
+def _protected_span_mask(batch, length):
+    if 'start_positions' not in batch or 'end_positions' not in batch:
+        return None
+    positions = torch.arange(length, device=batch['input_ids'].device).unsqueeze(0)
+    start = batch['start_positions'].view(-1, 1)
+    end = batch['end_positions'].view(-1, 1)
+    return (positions >= start) & (positions <= end)
+
+
+def eligible_tokens_mask(batch, special_token_ids):
+    """
+    Returns a bool tensor of the shape of ``batch['input_ids']``, True for the tokens that can be perturbed:
+    real (non padding) tokens that are neither special tokens nor part of the answer span.
+
+    Args:
+        batch (dict): batch of tensors with at least `input_ids`.
+        special_token_ids (torch.Tensor): ids of the special tokens ([CLS], [SEP], [PAD], ...).
+    """
+    input_ids = batch['input_ids']
+    eligible = ~(input_ids.unsqueeze(-1) == special_token_ids.to(input_ids.device)).any(-1)
+    if 'attention_mask' in batch:
+        eligible &= batch['attention_mask'].bool()
+    answer_span = _protected_span_mask(batch, input_ids.size(1))
+    if answer_span is not None:
+        eligible &= ~answer_span
+    return eligible
+
+
+def batch_masking(batch, mask_token_id, special_token_ids, p=0.1, generator=None):
+    """
+    Replaces each eligible token of ``batch['input_ids']`` by `mask_token_id` with probability `p`.
+    Returns a new batch, the input batch is left untouched.
+    """
+    input_ids = batch['input_ids']
+    eligible = eligible_tokens_mask(batch, special_token_ids)
+    draw = torch.rand(input_ids.shape, generator=generator).to(input_ids.device) < p
+    outputs = dict(batch)
+    outputs['input_ids'] = input_ids.masked_fill(draw & eligible, mask_token_id)
+    return outputs
+
+
+def batch_deleting(batch, special_token_ids, p=0.1, pad_token_id=0, generator=None):
+    """
+    Deletes each eligible token with probability `p`. The remaining tokens are shifted to the left, the sequences
+    are padded again to the original length and `start_positions`/`end_positions` are moved accordingly.
+    Returns a new batch.
+    """
+    input_ids = batch['input_ids']
+    batch_size, length = input_ids.shape
+    eligible = eligible_tokens_mask(batch, special_token_ids)
+    draw = torch.rand(input_ids.shape, generator=generator).to(input_ids.device) < p
+    keep = ~(draw & eligible)
+    new_positions = keep.long().cumsum(-1) - 1
+    rows, cols = keep.nonzero(as_tuple=True)
+    target_cols = new_positions[rows, cols]
+    outputs = dict(batch)
+    for key, fill_value in (('input_ids', pad_token_id), ('attention_mask', 0), ('token_type_ids', 0)):
+        if key not in batch:
+            continue
+        value = batch[key]
+        new_value = torch.full_like(value, fill_value)
+        new_value[rows, target_cols] = value[rows, cols]
+        outputs[key] = new_value
+    # answer tokens are never deleted, so their new positions are well defined
+    for key in ('start_positions', 'end_positions'):
+        if key in batch:
+            outputs[key] = new_positions.gather(1, batch[key].view(-1, 1)).view_as(batch[key])
+    return outputs
+
+
+def batch_short_disorder(batch, special_token_ids, p=0.1, generator=None):
+    """
+    Swaps pairs of neighbouring eligible tokens (of the same segment) with probability `p`.
+    The pairs start at even or odd positions, chosen at random for the batch. Returns a new batch.
+    """
+    input_ids = batch['input_ids']
+    batch_size, length = input_ids.shape
+    device = input_ids.device
+    eligible = eligible_tokens_mask(batch, special_token_ids)
+    offset = int(torch.randint(0, 2, (1,), generator=generator))
+    first = torch.arange(offset, length - 1, 2, device=device)
+    if first.numel() == 0:
+        return dict(batch)
+    second = first + 1
+    swap = eligible[:, first] & eligible[:, second]
+    if 'token_type_ids' in batch:
+        swap &= batch['token_type_ids'][:, first] == batch['token_type_ids'][:, second]
+    swap &= torch.rand(swap.shape, generator=generator).to(device) < p
+    permutation = torch.arange(length, device=device).repeat(batch_size, 1)
+    permutation[:, first] = torch.where(swap, second.expand_as(swap), first.expand_as(swap))
+    permutation[:, second] = torch.where(swap, first.expand_as(swap), second.expand_as(swap))
+    outputs = dict(batch)
+    outputs['input_ids'] = input_ids.gather(1, permutation)
+    return outputs
+
+
+class TensorAugmenter:
+    """
+    Applies :func:`batch_masking`, :func:`batch_short_disorder` and :func:`batch_deleting` (in this order) to
+    tokenized batches.
+
+    Args:
+        operations (List[str]): perturbations to apply, among ``'mask'``, ``'disorder'`` and ``'delete'``.
+        mask_token_id (int): id of the mask token.
+        special_token_ids (List[int]): ids of the special tokens that must not be perturbed.
+        pad_token_id (int): id of the padding token.
+        p (float): probability to perturb each eligible token.
+        seed (int): seed of the random generator, None uses the global torch generator.
+    """
+    OPERATIONS = ('mask', 'disorder', 'delete')
+
+    def __init__(self, operations, mask_token_id, special_token_ids, pad_token_id=0, p=0.1, seed=None):
+        for operation in operations:
+            if operation not in self.OPERATIONS:
+                raise KeyError(f"Unknown augmentation {operation}, should be one of {self.OPERATIONS}")
+        self.operations = [operation for operation in self.OPERATIONS if operation in operations]
+        self.mask_token_id = mask_token_id
+        self.special_token_ids = torch.tensor(sorted(set(special_token_ids)), dtype=torch.long)
+        self.pad_token_id = pad_token_id
+        self.p = p
+        self.generator = None
+        if seed is not None:
+            self.generator = torch.Generator()
+            self.generator.manual_seed(seed)
+
+    @classmethod
+    def from_tokenizer(cls, tokenizer, operations, p=0.1, seed=None):
+        return cls(operations, tokenizer.mask_token_id, tokenizer.all_special_ids,
+                   pad_token_id=tokenizer.pad_token_id, p=p, seed=seed)
+
+    def augment(self, batch):
+        """Returns one perturbed copy of a batch (dict of tensors)."""
+        for operation in self.operations:
+            if operation == 'mask':
+                batch = batch_masking(batch, self.mask_token_id, self.special_token_ids, self.p, self.generator)
+            elif operation == 'disorder':
+                batch = batch_short_disorder(batch, self.special_token_ids, self.p, self.generator)
+            else:
+                batch = batch_deleting(batch, self.special_token_ids, self.p, self.pad_token_id, self.generator)
+        return batch
+
+    def __call__(self, batch, repeated_aug=2):
+        """
+        Returns the batch concatenated with ``repeated_aug - 1`` perturbed copies of it, ``repeated_aug`` must be
+        greater than 1. Batches with separate ``teacher`` and ``student`` inputs are supported only when both share the
+        same token ids.
+        """
+        if repeated_aug <= 1:
+            raise ValueError(f"Token level augmentation needs repeated_aug > 1, got {repeated_aug}")
+        if isinstance(batch, dict) and 'teacher' in batch and 'student' in batch:
+            if not torch.equal(batch['teacher']['input_ids'], batch['student']['input_ids']):
+                raise NotImplementedError("Token level augmentation requires the teacher and the student to share "
+                                          "the same vocabulary")
+            teacher_batch = self(batch['teacher'], repeated_aug)
+            student_batch = {k: teacher_batch[k] if k in teacher_batch else torch.cat([v] * repeated_aug, 0)
+                             for k, v in batch['student'].items()}
+            return {'teacher': teacher_batch, 'student': student_batch}
+        copies = [batch] + [self.augment(batch) for _ in range(repeated_aug - 1)]
+        return {k: torch.cat([copy[k] for copy in copies], 0) for k in batch}
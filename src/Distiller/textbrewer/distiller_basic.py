@@ -1,4 +1,5 @@
 from .distiller_utils import *
+from .pseudo_labels import IndexedDataset
 from torch.utils.data import DataLoader, RandomSampler
 from torch.utils.data.distributed import DistributedSampler
 from torch.multiprocessing import cpu_count, Pool
@@ -135,13 +136,68 @@ class BasicDistiller(AbstractDistiller):
         tqdm_disable = None if self.rank == 0 else True
         return optimizer, scheduler, tqdm_disable
 
+    def training_state(self):
+        """
+        Returns everything needed to resume the distillation from the current step: the student, the projections,
+        the MI critics and baselines, the optimizer, the scheduler and the global step. Only available during
+        :meth:`train`.
+        """
+        def module_state(module):
+            if module is None:
+                return None
+            if isinstance(module, (list, tuple)):
+                return [module_state(m) for m in module]
+            return (module.module if hasattr(module, "module") else module).state_dict()
+        return {'model_S': module_state(self.model_S),
+                'projs': module_state(getattr(self, 'projs', None)),
+                'critic': module_state(self.d_config.critic),
+                'baseline_fn': module_state(self.d_config.baseline_fn),
+                'optimizer': self.optimizer.state_dict(),
+                'scheduler': self.scheduler.state_dict() if self.scheduler is not None else None,
+                'global_step': self.global_step}
+
+    def load_training_state(self, state, lr_scale=1.0):
+        """
+        Restores a state returned by :meth:`training_state`.
+
+        Args:
+            state (dict): the training state.
+            lr_scale (float): the learning rates of the restored optimizer and scheduler are multiplied by `lr_scale`.
+        Returns:
+            the global step of the state
+        """
+        def load_module_state(module, module_state):
+            if module is None or module_state is None:
+                return
+            if isinstance(module, (list, tuple)):
+                for m, m_state in zip(module, module_state):
+                    load_module_state(m, m_state)
+                return
+            (module.module if hasattr(module, "module") else module).load_state_dict(module_state)
+        load_module_state(self.model_S, state['model_S'])
+        load_module_state(getattr(self, 'projs', None), state['projs'])
+        load_module_state(self.d_config.critic, state['critic'])
+        load_module_state(self.d_config.baseline_fn, state['baseline_fn'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        if self.scheduler is not None and state['scheduler'] is not None:
+            self.scheduler.load_state_dict(state['scheduler'])
+        if lr_scale != 1.0:
+            for group in self.optimizer.param_groups:
+                group['lr'] *= lr_scale
+                if 'initial_lr' in group:
+                    group['initial_lr'] *= lr_scale
+            if self.scheduler is not None and hasattr(self.scheduler, 'base_lrs'):
+                self.scheduler.base_lrs = [lr * lr_scale for lr in self.scheduler.base_lrs]
+        return state['global_step']
+
     def train_with_num_steps(self, optimizer, scheduler, tqdm_disable, dataloader, max_grad_norm, num_steps, callback,
-                             batch_postprocessor, **args):
+                             batch_postprocessor, initial_step=0, **args):
         if self.d_config.is_caching_logits is True:
             raise AssertionError("You cannot set is_caching_logits to True with num_steps not None!")
+        scaler = amp.GradScaler()
         total_global_steps = num_steps
-        ckpt_steps = int(self.t_config.ckpt_steps)
         num_steps = int(num_steps)
+        ckpt_steps = int(self.t_config.ckpt_steps) if self.t_config.ckpt_steps else num_steps
         print_every = ckpt_steps // self.print_freq
         if print_every == 0:
             print_every = ckpt_steps
@@ -149,34 +205,55 @@ class BasicDistiller(AbstractDistiller):
         logger.info(f"Total training steps: {total_global_steps}")
         logger.info(f"Checkpoints(step): {checkpoints}")
 
-        global_step = 0
-        writer_step = 0
+        global_step = initial_step
+        writer_step = initial_step * self.t_config.gradient_accumulation_steps
+        self.global_step = global_step
+        if self.replay is not None:
+            dataloader = self.replay.wrap(dataloader, 0)
         for step, batch in tqdm(enumerate(cycle(dataloader)), disable=tqdm_disable):
+            if self.replay is not None:
+                self.mixup_params = self.replay.step(self.t_config.mixup)
+            if self.t_config.tensor_augmenter is not None and self.t_config.repeated_aug > 1:
+                batch = self.t_config.tensor_augmenter(batch, self.t_config.repeated_aug)
+            elif self.t_config.repeated_aug > 1:
+                batch = self.augment_data(batch)
+                features, s_features = self.t_config.processor.convert_examples_to_features(batch, disable=True)
+                batch = self.t_config.processor.convert_features_to_bacth(features, s_features)
             if batch_postprocessor is not None:
                 batch = batch_postprocessor(batch)
-            total_loss, losses_dict = self.train_on_batch(batch, args)
+            if self.t_config.fp16:
+                with amp.autocast():
+                    total_loss, losses_dict = self.train_on_batch(batch, args)
+            else:
+                total_loss, losses_dict = self.train_on_batch(batch, args)
 
             self.write_loss(total_loss, writer_step, losses_dict)
             writer_step += 1
 
             total_loss /= self.t_config.gradient_accumulation_steps
             if self.t_config.fp16:
-                with amp.scale_loss(total_loss, optimizer) as scaled_loss:
-                    scaled_loss.backward()
+                scaler.scale(total_loss).backward()
             else:
                 total_loss.backward()
 
             if (step + 1) % self.t_config.gradient_accumulation_steps == 0:
                 if max_grad_norm > 0:
                     if self.t_config.fp16:
-                        torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), max_grad_norm)
-                    else:
-                        torch.nn.utils.clip_grad_norm_(self.model_S.parameters(), max_grad_norm)
-                optimizer.step()
+                        scaler.unscale_(optimizer)
+                    torch.nn.utils.clip_grad_norm_(self.model_S.parameters(), max_grad_norm)
+                    if self.d_config.critic and self.d_config.baseline_fn:
+                        torch.nn.utils.clip_grad_norm_(self.d_config.critic.parameters(), max_grad_norm)
+                        torch.nn.utils.clip_grad_norm_(self.d_config.baseline_fn.parameters(), max_grad_norm)
+                if self.t_config.fp16:
+                    scaler.step(optimizer)
+                    scaler.update()
+                else:
+                    optimizer.step()
                 if scheduler is not None:
                     scheduler.step()
                 optimizer.zero_grad()
                 global_step += 1
+                self.global_step = global_step
                 if self.d_config.kd_loss_weight_scheduler is not None:
                     self.d_config.kd_loss_weight = \
                         self.d_config.kd_loss_weight_scheduler(global_step / total_global_steps)
@@ -213,8 +290,18 @@ class BasicDistiller(AbstractDistiller):
             for step, batch in tqdm(enumerate(dataloader), disable=tqdm_disable):
                 self.cache_logits(batch, args, batch_postprocessor)
 
+        variant = 0
         for current_epoch in tqdm(range(int(num_epochs)), disable=tqdm_disable):
-            if self.t_config.q and current_epoch % self.t_config.num_reaug == 0 and current_epoch != 0:
+            if self.replay is not None and self.replay.replaying:
+                # the augmented training set of the recorded run, instead of the one of the augmentation process
+                if current_epoch % self.t_config.num_reaug == 0 and current_epoch != 0 \
+                        and current_epoch // self.t_config.num_reaug in self.replay.datasets:
+                    variant = current_epoch // self.t_config.num_reaug
+                    train_dataset = self.replay.dataset(variant)
+                    if isinstance(dataloader.dataset, IndexedDataset):
+                        train_dataset = IndexedDataset(train_dataset, aug_id=1 + variant)
+                    dataloader = DataLoader(train_dataset, batch_size=dataloader.batch_size)
+            elif self.t_config.q and current_epoch % self.t_config.num_reaug == 0 and current_epoch != 0:
                 train_dataset = None
                 if self.local_rank not in [-1, 0]:
                     while True:
@@ -233,6 +320,9 @@ class BasicDistiller(AbstractDistiller):
                             train_dataset = self.t_config.q.get(timeout=300)
                             logger.info("Update augmented data")
                             torch.save(train_dataset, os.path.join(self.t_config.output_dir,f'train_dataset_{current_epoch}.bin'))
+                            if self.replay is not None:
+                                variant = current_epoch // self.t_config.num_reaug
+                                self.replay.record_dataset(variant, os.path.join(self.t_config.output_dir,f'train_dataset_{current_epoch}.bin'))
                             break
                         except queue.Empty:
                             logger.info("Waiting for data augmentation process to return data")
@@ -241,6 +331,8 @@ class BasicDistiller(AbstractDistiller):
                 # if self.local_rank not in [-1, 0]:
                 # train_dataset = torch.load(f'train_dataset_{current_epoch}.bin')
                 if train_dataset:
+                    if isinstance(dataloader.dataset, IndexedDataset):
+                        train_dataset = IndexedDataset(train_dataset, aug_id=1 + current_epoch // self.t_config.num_reaug)
                     train_sampler = RandomSampler(train_dataset) if self.t_config.local_rank == -1 \
                         else DistributedSampler(train_dataset)
                     dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=dataloader.batch_size)
@@ -254,9 +346,15 @@ class BasicDistiller(AbstractDistiller):
             if self.d_config.is_caching_logits:
                 random.shuffle(self.logits_cache)
                 dataloader = self.logits_cache
+            if self.replay is not None:
+                dataloader = self.replay.wrap(dataloader, current_epoch, variant)
             logger.info(f"Length of current epoch in forward batch: {len(dataloader)}")
             for step, batch in tqdm(enumerate(dataloader), disable=tqdm_disable, total=len(dataloader), desc=f"Epoch {current_epoch+1}"):
-                if self.t_config.repeated_aug > 1:
+                if self.replay is not None:
+                    self.mixup_params = self.replay.step(self.t_config.mixup)
+                if self.t_config.tensor_augmenter is not None and self.t_config.repeated_aug > 1:
+                    batch = self.t_config.tensor_augmenter(batch, self.t_config.repeated_aug)
+                elif self.t_config.repeated_aug > 1:
                     batch = self.augment_data(batch)
                     features, s_features = self.t_config.processor.convert_examples_to_features(batch, disable=True)
                     batch = self.t_config.processor.convert_features_to_bacth(features, s_features)
@@ -322,7 +420,8 @@ class BasicDistiller(AbstractDistiller):
             logger.info(f"Epoch {current_epoch + 1} finished")
 
     def train(self, optimizer, dataloader, num_epochs=None, scheduler_class=None, scheduler_args=None, scheduler=None,
-              max_grad_norm=-1.0, num_steps=None, callback=None, batch_postprocessor=None, **args):
+              max_grad_norm=-1.0, num_steps=None, callback=None, batch_postprocessor=None, initial_state=None,
+              lr_scale=1.0, **args):
         """
         trains the student model.
 
@@ -337,6 +436,8 @@ class BasicDistiller(AbstractDistiller):
             scheduler_args (dict): arguments (excluding `optimizer`) passed to the `scheduler_class` to construct the scheduler object. See the example below.
             scheduler (deprecated): used to adjust learning rate, optional, can be None, is deprecated in favor of `scheduler_class` and `scheduler_args`.
             max_grad_norm (float): Maximum norm for the gradients (-1 means no clipping). Default: -1.0
+            initial_state (dict): a state returned by :meth:`training_state`, the training resumes from its global step. Only supported with `num_steps`.
+            lr_scale (float): factor applied to the learning rates restored from `initial_state`.
             **args: additional arguments fed to the model.
         Note:
             * If the batch is a list or tuple, model is called as: ``model(*batch, **args)``. Make sure the order of elements in the batch matches their order in ``model.forward``.
@@ -352,13 +453,22 @@ class BasicDistiller(AbstractDistiller):
         optimizer, scheduler, tqdm_disable = self.initialize_training(optimizer, scheduler_class, scheduler_args,
                                                                       scheduler)
 
+        self.optimizer, self.scheduler, self.global_step = optimizer, scheduler, 0
+
         assert not (num_epochs is None and num_steps is None)
+        assert initial_state is None or num_steps is not None, "Resuming is only supported with num_steps"
+        assert self.replay is None or (self.t_config.repeated_aug <= 1 and self.t_config.tensor_augmenter is None
+                                       and not self.d_config.is_caching_logits and self.local_rank == -1), \
+            "The replay log does not support repeated_aug, tensor_augmenter, logits caching or distributed training"
         if num_steps is not None:
+            initial_step = self.load_training_state(initial_state, lr_scale) if initial_state is not None else 0
             self.train_with_num_steps(optimizer, scheduler, tqdm_disable, dataloader, max_grad_norm, num_steps,
-                                      callback, batch_postprocessor, **args)
+                                      callback, batch_postprocessor, initial_step=initial_step, **args)
         else:
             self.train_with_num_epochs(optimizer, scheduler, tqdm_disable, dataloader, max_grad_norm, num_epochs,
                                        callback, batch_postprocessor, **args)
+        if self.replay is not None:
+            self.replay.close()
 
     def train_on_batch(self, batch, args, s_batch=None):
         if self.d_config.is_caching_logits is False:
@@ -366,7 +476,8 @@ class BasicDistiller(AbstractDistiller):
                                                                                             self.model_T, self.model_S,
                                                                                             self.local_rank, args,
                                                                                             self.t_config.mixup,
-                                                                                            self.t_config.task_type)
+                                                                                            self.t_config.task_type,
+                                                                                            mixup_params=self.mixup_params)
             results_T = post_adaptor(self.adaptor_T(teacher_batch, results_T))
             results_S = post_adaptor(self.adaptor_S(student_batch, results_S))
         else:
@@ -375,7 +486,8 @@ class BasicDistiller(AbstractDistiller):
                                                                    self.model_S, self.local_rank, args,
                                                                    self.t_config.mixup,
                                                                    task_type=self.t_config.task_type,
-                                                                   no_teacher_forward=True)
+                                                                   no_teacher_forward=True,
+                                                                   mixup_params=self.mixup_params)
 
             results_S = post_adaptor(self.adaptor_S(student_batch, results_S))
             results_T = {'logits': [logits.to(self.t_config.device) for logits in cached_logits]}
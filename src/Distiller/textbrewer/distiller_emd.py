@@ -86,7 +86,8 @@ class EMDDistiller(BasicDistiller):
             self.model_T.train()
         (teacher_batch, results_T), (student_batch, results_S) = get_outputs_from_batch(batch, self.t_config.device,
                                                                                         self.model_T, self.model_S,self.local_rank,
-                                                                                        args,mixup=self.t_config.mixup,task_type=self.t_config.task_type)
+                                                                                        args,mixup=self.t_config.mixup,task_type=self.t_config.task_type,
+                                                                                        mixup_params=self.mixup_params)
 
         results_T = post_adaptor(self.adaptor_T(teacher_batch, results_T))
         results_S = post_adaptor(self.adaptor_S(student_batch, results_S))
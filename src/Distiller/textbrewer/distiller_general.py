@@ -1,6 +1,7 @@
 
 from .distiller_utils import *
 from .distiller_basic import BasicDistiller
+from .compiled_objective import CompiledObjective, unsupported_reason
 
 
 def cross_entropy(input, target):
@@ -61,6 +62,14 @@ class GeneralDistiller(BasicDistiller):
         
         self.d_config.is_caching_logits = False
 
+        self.objective = None
+        if self.d_config.compile_objective:
+            reason = unsupported_reason(self.d_config, self.has_custom_matches)
+            if reason is None:
+                self.objective = CompiledObjective(self.d_config, self.projs)
+            else:
+                logger.warning(f"The distillation objective is computed eagerly, compile_objective does not support {reason}")
+
     def save_and_callback(self,global_step, step, epoch, callback):
         if self.has_custom_matches:
             handles_T = self.model_T._forward_hooks
@@ -68,6 +77,8 @@ class GeneralDistiller(BasicDistiller):
             self.model_S._forward_hooks = OrderedDict()  # clear hooks
             self.model_T._forward_hooks = OrderedDict()
 
+        if self.d_config.pseudo_label_cache is not None and self.rank == 0:
+            self.d_config.pseudo_label_cache.save()
         super(GeneralDistiller, self).save_and_callback(global_step, step, epoch, callback)
 
         if self.has_custom_matches:
@@ -75,23 +86,41 @@ class GeneralDistiller(BasicDistiller):
             self.model_T._forward_hooks = handles_T
 
 
-    def train_on_batch(self, batch, args):
-        if self.d_config.soft_label_weight>0.0:
-            self.model_T.eval()
+    def teacher_pseudo_labels(self, teacher_batch):
+        """Runs the teacher on `teacher_batch` and returns its hard labels and the logits they come from."""
+        self.model_T.eval()
+        with torch.no_grad():
             if self.t_config.task_type == "glue":
+                logits = self.model_T(**move_to_device(teacher_batch, self.t_config.device)).logits.detach().cpu()
                 if self.t_config.task_name not in ["stsb","cloth"]:
-                    pre_labels = self.model_T(**batch['teacher']).logits.detach().cpu().argmax(dim=-1)
+                    hard_labels = {'labels': logits.argmax(dim=-1)}
                 else:
-                    pre_labels = self.model_T(**batch['teacher']).logits.detach().cpu()[:,0]
-                batch['student']['labels'] = pre_labels
+                    hard_labels = {'labels': logits[:,0]}
+                soft_labels = {'logits': logits}
             elif self.t_config.task_type in ["squad","squad2"]:
-                pre_outputs = self.model_T(**batch['teacher'])
-                # batch_start_logits = pre_outputs.start_logits.detach().cpu()
-                # batch_end_logits = pre_outputs.end_logits.detach().cpu()
-                batch['student']['start_positions'] = pre_outputs.start_logits.max(dim=-1).indices.detach().cpu()
-                batch['student']['end_positions'] = pre_outputs.end_logits.max(dim=-1).indices.detach().cpu()
-            self.model_T.train()
-        (teacher_batch, results_T), (student_batch, results_S) = get_outputs_from_batch(batch, self.t_config.device, self.model_T, self.model_S, self.local_rank,args,self.t_config.mixup,task_type=self.t_config.task_type)
+                pre_outputs = self.model_T(**move_to_device(teacher_batch, self.t_config.device))
+                start_logits = pre_outputs.start_logits.detach().cpu()
+                end_logits = pre_outputs.end_logits.detach().cpu()
+                hard_labels = {'start_positions': start_logits.max(dim=-1).indices,
+                               'end_positions': end_logits.max(dim=-1).indices}
+                soft_labels = {'start_logits': start_logits, 'end_logits': end_logits}
+        self.model_T.train()
+        return hard_labels, soft_labels
+
+    def train_on_batch(self, batch, args):
+        if self.d_config.soft_label_weight>0.0:
+            cache = self.d_config.pseudo_label_cache
+            hard_labels = None
+            if cache is not None and 'example_ids' in batch:
+                cached = cache.lookup(batch['example_ids'], batch['aug_ids'])
+                if cached is not None:
+                    hard_labels = {k: v for k, v in cached.items() if k in ['labels','start_positions','end_positions']}
+            if hard_labels is None:
+                hard_labels, soft_labels = self.teacher_pseudo_labels(batch['teacher'])
+                if cache is not None and 'example_ids' in batch:
+                    cache.update(batch['example_ids'], batch['aug_ids'], hard_labels, soft_labels)
+            batch['student'].update(hard_labels)
+        (teacher_batch, results_T), (student_batch, results_S) = get_outputs_from_batch(batch, self.t_config.device, self.model_T, self.model_S, self.local_rank,args,self.t_config.mixup,task_type=self.t_config.task_type,mixup_params=self.mixup_params)
         results_T = post_adaptor(self.adaptor_T(teacher_batch,results_T))
         results_S = post_adaptor(self.adaptor_S(student_batch, results_S))
         total_loss, losses_dict = self.compute_loss(results_S, results_T)
@@ -101,6 +130,34 @@ class GeneralDistiller(BasicDistiller):
 
     def compute_loss(self,results_S,results_T):
 
+        outputs = self.objective(results_S, results_T) if self.objective is not None else None
+        if outputs is not None:
+            total_loss, losses_dict = outputs
+        else:
+            total_loss, losses_dict = self.compute_distillation_loss(results_S, results_T)
+
+        if 'losses' in results_S:
+            total_hl_loss = 0
+            for loss in results_S['losses']:
+                # in case of multi-GPU
+                total_hl_loss += loss.mean() 
+            total_loss += total_hl_loss * self.d_config.hard_label_weight
+            losses_dict['unweighted_hard_label_loss'] = total_hl_loss
+        if 'loss' in results_S:
+            total_hl_loss = 0
+            if results_S['loss'].shape == torch.Size([]):
+                total_hl_loss = results_S['loss']
+            else:
+                for loss in results_S['loss']:
+                    # in case of multi-GPU
+                    total_hl_loss += loss.mean()
+            total_loss += total_hl_loss * self.d_config.hard_label_weight
+            losses_dict['unweighted_hard_label_loss'] = total_hl_loss
+            # total_loss += results_S['loss']
+        return total_loss, losses_dict
+
+    def compute_distillation_loss(self,results_S,results_T):
+        """The KD loss, the intermediate losses and the custom match losses, as computed without compile_objective."""
         losses_dict = dict()
 
         total_loss = 0
@@ -185,26 +242,6 @@ class GeneralDistiller(BasicDistiller):
                 total_loss += match_weight * match_loss(hook_S,hook_T,inputs_mask_S,inputs_mask_T)
             self.custom_matches_cache['hook_outputs_T'] = []
             self.custom_matches_cache['hook_outputs_S'] = []
-        # if self.d_config.soft_label_weight > 0.0:
-
-        if 'losses' in results_S:
-            total_hl_loss = 0
-            for loss in results_S['losses']:
-                # in case of multi-GPU
-                total_hl_loss += loss.mean() 
-            total_loss += total_hl_loss * self.d_config.hard_label_weight
-            losses_dict['unweighted_hard_label_loss'] = total_hl_loss
-        if 'loss' in results_S:
-            total_hl_loss = 0
-            if results_S['loss'].shape == torch.Size([]):
-                total_hl_loss = results_S['loss']
-            else:
-                for loss in results_S['loss']:
-                    # in case of multi-GPU
-                    total_hl_loss += loss.mean()
-            total_loss += total_hl_loss * self.d_config.hard_label_weight
-            losses_dict['unweighted_hard_label_loss'] = total_hl_loss
-            # total_loss += results_S['loss']
         return total_loss, losses_dict
 
     def add_match(self,match: CustomMatch):
@@ -1,5 +1,6 @@
 from .distiller_utils import *
 from .distiller_general import GeneralDistiller
+from .multitask_scheduler import MultiTaskBatchScheduler
 
 class MultiTaskDistiller(GeneralDistiller):
     """
@@ -33,7 +34,7 @@ class MultiTaskDistiller(GeneralDistiller):
 
         self.d_config.is_caching_logits = False
 
-    def train(self, optimizer, dataloaders, num_steps, scheduler_class=None, scheduler_args=None, scheduler=None, max_grad_norm = -1.0, tau=1, callback=None, batch_postprocessors=None, **args):
+    def train(self, optimizer, dataloaders, num_steps, scheduler_class=None, scheduler_args=None, scheduler=None, max_grad_norm = -1.0, tau=1, callback=None, batch_postprocessors=None, prefetch=2, seed=None, **args):
         """
         trains the student model.
 
@@ -48,6 +49,8 @@ class MultiTaskDistiller(GeneralDistiller):
             tau (float): the probability of sampling an example from task `d` is proportional to \|d\|^{tau}, where \|d\| is the size of `d`'s training set. If the size of any dataset is unknown, ignores tau and samples examples unifromly from each dataset.
             callback (Callable): function called after each epoch, can be None. It is called as ``callback(model=self.model_S, step = global_step)``. It can be used to do evaluation of the model at each checkpoint.
             batch_postprocessors (dict): a dict of batch_postprocessors. Keys are tasknames, values are corresponding batch_postprocessors. Each batch_postprocessor should take a batch and return a batch.
+            prefetch (int): number of batches kept ready per task by background workers, 0 loads batches synchronously.
+            seed (int): seed of the task schedule. The tasks are visited in the same order for a given seed. If None, a seed is drawn from numpy's global generator.
             **args: additional arguments fed to the model.
         """
         optimizer, scheduler, tqdm_disable = self.initialize_training(optimizer, scheduler_class, scheduler_args, scheduler)
@@ -64,65 +67,66 @@ class MultiTaskDistiller(GeneralDistiller):
         logger.info(f"Total training steps: {total_global_steps}")
         logger.info(f"Checkpoints(step): {checkpoints}")
 
-        dataiters = {k:cycle(v) for k,v in dataloaders.items()}
-        if all(hasattr(v,'__len__') for v in dataloaders.values()):
-            dataloader_sizes = {k:len(v) for k,v in dataloaders.items()}
-            total_size = sum(v for k,v in dataloader_sizes.items())//self.t_config.gradient_accumulation_steps
+        if seed is None:
+            seed = int(np.random.randint(2 ** 31))
+        batch_scheduler = MultiTaskBatchScheduler(dataloaders, num_steps * self.t_config.gradient_accumulation_steps,
+                                                  tau=tau, prefetch=prefetch, seed=seed,
+                                                  batch_postprocessors=batch_postprocessors)
+        if batch_scheduler.schedule.epoch_length is not None:
+            total_size = batch_scheduler.schedule.epoch_length//self.t_config.gradient_accumulation_steps
             logger.info(f"Total size of all datasets (in number of batch_size):{total_size}")
-            Z = sum(pow(v,tau) for v in dataloader_sizes.values())
-            tasknames, sampling_weights = zip(*((k,pow(v,tau)/Z) for k,v in dataloader_sizes.items()))
+            logger.info(f"Task sampling weights: {batch_scheduler.sampling_weights}")
         else:
             logger.info("The size of some datasets are unknown, so tau=1")
-            tasknames = tuple(dataloaders.keys())
-            sampling_weights = None
-
-
-        global_step = 0
-        writer_step = 0
-        optimizer.zero_grad()
-        while global_step < num_steps:
-            global_step += 1
-            for _ in range(self.t_config.gradient_accumulation_steps):
-                #sampling taskname
-                taskname = np.random.choice(tasknames,p=sampling_weights)
-                dataiter = dataiters[taskname]
-                batch = next(dataiter)
-                if batch_postprocessors is not None:
-                    batch = batch_postprocessors[taskname](batch)
-                batch_taskname = (batch, taskname)
-                total_loss, losses_dict = self.train_on_batch(batch_taskname, args)
-
-                self.write_loss(total_loss,writer_step,losses_dict)
-                writer_step += 1
-
-                total_loss /= self.t_config.gradient_accumulation_steps
-                if self.t_config.fp16:
-                    with amp.scale_loss(total_loss,optimizer) as scaled_loss:
-                        scaled_loss.backward()
-                else:
-                    total_loss.backward()
-
-            if max_grad_norm > 0:
-                if self.t_config.fp16:
-                    torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), max_grad_norm)
-                else:
-                    torch.nn.utils.clip_grad_norm_(self.model_S.parameters(), max_grad_norm)
-            optimizer.step()
-            if scheduler is not None:
-                scheduler.step()
-            optimizer.zero_grad()
+        batches = iter(batch_scheduler)
 
-            if self.d_config.kd_loss_weight_scheduler is not None:
-                self.d_config.kd_loss_weight = \
-                    self.d_config.kd_loss_weight_scheduler(global_step/total_global_steps)
-            if self.d_config.hard_label_weight_scheduler is not None:
-                self.d_config.hard_label_weight = \
-                    self.d_config.hard_label_weight_scheduler(global_step/total_global_steps)
-
-            if (global_step) % print_every == 0:
-                logger.info(f"Global step: {global_step}/{num_steps}")
-            if (global_step % ckpt_steps == 0) or global_step==total_global_steps:
-                self.save_and_callback(global_step, global_step-1, 0, callback)
+        try:
+            global_step = 0
+            writer_step = 0
+            optimizer.zero_grad()
+            while global_step < num_steps:
+                global_step += 1
+                for _ in range(self.t_config.gradient_accumulation_steps):
+                    batch_taskname = next(batches)
+                    total_loss, losses_dict = self.train_on_batch(batch_taskname, args)
+
+                    self.write_loss(total_loss,writer_step,losses_dict)
+                    writer_step += 1
+
+                    total_loss /= self.t_config.gradient_accumulation_steps
+                    if self.t_config.fp16:
+                        with amp.scale_loss(total_loss,optimizer) as scaled_loss:
+                            scaled_loss.backward()
+                    else:
+                        total_loss.backward()
+
+                if max_grad_norm > 0:
+                    if self.t_config.fp16:
+                        torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), max_grad_norm)
+                    else:
+                        torch.nn.utils.clip_grad_norm_(self.model_S.parameters(), max_grad_norm)
+                optimizer.step()
+                if scheduler is not None:
+                    scheduler.step()
+                optimizer.zero_grad()
+
+                if self.d_config.kd_loss_weight_scheduler is not None:
+                    self.d_config.kd_loss_weight = \
+                        self.d_config.kd_loss_weight_scheduler(global_step/total_global_steps)
+                if self.d_config.hard_label_weight_scheduler is not None:
+                    self.d_config.hard_label_weight = \
+                        self.d_config.hard_label_weight_scheduler(global_step/total_global_steps)
+
+                if (global_step) % print_every == 0:
+                    logger.info(f"Global step: {global_step}/{num_steps}")
+                if (global_step % ckpt_steps == 0) or global_step==total_global_steps:
+                    for taskname, task_stats in batch_scheduler.stats().items():
+                        logger.info(f"Task {taskname}: {task_stats}")
+                        self.tb_writer.add_scalar(f'throughput/{taskname}', task_stats['batches_per_second'], global_step)
+                    self.save_and_callback(global_step, global_step-1, 0, callback)
+        finally:
+            # stops the prefetching workers, also when a batch or a training step raised
+            batch_scheduler.close()
         logger.info("Training finished")
 
     def train_on_batch(self, batch_taskname, args) -> torch.Tensor:
@@ -131,7 +135,7 @@ class MultiTaskDistiller(GeneralDistiller):
         adaptor_T = self.adaptor_T[taskname]
         adaptor_S = self.adaptor_S[taskname]
 
-        (teacher_batch, results_T), (student_batch, results_S) = get_outputs_from_batch(batch, self.t_config.device, model_T, self.model_S, args)
+        (teacher_batch, results_T), (student_batch, results_S) = get_outputs_from_batch(batch, self.t_config.device, model_T, self.model_S, self.local_rank, args)
 
         results_T = post_adaptor(adaptor_T(teacher_batch,results_T))
         results_S = post_adaptor(adaptor_S(student_batch,results_S))
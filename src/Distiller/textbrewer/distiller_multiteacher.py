@@ -14,6 +14,9 @@ class MultiTeacherDistiller(BasicDistiller):
         adaptor_S (Callable): student model's adaptor.
 
     The roles of `adaptor_T` and `adaptor_S` are explained in :py:func:`adaptor`.
+
+    Batches built by :class:`~textbrewer.ensemble.EnsembleSoftLabelDataset` carry the ensemble logits computed
+    offline by :class:`~textbrewer.ensemble.EnsembleSoftLabelStore`, in which case no teacher is run during training.
     """
 
     def __init__(self, train_config,
@@ -30,8 +33,16 @@ class MultiTeacherDistiller(BasicDistiller):
             assert len(self.adaptor_T)==len(self.model_T)
 
     def train_on_batch(self, batch, args):
-        if self.d_config.is_caching_logits is False:
-            (teacher_batch, results_T), (student_batch, results_S) = get_outputs_from_batch(batch, self.t_config.device, self.model_T, self.model_S, args)
+        if isinstance(batch, dict) and 'teacher_cache' in batch:
+            # ensemble soft labels precomputed by EnsembleSoftLabelStore: served as a single teacher
+            assert not self.t_config.mixup, "Precomputed ensemble soft labels do not support mixup"
+            (teacher_batch, results_T), (student_batch, results_S) = get_outputs_from_batch(batch, self.t_config.device, self.model_T, self.model_S, self.local_rank, args)
+            results_T = [post_adaptor(results_T)]
+            results_S = post_adaptor(self.adaptor_S(student_batch,results_S))
+            if 'logits_mask' in results_S:
+                results_T[0]['logits_mask'] = results_S['logits_mask']
+        elif self.d_config.is_caching_logits is False:
+            (teacher_batch, results_T), (student_batch, results_S) = get_outputs_from_batch(batch, self.t_config.device, self.model_T, self.model_S, self.local_rank, args)
 
             if hasattr(self.adaptor_T,'__iter__'):
                 results_T = [post_adaptor(adpt_t(teacher_batch,results_t)) for results_t,adpt_t in zip(results_T,self.adaptor_T)]
@@ -40,7 +51,7 @@ class MultiTeacherDistiller(BasicDistiller):
             results_S = post_adaptor(self.adaptor_S(student_batch,results_S))
         else:
             batch, cached_logits = batch
-            _, (student_batch, results_S) = get_outputs_from_batch(batch, self.t_config.device, self.model_T, self.model_S, args, no_teacher_forward=True)
+            _, (student_batch, results_S) = get_outputs_from_batch(batch, self.t_config.device, self.model_T, self.model_S, self.local_rank, args, no_teacher_forward=True)
             results_S = post_adaptor(self.adaptor_S(student_batch,results_S))
             results_T = [{'logits': [lo.to(self.t_config.device) for lo in logits]} for logits in cached_logits]
             if 'logits_mask' in results_S:
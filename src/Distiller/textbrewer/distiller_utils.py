@@ -133,6 +133,10 @@ class AbstractDistiller(DistillationContext):
 
         self.logits_cache = []
 
+        self.replay = self.t_config.replay
+        # mixup parameters of the current step when they come from the replay log
+        self.mixup_params = None
+
 
 def select_logits_with_mask(logits_list, masks_list):
     output_logits = []
@@ -281,21 +285,28 @@ def mixup_assist(batch, model, random_index, lmbd, local_rank, task_type, device
     return new_batch
 
 
-def mixup_helper(teacher_batch, student_batch, model_T, model_S, local_rank, task_type, device):
+def sample_mixup(batch_size):
+    """Mixup lambda (from Beta(0.4, 0.4)) and permutation of a batch of `batch_size` examples."""
     lmbd = torch.distributions.Beta(0.4, 0.4).sample()
-    random_index = list(range(teacher_batch['input_ids'].shape[0]))
+    random_index = list(range(batch_size))
     random.shuffle(random_index)
+    return lmbd, random_index
+
+
+def mixup_helper(teacher_batch, student_batch, model_T, model_S, local_rank, task_type, device, mixup_params=None):
+    # mixup_params: the (lambda, permutation) of the batch, e.g. replayed by textbrewer.replay, drawn if None
+    lmbd, random_index = mixup_params or sample_mixup(teacher_batch['input_ids'].shape[0])
     return mixup_assist(teacher_batch, model_T, random_index, lmbd, local_rank, task_type,device), mixup_assist(student_batch, model_S, random_index, lmbd, local_rank, task_type,device)
 
 
-def get_outputs_from_batch(batch, device, model_T, model_S, local_rank, args, mixup=False, task_type="squad2", no_teacher_forward=False):
+def get_outputs_from_batch(batch, device, model_T, model_S, local_rank, args, mixup=False, task_type="squad2", no_teacher_forward=False, mixup_params=None):
     batch = move_to_device(batch, device)
     if type(batch) is dict:
         if 'teacher' in batch and 'student' in batch:
             teacher_batch = batch['teacher']
             student_batch = batch['student']
             if mixup:
-                teacher_batch, student_batch = mixup_helper(teacher_batch, student_batch, model_T, model_S, local_rank, task_type,device)
+                teacher_batch, student_batch = mixup_helper(teacher_batch, student_batch, model_T, model_S, local_rank, task_type,device,mixup_params)
             teacher_batch = move_to_device(teacher_batch, device)
             #teacher outputs
             if no_teacher_forward is True:
@@ -315,7 +326,7 @@ def get_outputs_from_batch(batch, device, model_T, model_S, local_rank, args, mi
                 results_S = model_S(*student_batch, **args)
         else:
             if mixup:
-                teacher_batch, student_batch = mixup_helper(batch, batch, model_T, model_S, local_rank, task_type,device)
+                teacher_batch, student_batch = mixup_helper(batch, batch, model_T, model_S, local_rank, task_type,device,mixup_params)
             else:
                 teacher_batch = batch
                 student_batch = batch
@@ -335,7 +346,7 @@ def get_outputs_from_batch(batch, device, model_T, model_S, local_rank, args, mi
     else:
         # batch = move_to_device(batch,device)
         if mixup:
-            teacher_batch, student_batch = mixup_helper(batch, batch, model_T, model_S, local_rank, task_type,device)
+            teacher_batch, student_batch = mixup_helper(batch, batch, model_T, model_S, local_rank, task_type,device,mixup_params)
         else:
             teacher_batch = batch
             student_batch = batch
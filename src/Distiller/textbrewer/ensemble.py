@@ -0,0 +1,111 @@
+import torch
+from torch.utils.data import Dataset, DataLoader, SequentialSampler
+from tqdm import tqdm
+from .distiller_utils import post_adaptor, move_to_device, auto_forward
+from Distiller.utils import Logger
+
+logger = Logger("all.log",level="debug").logger
+
+
+class EnsembleSoftLabelStore:
+    """
+    Stores the (weighted) average of the logits of an ensemble of teachers for every feature of a dataset.
+    Row ``i`` of every tensor in ``logits`` belongs to the ``i``-th feature of the dataset.
+
+    Args:
+        logits (List[torch.Tensor]): one tensor per logits output of the adaptor (e.g. start and end logits).
+        teacher_names (List[str]): names of the teachers of the ensemble, only used for bookkeeping.
+        weights (List[float]): normalized weights of the teachers.
+    """
+    def __init__(self, logits, teacher_names=None, weights=None):
+        self.logits = logits
+        self.teacher_names = teacher_names
+        self.weights = weights
+
+    def __len__(self):
+        return self.logits[0].size(0)
+
+    def __getitem__(self, index):
+        return [logits[index].float() for logits in self.logits]
+
+    def save(self, path):
+        torch.save({'logits': self.logits, 'teacher_names': self.teacher_names, 'weights': self.weights}, path)
+
+    @classmethod
+    def load(cls, path):
+        state = torch.load(path)
+        return cls(state['logits'], state['teacher_names'], state['weights'])
+
+    @classmethod
+    def from_teachers(cls, models_T, adaptor_T, dataset, device, weights=None, batch_size=64, args=None,
+                      teacher_names=None, dtype=torch.float16):
+        """
+        Runs every teacher once over ``dataset`` and keeps the weighted average of their logits.
+
+        Args:
+            models_T (List[torch.nn.Module]): teacher models.
+            adaptor_T (Callable or List[Callable]): teacher adaptor(s), as in :class:`MultiTeacherDistiller`.
+            dataset (torch.utils.data.Dataset): training dataset. If it returns ``teacher``/``student`` batches the
+                teacher inputs are used.
+            device: device the teachers run on.
+            weights (List[float]): teacher weights. Defaults to uniform weights, which reproduces the plain average
+                of :class:`MultiTeacherDistiller`.
+            batch_size (int): inference batch size.
+            args (dict): extra keyword arguments passed to the teachers.
+            teacher_names (List[str]): names of the teachers.
+            dtype: dtype of the stored logits.
+        """
+        args = args or {}
+        if weights is None:
+            weights = [1.0] * len(models_T)
+        assert len(weights) == len(models_T)
+        weights = [w / sum(weights) for w in weights]
+        adaptors = adaptor_T if hasattr(adaptor_T, '__iter__') else [adaptor_T] * len(models_T)
+        dataloader = DataLoader(dataset, sampler=SequentialSampler(dataset), batch_size=batch_size)
+
+        sum_logits = None
+        # one teacher at a time so that only one of them has to be resident on the device
+        for model_t, adpt_t, weight in zip(models_T, adaptors, weights):
+            was_training = model_t.training
+            model_t.eval()
+            model_t.to(device)
+            teacher_logits = []
+            for batch in tqdm(dataloader, desc="Ensemble teacher inference"):
+                if isinstance(batch, dict) and 'teacher' in batch:
+                    batch = batch['teacher']
+                batch = move_to_device(batch, device)
+                with torch.no_grad():
+                    results_t = post_adaptor(adpt_t(batch, auto_forward(model_t, batch, args)))
+                teacher_logits.append([logits.float().cpu() * weight for logits in results_t['logits']])
+            teacher_logits = [torch.cat(logits, 0) for logits in zip(*teacher_logits)]
+            if sum_logits is None:
+                sum_logits = teacher_logits
+            else:
+                sum_logits = [s + t for s, t in zip(sum_logits, teacher_logits)]
+            model_t.train(was_training)
+        logger.info("Stored ensemble soft labels of %d teachers for %d features", len(models_T), len(dataset))
+        return cls([logits.to(dtype) for logits in sum_logits], teacher_names, weights)
+
+
+class EnsembleSoftLabelDataset(Dataset):
+    """
+    Wraps a dataset so that every item carries the ensemble logits of its feature under the ``teacher_cache`` key.
+    :class:`MultiTeacherDistiller` then uses them in place of the teacher forwards.
+    """
+    def __init__(self, dataset, store):
+        super(EnsembleSoftLabelDataset, self).__init__()
+        assert len(dataset) == len(store), "The soft label store does not match the dataset"
+        self.dataset = dataset
+        self.store = store
+
+    def __getitem__(self, index):
+        item = self.dataset[index]
+        if not (isinstance(item, dict) and 'teacher' in item):
+            item = {'teacher': item, 'student': item}
+        else:
+            item = dict(item)
+        item['teacher_cache'] = {'logits': self.store[index]}
+        return item
+
+    def __len__(self):
+        return len(self.dataset)
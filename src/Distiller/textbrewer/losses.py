@@ -4,6 +4,8 @@ import numpy as np
 from typing import List
 
 from .compatibility import mask_dtype
+from torch.utils.checkpoint import checkpoint
+from .blockwise import AttentionFactors, blockwise_sum, get_block_size
 
 def kd_mse_loss(logits_S, logits_T, temperature=1):
     '''
@@ -46,7 +48,12 @@ def att_mse_loss(attention_S, attention_T, mask=None):
     :param torch.Tensor logits_S: tensor of shape  (*batch_size*, *num_heads*, *length*, *length*)
     :param torch.Tensor logits_T: tensor of shape  (*batch_size*, *num_heads*, *length*, *length*)
     :param torch.Tensor mask: tensor of shape  (*batch_size*, *length*)
+
+    `attention_S` and `attention_T` can also be :class:`~textbrewer.blockwise.AttentionFactors`, the loss is then
+    computed blockwise over the query rows.
     '''
+    if isinstance(attention_S, AttentionFactors):
+        return _blockwise_att_mse_loss(attention_S, attention_T, mask)
     if mask is None:
         attention_S_select = torch.where(attention_S <= -1e-3, torch.zeros_like(attention_S), attention_S)
         attention_T_select = torch.where(attention_T <= -1e-3, torch.zeros_like(attention_T), attention_T)
@@ -68,6 +75,8 @@ def att_mse_sum_loss(attention_S, attention_T, mask=None):
     :param torch.Tensor logits_T: tensor of shape  (*batch_size*, *num_heads*, *length*, *length*) or (*batch_size*, *length*, *length*)
     :param torch.Tensor mask:     tensor of shape  (*batch_size*, *length*)
     '''
+    if isinstance(attention_S, AttentionFactors):
+        return _blockwise_att_mse_sum_loss(attention_S, attention_T, mask)
     if len(attention_S.size())==4:
         attention_T = attention_T.sum(dim=1)
         attention_S = attention_S.sum(dim=1)
@@ -91,7 +100,12 @@ def att_ce_loss(attention_S, attention_T, mask=None):
     :param torch.Tensor logits_S: tensor of shape  (*batch_size*, *num_heads*, *length*, *length*)
     :param torch.Tensor logits_T: tensor of shape  (*batch_size*, *num_heads*, *length*, *length*)
     :param torch.Tensor mask:     tensor of shape  (*batch_size*, *length*)
+
+    `attention_S` and `attention_T` can also be :class:`~textbrewer.blockwise.AttentionFactors`, the loss is then
+    computed blockwise over the query rows.
     '''
+    if isinstance(attention_S, AttentionFactors):
+        return _blockwise_att_ce_loss(attention_S, attention_T, mask)
     probs_T = F.softmax(attention_T, dim=-1)
     if mask is None:
         probs_T_select = torch.where(attention_T <= -1e-3, torch.zeros_like(attention_T), probs_T)
@@ -111,7 +125,12 @@ def att_ce_mean_loss(attention_S, attention_T, mask=None):
     :param torch.tensor logits_S: tensor of shape  (*batch_size*, *num_heads*, *length*, *length*) or (*batch_size*, *length*, *length*)
     :param torch.tensor logits_T: tensor of shape  (*batch_size*, *num_heads*, *length*, *length*) or (*batch_size*, *length*, *length*)
     :param torch.tensor mask:     tensor of shape  (*batch_size*, *length*)
+
+    `attention_S` and `attention_T` can also be :class:`~textbrewer.blockwise.AttentionFactors`, the loss is then
+    computed blockwise over the query rows.
     '''
+    if isinstance(attention_S, AttentionFactors):
+        return _blockwise_att_ce_mean_loss(attention_S, attention_T, mask)
     if len(attention_S.size())==4:
         attention_S = attention_S.mean(dim=1) # (bs, len, len)
         attention_T = attention_T.mean(dim=1)
@@ -125,6 +144,76 @@ def att_ce_mean_loss(attention_S, attention_T, mask=None):
     return loss
 
 
+def _blockwise_att_mse_loss(attention_S, attention_T, mask=None):
+    # same sums as att_mse_loss, accumulated over blocks of query rows
+    batch_size, num_heads, length, _ = attention_S.size()
+    if mask is None:
+        def block(rows_S, rows_T, start, end):
+            rows_S = torch.where(rows_S <= -1e-3, torch.zeros_like(rows_S), rows_S)
+            rows_T = torch.where(rows_T <= -1e-3, torch.zeros_like(rows_T), rows_T)
+            return F.mse_loss(rows_S, rows_T, reduction='sum')
+        return blockwise_sum(block, attention_S, attention_T) / (batch_size * num_heads * length * length)
+    mask = mask.to(attention_S.query)
+    valid_count = torch.pow(mask.sum(dim=1), 2).sum() * num_heads
+
+    def block(rows_S, rows_T, start, end):
+        return (F.mse_loss(rows_S, rows_T, reduction='none') * mask[:, None, start:end, None] * mask[:, None, None, :]).sum()
+    return blockwise_sum(block, attention_S, attention_T) / valid_count
+
+
+def _blockwise_att_mse_sum_loss(attention_S, attention_T, mask=None):
+    batch_size, _, length, _ = attention_S.size()
+    if mask is None:
+        def block(rows_S, rows_T, start, end):
+            rows_S, rows_T = rows_S.sum(dim=1), rows_T.sum(dim=1)
+            rows_S = torch.where(rows_S <= -1e-3, torch.zeros_like(rows_S), rows_S)
+            rows_T = torch.where(rows_T <= -1e-3, torch.zeros_like(rows_T), rows_T)
+            return F.mse_loss(rows_S, rows_T, reduction='sum')
+        return blockwise_sum(block, attention_S, attention_T) / (batch_size * length * length)
+    mask = mask.to(attention_S.query)
+    valid_count = torch.pow(mask.sum(dim=1), 2).sum()
+
+    def block(rows_S, rows_T, start, end):
+        return (F.mse_loss(rows_S.sum(dim=1), rows_T.sum(dim=1), reduction='none')
+                * mask[:, start:end, None] * mask[:, None, :]).sum()
+    return blockwise_sum(block, attention_S, attention_T) / valid_count
+
+
+def _blockwise_att_ce_loss(attention_S, attention_T, mask=None):
+    batch_size, num_heads, length, _ = attention_S.size()
+    if mask is None:
+        def block(rows_S, rows_T, start, end):
+            probs_T = F.softmax(rows_T, dim=-1)
+            probs_T_select = torch.where(rows_T <= -1e-3, torch.zeros_like(rows_T), probs_T)
+            return -(probs_T_select * F.log_softmax(rows_S, dim=-1)).sum()
+        return blockwise_sum(block, attention_S, attention_T) / (batch_size * num_heads * length)
+    mask = mask.to(attention_S.query)
+
+    def block(rows_S, rows_T, start, end):
+        probs_T = F.softmax(rows_T, dim=-1)
+        return -((probs_T * F.log_softmax(rows_S, dim=-1) * mask[:, None, None, :]).sum(dim=-1)
+                 * mask[:, None, start:end]).sum()
+    return blockwise_sum(block, attention_S, attention_T) / (mask.sum() * num_heads)
+
+
+def _blockwise_att_ce_mean_loss(attention_S, attention_T, mask=None):
+    batch_size, _, length, _ = attention_S.size()
+    if mask is None:
+        def block(rows_S, rows_T, start, end):
+            rows_S, rows_T = rows_S.mean(dim=1), rows_T.mean(dim=1)
+            probs_T = F.softmax(rows_T, dim=-1)
+            probs_T_select = torch.where(rows_T <= -1e-3, torch.zeros_like(rows_T), probs_T)
+            return -(probs_T_select * F.log_softmax(rows_S, dim=-1)).sum()
+        return blockwise_sum(block, attention_S, attention_T) / (batch_size * length)
+    mask = mask.to(attention_S.query)
+
+    def block(rows_S, rows_T, start, end):
+        probs_T = F.softmax(rows_T.mean(dim=1), dim=-1)
+        return -((probs_T * F.log_softmax(rows_S.mean(dim=1), dim=-1) * mask[:, None, :]).sum(dim=-1)
+                 * mask[:, start:end]).sum()
+    return blockwise_sum(block, attention_S, attention_T) / mask.sum()
+
+
 def hid_ce_loss(state_S, state_T, mask=None):
     probs_T = F.softmax(state_T, dim=-1)
     if mask is None:
@@ -271,6 +360,9 @@ def mmd_loss(state_S, state_T, mask=None):
     state_S_1 = state_S[1] # (batch_size , length, hidden_dim_S)
     state_T_0 = state_T[0] # (batch_size , length, hidden_dim_T)
     state_T_1 = state_T[1] # (batch_size , length, hidden_dim_T)
+    block_size = get_block_size()
+    if block_size and state_S_0.size(1) > block_size:
+        return _blockwise_mmd_loss(state_S_0, state_S_1, state_T_0, state_T_1, mask, block_size)
     if mask is None:
         gram_S = torch.bmm(state_S_0, state_S_1.transpose(1, 2)) / state_S_1.size(2)  # (batch_size, length, length)
         gram_T = torch.bmm(state_T_0, state_T_1.transpose(1, 2)) / state_T_1.size(2)
@@ -284,6 +376,35 @@ def mmd_loss(state_S, state_T, mask=None):
     return loss
 
 
+def _blockwise_mmd_loss(state_S_0, state_S_1, state_T_0, state_T_1, mask, block_size):
+    # mmd_loss over blocks of rows of the similarity matrices, each block checkpointed
+    batch_size, length = state_S_0.size(0), state_S_0.size(1)
+    if mask is None:
+        divisor_S, divisor_T = state_S_1.size(2), state_T_1.size(2)
+    else:
+        mask = mask.to(state_S_0)
+        divisor_S, divisor_T = state_S_1.size(1), state_T_1.size(1)
+
+    def block(rows_S_0, state_S_1, rows_T_0, state_T_1, rows_mask):
+        gram_S = torch.bmm(rows_S_0, state_S_1.transpose(1, 2)) / divisor_S
+        gram_T = torch.bmm(rows_T_0, state_T_1.transpose(1, 2)) / divisor_T
+        if rows_mask is None:
+            return F.mse_loss(gram_S, gram_T, reduction='sum')
+        return (F.mse_loss(gram_S, gram_T, reduction='none') * rows_mask.unsqueeze(-1) * mask.unsqueeze(1)).sum()
+    total = 0
+    for start in range(0, length, block_size):
+        end = min(start + block_size, length)
+        inputs = (state_S_0[:, start:end], state_S_1, state_T_0[:, start:end], state_T_1,
+                  None if mask is None else mask[:, start:end])
+        if torch.is_grad_enabled() and (state_S_0.requires_grad or state_S_1.requires_grad):
+            total = total + checkpoint(block, *inputs)
+        else:
+            total = total + block(*inputs)
+    if mask is None:
+        return total / (batch_size * length * length)
+    return total / torch.pow(mask.sum(dim=1), 2).sum()
+
+
 def mi_loss(state_S, state_T, critic, baseline_fn, alpha, mask_T=None, mask_S=None):
     if state_T.dim() == 3:
         # cls label states
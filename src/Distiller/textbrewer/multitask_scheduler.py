@@ -0,0 +1,202 @@
+import time
+import queue
+import threading
+import numpy as np
+from .utils import cycle
+
+
+class TaskSchedule:
+    """
+    Deterministic tau-weighted task schedule. For every epoch each task is drawn a number of times proportional to
+    \|d\|^{tau} (largest remainder rounding) and the draws are shuffled with a generator seeded by ``(seed, epoch)``,
+    so that two runs with the same seed visit the tasks in the same order.
+
+    Args:
+        tasknames (List[str]): names of the tasks.
+        sizes (dict): number of batches of each task, None if some of them are unknown (uniform sampling).
+        tau (float): sampling temperature.
+        seed (int): seed of the schedule.
+    """
+    def __init__(self, tasknames, sizes=None, tau=1, seed=0):
+        self.tasknames = list(tasknames)
+        self.seed = seed
+        if sizes is not None:
+            Z = sum(pow(sizes[k], tau) for k in self.tasknames)
+            self.weights = np.array([pow(sizes[k], tau) / Z for k in self.tasknames])
+            self.epoch_length = sum(sizes.values())
+        else:
+            self.weights = np.full(len(self.tasknames), 1. / len(self.tasknames))
+            self.epoch_length = None
+
+    def epoch(self, epoch, length=None):
+        """Returns the task indices of one epoch."""
+        length = length or self.epoch_length
+        exact = self.weights * length
+        counts = np.floor(exact).astype(np.int64)
+        remainder = length - counts.sum()
+        if remainder > 0:
+            counts[np.argsort(counts - exact, kind="stable")[:remainder]] += 1
+        schedule = np.repeat(np.arange(len(self.tasknames)), counts)
+        np.random.RandomState((self.seed + epoch) % (2 ** 32)).shuffle(schedule)
+        return schedule
+
+    def __call__(self, num_draws, block_length=None):
+        """Yields ``num_draws`` tasknames, concatenating as many epochs as needed."""
+        block_length = block_length or self.epoch_length or 1000
+        epoch = 0
+        drawn = 0
+        while drawn < num_draws:
+            for task_index in self.epoch(epoch, block_length):
+                if drawn == num_draws:
+                    break
+                drawn += 1
+                yield self.tasknames[task_index]
+            epoch += 1
+
+
+class _TaskPrefetcher(threading.Thread):
+    """
+    Background thread keeping up to ``size`` batches of one task ready. The first exception raised by the dataloader
+    or the batch postprocessor (or a pass over the dataloader yielding no batch) stops the thread, and is raised once
+    by :meth:`get`.
+    """
+    def __init__(self, dataloader, size, batch_postprocessor=None):
+        super(_TaskPrefetcher, self).__init__(daemon=True)
+        self.dataloader = dataloader
+        self.buffer = queue.Queue(maxsize=size)
+        self.batch_postprocessor = batch_postprocessor
+        self.produce_time = 0.0
+        self.produced = 0
+        self._stop_event = threading.Event()
+
+    def _put(self, item):
+        while not self._stop_event.is_set():
+            try:
+                self.buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self):
+        while not self._stop_event.is_set():
+            produced = self.produced
+            start = time.perf_counter()
+            for batch in self.dataloader:
+                if self.batch_postprocessor is not None:
+                    batch = self.batch_postprocessor(batch)
+                self.produce_time += time.perf_counter() - start
+                self.produced += 1
+                if not self._put(batch):
+                    return
+                start = time.perf_counter()
+            if self.produced == produced:
+                raise RuntimeError("the dataloader of the task yielded no batch")
+
+    def run(self):
+        try:
+            self._produce()
+        except Exception as e:
+            if isinstance(e, StopIteration):
+                # a StopIteration raised by get() inside the scheduler generator would become a RuntimeError anyway
+                error = RuntimeError("the batch postprocessor of the task raised StopIteration")
+                error.__cause__ = e
+                e = error
+            self._put(e)
+
+    def get(self):
+        while True:
+            try:
+                batch = self.buffer.get(timeout=0.1)
+                break
+            except queue.Empty:
+                if not self.is_alive() and self.buffer.empty():
+                    raise RuntimeError("the prefetching worker of the task has stopped")
+        if isinstance(batch, Exception):
+            raise batch
+        return batch
+
+    def stop(self):
+        self._stop_event.set()
+
+
+class MultiTaskBatchScheduler:
+    """
+    Serves ``(batch, taskname)`` pairs following a :class:`TaskSchedule`. With ``prefetch > 0`` every task has a
+    background worker keeping ``prefetch`` collated batches ready, so switching task doesn't wait for the
+    dataloader. Per task statistics are available through :meth:`stats`.
+
+    Args:
+        dataloaders (dict): dict of dataloaders. Keys are tasknames.
+        num_draws (int): total number of batches to serve.
+        tau (float): sampling temperature, see :class:`TaskSchedule`.
+        prefetch (int): number of batches prefetched per task, 0 disables the background workers.
+        seed (int): seed of the task schedule.
+        batch_postprocessors (dict): a dict of batch_postprocessors. Keys are tasknames.
+    """
+    def __init__(self, dataloaders, num_draws, tau=1, prefetch=2, seed=0, batch_postprocessors=None):
+        self.tasknames = list(dataloaders.keys())
+        self.num_draws = num_draws
+        if all(hasattr(v, '__len__') for v in dataloaders.values()):
+            sizes = {k: len(v) for k, v in dataloaders.items()}
+        else:
+            sizes = None
+        self.schedule = TaskSchedule(self.tasknames, sizes, tau, seed)
+        self.prefetch = prefetch
+        batch_postprocessors = batch_postprocessors or {}
+        if prefetch > 0:
+            self.workers = {k: _TaskPrefetcher(v, prefetch, batch_postprocessors.get(k))
+                            for k, v in dataloaders.items()}
+            for worker in self.workers.values():
+                worker.start()
+        else:
+            self.workers = None
+            self.dataiters = {k: cycle(v) for k, v in dataloaders.items()}
+            self.batch_postprocessors = batch_postprocessors
+        self.served = {k: 0 for k in self.tasknames}
+        self.wait_time = {k: 0.0 for k in self.tasknames}
+        self.start_time = None
+
+    @property
+    def sampling_weights(self):
+        return dict(zip(self.tasknames, self.schedule.weights.tolist()))
+
+    def __iter__(self):
+        self.start_time = time.perf_counter()
+        for taskname in self.schedule(self.num_draws):
+            start = time.perf_counter()
+            if self.workers is not None:
+                batch = self.workers[taskname].get()
+            else:
+                batch = next(self.dataiters[taskname])
+                if self.batch_postprocessors.get(taskname) is not None:
+                    batch = self.batch_postprocessors[taskname](batch)
+            self.wait_time[taskname] += time.perf_counter() - start
+            self.served[taskname] += 1
+            yield batch, taskname
+
+    def __len__(self):
+        return self.num_draws
+
+    def stats(self):
+        """Batches served, time blocked waiting for data and batches per second of every task."""
+        elapsed = time.perf_counter() - self.start_time if self.start_time else 0.0
+        stats = {}
+        for taskname in self.tasknames:
+            stats[taskname] = {
+                'batches': self.served[taskname],
+                'wait_time': self.wait_time[taskname],
+                'batches_per_second': self.served[taskname] / elapsed if elapsed > 0 else 0.0,
+            }
+            if self.workers is not None:
+                worker = self.workers[taskname]
+                stats[taskname]['produce_time_per_batch'] = worker.produce_time / max(worker.produced, 1)
+        return stats
+
+    def close(self, timeout=5.0):
+        """Stops the background workers, waiting at most ``timeout`` seconds for each of them."""
+        if self.workers is not None:
+            for worker in self.workers.values():
+                worker.stop()
+            for worker in self.workers.values():
+                worker.join(timeout)
@@ -0,0 +1,126 @@
+import os
+import hashlib
+import torch
+from torch.utils.data import Dataset
+from Distiller.utils import Logger
+
+logger = Logger("all.log",level="debug").logger
+
+
+def teacher_checkpoint_hash(model):
+    """Returns the sha1 of the names and values of the parameters and buffers of a (possibly wrapped) model."""
+    model = model.module if hasattr(model, "module") else model
+    model = model.module if hasattr(model, "module") else model
+    sha1 = hashlib.sha1()
+    for name, tensor in sorted(model.state_dict().items()):
+        sha1.update(name.encode("utf-8"))
+        sha1.update(tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+    return sha1.hexdigest()
+
+
+class IndexedDataset(Dataset):
+    """
+    Wraps a training dataset so that every item also carries its index (``example_ids``) and the id of the
+    augmentation round it comes from (``aug_ids``), which :class:`PseudoLabelCache` uses as keys. Items are always
+    returned as ``teacher``/``student`` dicts, the ids are stored next to them and are not fed to the models.
+
+    Args:
+        dataset: dataset returning dicts of tensors.
+        aug_id (int): id of the augmented version of the dataset, 0 for the original data.
+    """
+    def __init__(self, dataset, aug_id=0):
+        super(IndexedDataset, self).__init__()
+        self.dataset = dataset
+        self.aug_id = aug_id
+
+    def __getitem__(self, index):
+        item = self.dataset[index]
+        if not (isinstance(item, dict) and 'teacher' in item):
+            item = {'teacher': item, 'student': dict(item)}
+        else:
+            item = dict(item)
+        item['example_ids'] = torch.tensor(index, dtype=torch.long)
+        item['aug_ids'] = torch.tensor(self.aug_id, dtype=torch.long)
+        return item
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+class PseudoLabelCache:
+    """
+    Teacher pseudo labels keyed by ``(example id, augmentation id)``. Every entry holds the hard labels given to
+    the student (``labels`` or ``start_positions``/``end_positions``) and, if ``store_soft`` is set, the teacher
+    logits they come from (in float16). The cache is tied to the hash of the teacher checkpoint: a cache file
+    written for another teacher is discarded when loaded. Only the entries of the original data (augmentation id 0)
+    are saved to disk, those of augmented data live as long as the run.
+
+    Args:
+        teacher_hash (str): hash of the teacher checkpoint, see :func:`teacher_checkpoint_hash`.
+        path (str): file the cache is loaded from and saved to, None keeps the cache in memory only.
+        store_soft (bool): whether to keep the teacher logits next to the hard labels.
+    """
+    def __init__(self, teacher_hash, path=None, store_soft=True):
+        self.teacher_hash = teacher_hash
+        self.path = path
+        self.store_soft = store_soft
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self._dirty = False
+        if path is not None and os.path.exists(path):
+            state = torch.load(path)
+            if state.get('teacher_hash') == teacher_hash:
+                self.entries = state['entries']
+                logger.info("Loaded %d teacher pseudo labels from %s", len(self.entries), path)
+            else:
+                logger.info("Teacher checkpoint changed, discarding the pseudo labels cached in %s", path)
+
+    @classmethod
+    def for_teacher(cls, model_T, cache_dir, name, store_soft=True):
+        """Builds the cache of ``model_T`` stored under ``cache_dir`` (one file per teacher checkpoint)."""
+        teacher_hash = teacher_checkpoint_hash(model_T)
+        return cls(teacher_hash, os.path.join(cache_dir, f"pseudo_labels_{name}_{teacher_hash[:12]}.bin"),
+                   store_soft=store_soft)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, example_ids, aug_ids):
+        """Returns the stacked cached labels of a batch, or None if any of its examples is missing."""
+        keys = list(zip(example_ids.view(-1).tolist(), aug_ids.view(-1).tolist()))
+        if not all(key in self.entries for key in keys):
+            self.misses += len(keys)
+            return None
+        self.hits += len(keys)
+        entries = [self.entries[key] for key in keys]
+        return {name: torch.stack([entry[name] for entry in entries]) for name in entries[0]}
+
+    def update(self, example_ids, aug_ids, hard_labels, soft_labels=None):
+        """
+        Args:
+            example_ids, aug_ids (torch.Tensor): keys of the batch.
+            hard_labels (dict): name -> tensor of shape (batch_size, ...).
+            soft_labels (dict): name -> teacher logits of shape (batch_size, ...).
+        """
+        hard_labels = {name: value.detach().cpu() for name, value in hard_labels.items()}
+        if self.store_soft and soft_labels is not None:
+            soft_labels = {name: value.detach().cpu().half() for name, value in soft_labels.items()}
+        else:
+            soft_labels = {}
+        for i, key in enumerate(zip(example_ids.view(-1).tolist(), aug_ids.view(-1).tolist())):
+            entry = {name: value[i].clone() for name, value in hard_labels.items()}
+            entry.update({name: value[i].clone() for name, value in soft_labels.items()})
+            self.entries[key] = entry
+        self._dirty = True
+
+    def save(self):
+        if self.path is None or not self._dirty:
+            return
+        # augmented data is regenerated by every run, only the labels of the original data are kept on disk
+        entries = {key: entry for key, entry in self.entries.items() if key[1] == 0}
+        torch.save({'teacher_hash': self.teacher_hash, 'entries': entries}, self.path + ".tmp")
+        os.replace(self.path + ".tmp", self.path)
+        self._dirty = False
+        logger.info("Saved %d teacher pseudo labels to %s (hits: %d, misses: %d)", len(self.entries), self.path,
+                    self.hits, self.misses)
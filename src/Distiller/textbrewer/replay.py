@@ -0,0 +1,189 @@
+import os
+import math
+import struct
+import collections
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, BatchSampler, RandomSampler
+from .distiller_utils import sample_mixup
+from Distiller.utils import Logger
+# Replay log of the data seen by a training run. Every step records the indices of its examples, the id of the
+# augmented version of the training set they come from, the mixup lambda and permutation, and the task id, in a compact
+# binary file. A later run reading the log gets exactly the same batches, without the augmentation process: the
+# augmented training sets are the ones the recording run saved (train_dataset*.bin in its output directory).
+#
+# File layout (little endian): the header MAGIC + uint16 version, then records starting with a one byte tag.
+#   b"D" dataset:  int16 variant, uint16 path length, utf-8 path
+#   b"S" step:     int32 epoch, int32 step (of the run), int16 variant, int16 task (-1 for single task runs),
+#                  float32 lambda (NaN without mixup), uint32 n, int32[n] example indices, then int32[n] mixup
+#                  permutation when lambda is not NaN
+
+logger = Logger("all.log",level="debug").logger
+
+MAGIC = b"DRPL"
+VERSION = 1
+_HEADER = struct.Struct("<4sH")
+_DATASET = struct.Struct("<hH")
+_STEP = struct.Struct("<iihhfI")
+
+
+class StepRecord(object):
+    __slots__ = ("epoch", "step", "variant", "task", "indices", "lmbd", "permutation")
+
+    def __init__(self, epoch, step, variant, task, indices, lmbd=None, permutation=None):
+        self.epoch = epoch
+        self.step = step
+        self.variant = variant
+        self.task = task
+        self.indices = indices
+        self.lmbd = lmbd
+        self.permutation = permutation
+
+    @property
+    def mixup(self):
+        if self.lmbd is None:
+            return None
+        return torch.tensor(self.lmbd), self.permutation.tolist()
+
+
+class _RecordingBatchSampler(object):
+    # yields the batches of `batch_sampler` and queues their indices for ReplayLog.step, in the same order
+    def __init__(self, batch_sampler, replay_log, epoch):
+        self.batch_sampler = batch_sampler
+        self.replay_log = replay_log
+        self.epoch = epoch
+
+    def __iter__(self):
+        for indices in self.batch_sampler:
+            self.replay_log.pending.append((self.epoch, indices))
+            yield indices
+        self.epoch += 1
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+
+class _ReplayBatchSampler(object):
+    # yields the recorded batches of one epoch, of the next one at every new iteration
+    def __init__(self, replay_log, epoch):
+        self.replay_log = replay_log
+        self.epoch = epoch
+
+    def __iter__(self):
+        for record in self.replay_log.epochs.get(self.epoch, []):
+            yield record.indices.tolist()
+        self.epoch += 1
+
+    def __len__(self):
+        return len(self.replay_log.epochs.get(self.epoch, []))
+
+
+class ReplayLog(object):
+    '''
+    * Records the batches of a training run (``replay=False``) or serves the batches of a recorded run (``replay=True``).
+    * The distillers call :meth:`wrap` on the dataloader of every epoch, and :meth:`step` before every training step,
+      which returns the mixup parameters of the step.
+
+    :param str path: the log file, overwritten when recording
+    :param bool replay: whether to read the log instead of writing it
+    '''
+    def __init__(self, path, replay=False):
+        self.path = path
+        self.replaying = replay
+        self.datasets = {}
+        self.variant = 0
+        self.position = 0
+        if replay:
+            self.records = []
+            self.epochs = collections.OrderedDict()
+            self._read()
+            logger.info(f"Replaying {len(self.records)} steps of {len(self.epochs)} epochs from {path}")
+        else:
+            self.pending = collections.deque()
+            self.writer = open(path, "wb")
+            self.writer.write(_HEADER.pack(MAGIC, VERSION))
+
+    def _read(self):
+        with open(self.path, "rb") as f:
+            data = f.read()
+        magic, version = _HEADER.unpack_from(data, 0)
+        assert magic == MAGIC and version == VERSION, f"{self.path} is not a replay log of version {VERSION}"
+        offset = _HEADER.size
+        while offset < len(data):
+            tag = data[offset:offset + 1]
+            offset += 1
+            if tag == b"D":
+                variant, length = _DATASET.unpack_from(data, offset)
+                offset += _DATASET.size
+                self.datasets[variant] = data[offset:offset + length].decode("utf-8")
+                offset += length
+            elif tag == b"S":
+                epoch, step, variant, task, lmbd, n = _STEP.unpack_from(data, offset)
+                offset += _STEP.size
+                indices = np.frombuffer(data, dtype="<i4", count=n, offset=offset)
+                offset += 4 * n
+                permutation = None
+                if math.isnan(lmbd):
+                    lmbd = None
+                else:
+                    permutation = np.frombuffer(data, dtype="<i4", count=n, offset=offset)
+                    offset += 4 * n
+                record = StepRecord(epoch, step, variant, task, indices, lmbd, permutation)
+                self.records.append(record)
+                self.epochs.setdefault(epoch, []).append(record)
+            else:
+                raise ValueError(f"Corrupted replay log {self.path} at byte {offset - 1}")
+
+    def record_dataset(self, variant, path):
+        """Records that the training set of `variant` was saved to `path`."""
+        path = os.path.abspath(path).encode("utf-8")
+        self.writer.write(b"D" + _DATASET.pack(variant, len(path)) + path)
+
+    def dataset(self, variant):
+        """The training set of `variant` saved by the recording run, or None if it was not recorded."""
+        if variant not in self.datasets:
+            return None
+        logger.info(f"Loading the training set of variant {variant} from {self.datasets[variant]}")
+        return torch.load(self.datasets[variant])
+
+    def wrap(self, dataloader, epoch, variant=0):
+        """A dataloader over the dataset of `dataloader` which records, or replays, the batches of `epoch`."""
+        self.variant = variant
+        batch_sampler = getattr(dataloader.batch_sampler, "batch_sampler", dataloader.batch_sampler)
+        if self.replaying:
+            batch_sampler = _ReplayBatchSampler(self, epoch)
+        else:
+            if batch_sampler is None:
+                batch_sampler = BatchSampler(RandomSampler(dataloader.dataset), dataloader.batch_size, False)
+            batch_sampler = _RecordingBatchSampler(batch_sampler, self, epoch)
+            self.writer.flush()
+        return DataLoader(dataloader.dataset, batch_sampler=batch_sampler, collate_fn=dataloader.collate_fn,
+                          num_workers=dataloader.num_workers, pin_memory=dataloader.pin_memory)
+
+    def step(self, mixup=False, task=-1):
+        """
+        Records the next batch served by the wrapped dataloader, or moves to the next recorded batch.
+
+        Returns:
+            the mixup ``(lambda, permutation)`` of the step, None without mixup
+        """
+        if self.replaying:
+            record = self.records[self.position]
+            self.position += 1
+            assert (record.lmbd is not None) == bool(mixup), "the recorded run used mixup differently"
+            return record.mixup
+        epoch, indices = self.pending.popleft()
+        params = sample_mixup(len(indices)) if mixup else None
+        lmbd = float(params[0]) if mixup else float("nan")
+        record = b"S" + _STEP.pack(epoch, self.position, self.variant, task, lmbd, len(indices)) + \
+            np.asarray(indices, dtype="<i4").tobytes()
+        if mixup:
+            record += np.asarray(params[1], dtype="<i4").tobytes()
+        self.writer.write(record)
+        self.position += 1
+        return params
+
+    def close(self):
+        if not self.replaying:
+            self.writer.close()
+            logger.info(f"Recorded {self.position} steps to {self.path}")
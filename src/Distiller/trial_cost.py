@@ -0,0 +1,105 @@
+import time
+import resource
+import torch
+from .utils import Logger
+# Training cost of the trials of a sweep (auto_distiller_exp.py, ray_directory/run.py): measured throughput, evaluation
+# time and peak memory, a cost aware objective and the termination of trials that will not fit in their time budget.
+
+logger = Logger("all.log",level="debug").logger
+
+
+class TrialBudgetExceeded(Exception):
+    """Raised by :meth:`TrialCostTracker.check` when a trial is projected to exceed its time budget."""
+
+
+class TrialCostTracker:
+    """
+    Measures the cost of a trial between evaluations.
+
+    Args:
+        time_budget (float): wall clock budget of the trial in seconds, None or 0 for no budget.
+        objective (str): ``"score"`` ranks trials by dev score only, ``"budget"`` scales the score of trials projected
+            to exceed the budget by ``budget / projected time``.
+        tolerance (float): trials are terminated once their projected time exceeds ``tolerance * time_budget``.
+        total_steps (int): number of optimization steps of the trial, needed to project its total time.
+    """
+    def __init__(self, time_budget=None, objective="score", tolerance=1.1, total_steps=None):
+        assert objective in ["score", "budget"]
+        self.time_budget = time_budget if time_budget else None
+        self.objective_type = objective
+        self.tolerance = tolerance
+        self.total_steps = total_steps
+        self.start()
+
+    def start(self, total_steps=None, initial_step=0):
+        """Starts the measurement at step `initial_step`, e.g. the step of the checkpoint a PBT trial resumes from."""
+        if total_steps is not None:
+            self.total_steps = total_steps
+        self.start_time = time.time()
+        self.start_step = initial_step
+        self.eval_seconds = 0.0
+        self.num_evals = 0
+        self.last_step = initial_step
+        self.last_metrics = None
+        self._eval_start = None
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+
+    def start_eval(self):
+        self._eval_start = time.time()
+
+    def end_eval(self, step):
+        self.last_step = step
+        if self._eval_start is not None:
+            self.eval_seconds += time.time() - self._eval_start
+            self.num_evals += 1
+            self._eval_start = None
+        self.last_metrics = self.metrics(step)
+
+    @staticmethod
+    def peak_memory_mb():
+        if torch.cuda.is_available():
+            return torch.cuda.max_memory_allocated() / 2 ** 20
+        # ru_maxrss is in kilobytes on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+    def metrics(self, step):
+        """Cost of the trial after `step` optimization steps."""
+        elapsed = time.time() - self.start_time
+        train_seconds = max(elapsed - self.eval_seconds, 1e-6)
+        # only the steps run since start() were timed
+        steps = step - self.start_step
+        steps_per_second = steps / train_seconds
+        seconds_per_eval = self.eval_seconds / self.num_evals if self.num_evals else 0.0
+        projected_seconds = elapsed
+        if self.total_steps and steps > 0:
+            remaining_steps = max(self.total_steps - step, 0)
+            remaining_evals = self.num_evals * remaining_steps / steps
+            projected_seconds += remaining_steps / steps_per_second + remaining_evals * seconds_per_eval
+        return {"steps_per_second": steps_per_second,
+                "seconds_per_eval": seconds_per_eval,
+                "peak_memory_mb": self.peak_memory_mb(),
+                "elapsed_seconds": elapsed,
+                "projected_seconds": projected_seconds,
+                "over_budget": int(self.time_budget is not None
+                                   and projected_seconds > self.tolerance * self.time_budget)}
+
+    def summary(self, score):
+        """Cost metrics and objective of the trial, as measured at its last evaluation."""
+        metrics = self.last_metrics if self.last_metrics is not None else self.metrics(self.last_step)
+        return dict(metrics, objective=self._objective(score, metrics))
+
+    def objective(self, score, step):
+        return self._objective(score, self.metrics(step))
+
+    def _objective(self, score, metrics):
+        if self.objective_type == "score" or self.time_budget is None:
+            return score
+        return score * min(1.0, self.time_budget / max(metrics["projected_seconds"], 1e-6))
+
+    def check(self, step):
+        """Raises :class:`TrialBudgetExceeded` if the trial is on track to exceed its time budget."""
+        metrics = self.metrics(step)
+        if metrics["over_budget"]:
+            raise TrialBudgetExceeded(f"Projected {metrics['projected_seconds']:.0f}s at step {step}, "
+                                      f"budget is {self.time_budget:.0f}s")
@@ -11,6 +11,8 @@ import boto3
 import re
 import json
 import string
+from .artifact_writer import get_artifact_writer
+from .feature_arrays import feature_column
 
 
 class Logger(object):
@@ -98,12 +100,17 @@ def cal_layer_mapping(args, t_config, s_config):
 def write_predictions_squad(tokenizer, all_examples, all_features, all_results, n_best_size,
                              max_answer_length, do_lower_case, output_prediction_file,
                              output_nbest_file, output_null_log_odds_file, version_2_with_negative,
-                             null_score_diff_threshold, write_prediction):
-    """Write final predictions to the json file and log-odds of null if needed."""
+                             null_score_diff_threshold, write_prediction, compress=False):
+    """
+    Write final predictions to the json file and log-odds of null if needed. The files are written in the background
+    by the shared :class:`~Distiller.artifact_writer.ArtifactWriter` (gzip compressed if `compress`), call
+    :func:`~Distiller.artifact_writer.flush_artifacts` before reading them back.
+    """
 
+    # group the feature indices by the example_index column, the features are built one example at a time
     example_index_to_features = collections.defaultdict(list)
-    for feature in all_features:
-        example_index_to_features[feature.example_index].append(feature)
+    for feature_index, example_index in enumerate(feature_column(all_features, "example_index")):
+        example_index_to_features[int(example_index)].append(feature_index)
 
     unique_id_to_result = {}
     for result in all_results:
@@ -118,7 +125,7 @@ def write_predictions_squad(tokenizer, all_examples, all_features, all_results,
     scores_diff_json = collections.OrderedDict()
 
     for (example_index, example) in enumerate(all_examples):
-        features = example_index_to_features[example_index]
+        features = [all_features[i] for i in example_index_to_features[example_index]]
 
         prelim_predictions = []
         # keep track of the minimum score of null start+end of position 0
@@ -268,20 +275,18 @@ def write_predictions_squad(tokenizer, all_examples, all_features, all_results,
                 all_predictions[example.qas_id] = best_non_null_entry.text
         all_nbest_json[example.qas_id] = nbest_json
     if write_prediction:
+        writer = get_artifact_writer()
         if output_prediction_file:
             logger.info(f"Writing predictions to: {output_prediction_file}")
-            with open(output_prediction_file, "w") as writer:
-                writer.write(json.dumps(all_predictions, indent=4) + "\n")
+            writer.write_json(output_prediction_file, all_predictions, compress)
 
         if output_nbest_file:
             logger.info(f"Writing nbest to: {output_nbest_file}")
-            with open(output_nbest_file, "w") as writer:
-                writer.write(json.dumps(all_nbest_json, indent=4) + "\n")
+            writer.write_json(output_nbest_file, all_nbest_json, compress)
 
         if output_null_log_odds_file and version_2_with_negative:
             logger.info(f"Writing null_log_odds to: {output_null_log_odds_file}")
-            with open(output_null_log_odds_file, "w") as writer:
-                writer.write(json.dumps(scores_diff_json, indent=4) + "\n")
+            writer.write_json(output_null_log_odds_file, scores_diff_json, compress)
 
     return all_predictions
 